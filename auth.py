@@ -1,21 +1,36 @@
+import asyncio
+import hashlib
+import secrets
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import UTC, datetime, timedelta
+import time
 import jwt
 from fastapi.security import OAuth2PasswordBearer
 from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
 
 from config import settings
 
 from typing import Annotated
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 
-from sqlalchemy import select
+from sqlalchemy import delete, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from models import Task, User
+from cache import LRUCache
+from models import RefreshToken, User, profile_image_path
 from database import get_db
+from timing import timed
 
 # Uses the Argon2 algorithm via pwdlib — resistant to brute-force attacks
-password_hash = PasswordHash.recommended()
+password_hash = PasswordHash((
+    Argon2Hasher(
+        time_cost=settings.argon2_time_cost,
+        memory_cost=settings.argon2_memory_cost,
+        parallelism=settings.argon2_parallelism,
+    ),
+))
 
 # Tells FastAPI where clients obtain a token; also powers the Authorize button in /docs
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/users/token")
@@ -31,6 +46,61 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return password_hash.verify(plain_password, hashed_password)
 
 
+class PasswordHashPool:
+    # Runs Argon2 off the event loop. At most max_pending hashes may be running or queued;
+    # past that we shed load with a 503 instead of letting logins pile up behind each other
+    def __init__(self, kind: str, workers: int, max_pending: int, retry_after: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Executor | None = None
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry shortly",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        if self._executor is None:
+            # argon2-cffi releases the GIL while hashing, so threads scale across cores
+            executor_class = ProcessPoolExecutor if self.kind == "process" else ThreadPoolExecutor
+            self._executor = executor_class(max_workers=self.workers)
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "workers": self.workers, "max_pending": self.max_pending, "pending": self.pending, "rejected": self.rejected}
+
+
+password_pool = PasswordHashPool(
+    settings.password_hash_executor,
+    settings.password_hash_workers,
+    settings.password_hash_max_pending,
+    settings.password_hash_retry_after_seconds,
+)
+
+
+async def hash_password_async(password: str) -> str:
+    return await password_pool.run(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
     if expires_delta:
@@ -49,10 +119,10 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 
-def verify_access_token(token: str) -> str | None:
-    # Returns the user ID stored in "sub", or None if the token is invalid/expired
+def decode_access_token(token: str) -> dict | None:
+    # Returns the verified claims, or None if the token is invalid/expired
     try:
-        payload = jwt.decode(
+        return jwt.decode(
             token,
             settings.secret_key.get_secret_value(),
             algorithms=[settings.algorithm],
@@ -61,20 +131,188 @@ def verify_access_token(token: str) -> str | None:
         )
     except jwt.InvalidTokenError:
         return None
-    else:
-        return payload.get("sub")
+
+
+def verify_access_token(token: str) -> str | None:
+    # Returns the user ID stored in "sub", or None if the token is invalid/expired
+    payload = decode_access_token(token)
+    if payload is None:
+        return None
+    return payload.get("sub")
+
+
+# Refresh tokens: opaque random strings, stored as sha256 (unique index) so a lookup is one seek
+# and a leaked table can't be replayed. Exchanging one needs no password hashing. Each use marks
+# it used and issues the next token of its family; presenting a used token again means it was
+# copied, so the whole family is revoked and the owner has to log in again
+def hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def issue_refresh_token(db: AsyncSession, user_id: int, family_id: str | None = None) -> str:
+    # A login starts a new family; the caller commits
+    token = secrets.token_urlsafe(32)
+    await db.execute(insert(RefreshToken).values(
+        token_hash=hash_refresh_token(token),
+        user_id=user_id,
+        family_id=family_id or secrets.token_hex(16),
+        expires_at=datetime.now(UTC) + timedelta(days=settings.refresh_token_expire_days),
+    ))
+    return token
+
+
+async def rotate_refresh_token(db: AsyncSession, token: str) -> tuple[int, str]:
+    # Returns the owner's id and the next refresh token; the caller commits
+    now = datetime.now(UTC)
+    token_hash = hash_refresh_token(token)
+    stmt = (
+        update(RefreshToken)
+        .where(
+            RefreshToken.token_hash == token_hash,
+            RefreshToken.used_at.is_(None),
+            RefreshToken.revoked_at.is_(None),
+            RefreshToken.expires_at > now,
+        )
+        .values(used_at=now)
+        .returning(RefreshToken.user_id, RefreshToken.family_id)
+    )
+    row = (await db.execute(stmt)).first()
+    if row is None:
+        reused_family = (await db.execute(
+            select(RefreshToken.family_id).where(RefreshToken.token_hash == token_hash, RefreshToken.used_at.is_not(None))
+        )).scalar()
+        if reused_family is not None:
+            await revoke_refresh_family(db, reused_family)
+            await db.commit()
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired refresh token")
+    return row.user_id, await issue_refresh_token(db, row.user_id, row.family_id)
+
+
+async def revoke_refresh_token(db: AsyncSession, token: str):
+    # Logout: revokes the token's whole family in one statement; unknown tokens change nothing
+    family_id = select(RefreshToken.family_id).where(RefreshToken.token_hash == hash_refresh_token(token)).scalar_subquery()
+    await revoke_refresh_family(db, family_id)
+
+
+async def prune_refresh_tokens(db: AsyncSession) -> int:
+    # Expired tokens can't be exchanged any more; returns how many were removed
+    result = await db.execute(delete(RefreshToken).where(RefreshToken.expires_at < datetime.now(UTC)))
+    return result.rowcount
+
+
+async def revoke_refresh_family(db: AsyncSession, family_id):
+    # family_id is a value or a scalar subquery
+    await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.now(UTC))
+    )
+
+
+# Lightweight, detached snapshot of the authenticated user; endpoints that need to
+# modify the account load the ORM row themselves
+@dataclass(frozen=True, slots=True)
+class Principal:
+    id: int
+    username: str
+    email: str
+    image_file: str | None
+    version: int
+
+    @property
+    def image_path(self) -> str:
+        return profile_image_path(self.image_file)
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        return cls(id=user.id, username=user.username, email=user.email, image_file=user.image_file, version=user.version)
+
+
+class PrincipalCache:
+    # Verified token -> Principal, so repeat requests skip both the HMAC check and the users lookup.
+    # Entries never outlive the token's "exp" and are dropped when the user is updated or deleted.
+    # Invalidation is per process, so token_cache_ttl_seconds bounds staleness across workers
+    def __init__(self, maxsize: int, ttl: float):
+        self._entries = LRUCache(maxsize, ttl, on_evict=self._forget)
+        self._tokens_by_user: dict[int, set[str]] = {}
+
+    def get(self, token: str) -> Principal | None:
+        entry = self._entries.get(token)
+        return entry[1] if entry is not None else None
+
+    def peek(self, token: str) -> Principal | None:
+        # For the rate limiter: doesn't count as a lookup
+        entry = self._entries.peek(token)
+        return entry[1] if entry is not None else None
+
+    def set(self, token: str, claims: dict, principal: Principal) -> None:
+        self._entries.set(token, (claims, principal), ttl=claims["exp"] - time.time())
+        if token in self._entries:
+            self._tokens_by_user.setdefault(principal.id, set()).add(token)
+
+    def invalidate_user(self, user_id: int) -> None:
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self._entries.delete(token)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._entries.reset_stats()
+
+    def stats(self) -> dict:
+        return self._entries.stats()
+
+    def _forget(self, token: str, entry: tuple[dict, Principal]) -> None:
+        principal = entry[1]
+        tokens = self._tokens_by_user.get(principal.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[principal.id]
+
+
+token_cache = PrincipalCache(settings.token_cache_size, settings.token_cache_ttl_seconds)
 
 
 async def get_current_user(
+        request: Request,
         token: Annotated[str, Depends(oauth2_scheme)],
         db: Annotated[AsyncSession, Depends(get_db)]
-) -> User:
-    user_id = verify_access_token(token)
-    if user_id is None:
+) -> Principal:
+    # Timed on its own so Server-Timing shows how much of a request went to authentication
+    with timed("auth"):
+        principal = await _authenticate(token, db)
+    # Read-your-writes pins the user, not the token (see pin_writers_to_primary in main.py)
+    request.state.user_id = principal.id
+    return principal
+
+
+def request_user_id(request: Request) -> int | None:
+    # The user a bearer token belongs to, without a database lookup; None for anonymous requests
+    # and invalid tokens. Cheap enough for middleware (rate limits, replica routing)
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    principal = token_cache.peek(token)
+    if principal is not None:
+        return principal.id
+    claims = decode_access_token(token)
+    try:
+        return int(claims["sub"]) if claims is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+async def _authenticate(token: str, db: AsyncSession) -> Principal:
+    principal = token_cache.get(token)
+    if principal is not None:
+        return principal
+
+    claims = decode_access_token(token)
+    if claims is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
     try:
         # "sub" is stored as a string in the JWT payload, so cast it back to int
-        user_id_int = int(user_id)
+        user_id_int = int(claims["sub"])
     except (TypeError, ValueError):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
 
@@ -83,8 +321,11 @@ async def get_current_user(
     if not user:
         # Token was valid but the account was deleted after it was issued
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found", headers={"WWW-Authenticate": "Bearer"})
-    return user
+
+    principal = Principal.from_user(user)
+    token_cache.set(token, claims, principal)
+    return principal
 
 
 # Reusable type alias — inject this into any endpoint that requires authentication
-CurrentUser = Annotated[User, Depends(get_current_user)]
\ No newline at end of file
+CurrentUser = Annotated[Principal, Depends(get_current_user)]
\ No newline at end of file
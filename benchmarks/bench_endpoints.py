@@ -0,0 +1,385 @@
+"""Endpoint benchmarks for the Task Manager API.
+
+Drives main.app in-process through httpx.ASGITransport (like tests/conftest.py) against a
+seeded SQLite database and reports throughput and p50/p95/p99 latency per route.
+
+    python -m benchmarks.bench_endpoints --users 1000 --tasks 1000000 --output bench.json
+    python -m benchmarks.bench_endpoints --baseline benchmarks/baseline.json --tolerance 0.25
+
+Exits with status 1 when a route is slower than the baseline by more than the tolerance.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+BENCH_PASSWORD = "benchmark-password"
+SEED_CHUNK = 10_000
+BATCH_SIZE = 20
+# Made-up vocabulary for task text, so search terms have a realistic spread of document frequencies
+VOCABULARY = [prefix + suffix for prefix in ("ka", "lo", "mi", "ne", "ru", "sa", "te", "vo", "pi", "du")
+              for suffix in ("bar", "den", "fix", "gun", "lap", "mon", "pet", "rix", "sol", "tam", "vek", "zor")]
+DEEP_PAGES = 5
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    # Builds (path, kwargs for client.request) for the i-th request
+    build: Callable[[int], tuple[str, dict]]
+    auth: bool = False
+    expected: tuple[int, ...] = (200,)
+    # Called with each successful response, e.g. to remember ids for the DELETE scenarios
+    record: Callable[[Any], None] | None = None
+
+
+@dataclass
+class BenchContext:
+    headers: dict
+    user_id: int
+    users: int
+    task_ids: list[int]
+    deep_cursor: str | None = None
+    created_task_ids: list[int] = field(default_factory=list)
+    created_user_ids: list[int] = field(default_factory=list)
+    # Unused refresh tokens of bench1; each refresh or revoke spends one
+    refresh_tokens: list[str] = field(default_factory=list)
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    # Nearest-rank percentile on an already sorted list
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, math.ceil(pct / 100 * len(samples)) - 1))
+    return samples[rank]
+
+
+def summarize(latencies: list[float], wall_time: float, errors: int) -> dict:
+    samples = sorted(latencies)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": len(samples) / wall_time if wall_time else 0.0,
+        "mean_ms": 1000 * sum(samples) / len(samples) if samples else 0.0,
+        "p50_ms": 1000 * percentile(samples, 50),
+        "p95_ms": 1000 * percentile(samples, 95),
+        "p99_ms": 1000 * percentile(samples, 99),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, metric: str = "p95_ms") -> list[str]:
+    # Returns one message per route that regressed past the tolerance (or started failing)
+    regressions = []
+    for name, base in baseline.get("routes", {}).items():
+        current = results.get("routes", {}).get(name)
+        if current is None:
+            regressions.append(f"{name}: missing from current run")
+            continue
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: {current['errors']} errors (baseline {base.get('errors', 0)})")
+        limit = base[metric] * (1 + tolerance)
+        if base[metric] > 0 and current[metric] > limit:
+            regressions.append(f"{name}: {metric} {current[metric]:.2f} > {limit:.2f} (baseline {base[metric]:.2f} +{tolerance:.0%})")
+    return regressions
+
+
+async def seed(users: int, tasks: int, reseed: bool = False) -> None:
+    from sqlalchemy import func, insert, select
+
+    from auth import hash_password
+    from database import AsyncSessionLocal, Base, engine
+    from models import Task, User
+    from schema import create_schema
+
+    async with engine.begin() as conn:
+        if reseed:
+            await conn.run_sync(Base.metadata.drop_all)
+        await create_schema(conn)
+
+    async with AsyncSessionLocal() as db:
+        existing_users = (await db.execute(select(func.count()).select_from(User))).scalar()
+        existing_tasks = (await db.execute(select(func.count()).select_from(Task))).scalar()
+    if existing_users == users and existing_tasks == tasks:
+        return
+    if existing_users or existing_tasks:
+        # Different dataset size: start over so results stay comparable
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await create_schema(conn)
+
+    # One Argon2 hash shared by every seeded user; hashing 1k passwords would dominate seeding
+    password_hash = hash_password(BENCH_PASSWORD)
+    rng = random.Random(42)
+    now = datetime.now(UTC)
+
+    async with engine.begin() as conn:
+        await conn.execute(insert(User.__table__), [
+            {"id": i, "username": f"bench{i}", "email": f"bench{i}@example.com", "password_hash": password_hash, "version": 1}
+            for i in range(1, users + 1)
+        ])
+    for start in range(0, tasks, SEED_CHUNK):
+        rows = []
+        for i in range(start, min(start + SEED_CHUNK, tasks)):
+            created = now - timedelta(seconds=tasks - i)
+            due = created + timedelta(days=rng.randint(-30, 60)) if rng.random() < 0.7 else None
+            rows.append({
+                "user_id": rng.randint(1, users),
+                "task": f"Task {i} " + " ".join(rng.sample(VOCABULARY, 4)),
+                "created": created,
+                "due": due,
+                "done": rng.random() < 0.4,
+                "version": 1,
+            })
+        async with engine.begin() as conn:
+            await conn.execute(insert(Task.__table__), rows)
+
+    from crud import rebuild_task_counters
+    async with AsyncSessionLocal() as db:
+        await rebuild_task_counters(db)
+        await db.commit()
+
+
+def scenarios(ctx: BenchContext) -> list[Scenario]:
+    from auth import create_access_token
+    from sync import encode_sync_cursor
+
+    task_ids = ctx.task_ids
+    new_users = itertools.count()
+
+    def owned(i: int) -> int:
+        return task_ids[i % len(task_ids)]
+
+    def create_user(i: int):
+        n = next(new_users)
+        return "/api/users", {"json": {"username": f"benchnew{n}", "email": f"benchnew{n}@example.com", "password": BENCH_PASSWORD}}
+
+    def delete_user(i: int):
+        # Only the owner may delete an account; minting the token skips an Argon2 login per request
+        user_id = ctx.created_user_ids.pop()
+        token = create_access_token({"sub": str(user_id)})
+        return f"/api/users/{user_id}", {"headers": {"Authorization": f"Bearer {token}"}}
+
+    def update_user(i: int):
+        # Spread over the seeded users: concurrent PATCHes of one row would fail the version check (412)
+        user_id = i % ctx.users + 1
+        token = create_access_token({"sub": str(user_id)})
+        return f"/api/users/{user_id}", {"json": {"image_file": f"bench{i % 10}.jpg"}, "headers": {"Authorization": f"Bearer {token}"}}
+
+    def new_task(i: int) -> dict:
+        return {"task": f"Benchmark new task {i}", "done": False, "due": None}
+
+    def spend_refresh_token() -> dict:
+        return {"json": {"refresh_token": ctx.refresh_tokens.pop()}}
+
+    # A client catching up from far behind: every request gets a full page of changed tasks. The
+    # tombstone position stays inside the retention window, older cursors are answered with 410
+    now = datetime.now(UTC)
+    changes_cursor = encode_sync_cursor((datetime(1970, 1, 1, tzinfo=UTC), 0), (now - timedelta(days=1), 0))
+
+    return [
+        # Reads
+        Scenario("GET /api/tasks", "GET", lambda i: ("/api/tasks", {})),
+        Scenario("GET /api/tasks (deep page)", "GET", lambda i: ("/api/tasks", {"params": {"after": ctx.deep_cursor}})),
+        Scenario("GET /api/tasks (filtered, sort=due)", "GET", lambda i: ("/api/tasks", {"params": {"done": "false", "sort": "due"}})),
+        Scenario("GET /api/tasks/{id}", "GET", lambda i: (f"/api/tasks/{owned(i)}", {})),
+        Scenario("GET /api/tasks/search", "GET", lambda i: ("/api/tasks/search", {"params": {"q": VOCABULARY[i % len(VOCABULARY)]}}), auth=True),
+        Scenario("GET /api/users/me", "GET", lambda i: ("/api/users/me", {}), auth=True),
+        Scenario("GET /api/users/{id}", "GET", lambda i: (f"/api/users/{ctx.user_id}", {})),
+        Scenario("GET /api/users/{id}/tasks", "GET", lambda i: (f"/api/users/{ctx.user_id}/tasks", {})),
+        Scenario("GET /api/users/{id}/tasks/stats", "GET", lambda i: (f"/api/users/{ctx.user_id}/tasks/stats", {})),
+        Scenario("GET /api/users/{id}/tasks/export", "GET", lambda i: (f"/api/users/{ctx.user_id}/tasks/export", {})),
+        Scenario("GET /api/tasks/changes", "GET", lambda i: ("/api/tasks/changes", {"params": {"since": changes_cursor}})),
+        # Argon2-bound paths
+        Scenario("POST /api/users/token", "POST", lambda i: ("/api/users/token", {"data": {"username": "bench1@example.com", "password": BENCH_PASSWORD}})),
+        Scenario("POST /api/users", "POST", create_user, expected=(201,), record=lambda r: ctx.created_user_ids.append(r.json()["id"])),
+        # Refresh tokens: the logins they replace skip Argon2; both spend tokens minted by top_up
+        Scenario("POST /api/users/token/refresh", "POST", lambda i: ("/api/users/token/refresh", spend_refresh_token())),
+        Scenario("POST /api/users/token/revoke", "POST", lambda i: ("/api/users/token/revoke", spend_refresh_token()), expected=(204,)),
+        # Task writes
+        Scenario("POST /api/tasks", "POST", lambda i: ("/api/tasks", {"json": new_task(i)}), auth=True, expected=(201,),
+                 record=lambda r: ctx.created_task_ids.append(r.json()["id"])),
+        Scenario("POST /api/tasks/batch", "POST", lambda i: ("/api/tasks/batch", {"json": {"items": [new_task(i)] * BATCH_SIZE}}), auth=True, expected=(201,),
+                 record=lambda r: ctx.created_task_ids.extend(item["id"] for item in r.json()["results"])),
+        Scenario("PUT /api/tasks/{id}", "PUT", lambda i: (f"/api/tasks/{owned(i)}", {"json": new_task(i)}), auth=True),
+        Scenario("PATCH /api/tasks/{id}", "PATCH", lambda i: (f"/api/tasks/{owned(i)}", {"json": {"done": i % 2 == 0}}), auth=True),
+        Scenario("PATCH /api/tasks/batch", "PATCH", lambda i: ("/api/tasks/batch", {"json": {"items": [{"id": owned(i * BATCH_SIZE + j), "done": True} for j in range(BATCH_SIZE)]}}), auth=True),
+        # DELETEs consume the rows created above, so the seeded dataset keeps its size
+        Scenario("DELETE /api/tasks/{id}", "DELETE", lambda i: (f"/api/tasks/{ctx.created_task_ids.pop()}", {}), auth=True, expected=(204,)),
+        Scenario("DELETE /api/tasks/batch", "DELETE", lambda i: ("/api/tasks/batch", {"params": {"ids": [ctx.created_task_ids.pop() for _ in range(BATCH_SIZE)]}}), auth=True),
+        # User writes
+        Scenario("PATCH /api/users/{id}", "PATCH", update_user),
+        Scenario("DELETE /api/users/{id}", "DELETE", delete_user, expected=(204,)),
+    ]
+
+
+async def run_scenario(client, scenario: Scenario, ctx: BenchContext, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(i: int):
+        nonlocal errors
+        path, kwargs = scenario.build(i)
+        if scenario.auth:
+            kwargs = {**kwargs, "headers": ctx.headers}
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(scenario.method, path, **kwargs)
+            latencies.append(time.perf_counter() - start)
+        if response.status_code not in scenario.expected:
+            errors += 1
+        elif scenario.record is not None:
+            scenario.record(response)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+async def run_benchmarks(client, requests: int, concurrency: int, only: list[str] | None = None, warmup: int = 5) -> dict:
+    from sqlalchemy import func, select
+
+    from config import settings
+    from database import AsyncSessionLocal
+    from models import Task, User
+
+    login = await client.post("/api/users/token", data={"username": "bench1@example.com", "password": BENCH_PASSWORD})
+    login.raise_for_status()
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Task.id).where(Task.user_id == 1).order_by(Task.id).limit(1000))
+        task_ids = list(result.scalars().all())
+        users = (await db.execute(select(func.count()).select_from(User))).scalar()
+    if not task_ids:
+        raise SystemExit("Seeded user bench1 owns no tasks; seed more tasks")
+
+    ctx = BenchContext(headers={"Authorization": f"Bearer {login.json()['access_token']}"}, user_id=1, users=users, task_ids=task_ids)
+    # A cursor a few pages in shows whether later pages stay as cheap as the first one
+    for _ in range(DEEP_PAGES):
+        params = {"limit": settings.max_page_size, **({"after": ctx.deep_cursor} if ctx.deep_cursor else {})}
+        page = await client.get("/api/tasks", params=params)
+        page.raise_for_status()
+        ctx.deep_cursor = page.json()["next_cursor"] or ctx.deep_cursor
+
+    selected = [s for s in scenarios(ctx) if not only or any(name in s.name for name in only)]
+    routes = {}
+    for scenario in selected:
+        if scenario.method == "GET" and warmup:
+            # Unmeasured requests so first-hit costs (statement compilation, cold caches) are not sampled
+            await run_scenario(client, scenario, ctx, warmup, concurrency)
+        if scenario.method == "DELETE" or scenario.name.startswith("POST /api/users/token/"):
+            await top_up(client, ctx, scenario, requests)
+        routes[scenario.name] = await run_scenario(client, scenario, ctx, requests, concurrency)
+    return routes
+
+
+async def top_up(client, ctx: BenchContext, scenario: Scenario, requests: int) -> None:
+    # Makes sure a DELETE scenario has enough rows to consume when the POST scenarios were skipped,
+    # and the refresh token scenarios have a token for every request
+    if scenario.name.startswith("POST /api/users/token/"):
+        from auth import issue_refresh_token
+        from database import AsyncSessionLocal
+
+        # Minted directly: one Argon2 login per token would dominate the setup
+        async with AsyncSessionLocal() as db:
+            ctx.refresh_tokens += [await issue_refresh_token(db, ctx.user_id) for _ in range(len(ctx.refresh_tokens), requests)]
+            await db.commit()
+        return
+    if scenario.name == "DELETE /api/users/{id}":
+        for n in range(len(ctx.created_user_ids), requests):
+            response = await client.post("/api/users", json={"username": f"benchdel{n}", "email": f"benchdel{n}@example.com", "password": BENCH_PASSWORD})
+            response.raise_for_status()
+            ctx.created_user_ids.append(response.json()["id"])
+        return
+    needed = requests * (BATCH_SIZE if "batch" in scenario.name else 1)
+    while len(ctx.created_task_ids) < needed:
+        response = await client.post("/api/tasks/batch", json={"items": [{"task": "to delete", "done": False, "due": None}] * BATCH_SIZE}, headers=ctx.headers)
+        response.raise_for_status()
+        ctx.created_task_ids.extend(item["id"] for item in response.json()["results"])
+
+
+def print_table(routes: dict) -> None:
+    print(f"{'route':45} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, stats in routes.items():
+        print(f"{name:45} {stats['throughput_rps']:9.1f} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} {stats['errors']:7d}")
+
+
+async def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tasks", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per read route")
+    parser.add_argument("--database", default="./benchmarks/bench.db", help="SQLite file used for the seeded dataset")
+    parser.add_argument("--reseed", action="store_true", help="drop and re-seed the dataset even if it matches")
+    parser.add_argument("--only", action="append", help="run only routes whose name contains this text (repeatable)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against this JSON result file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    parser.add_argument("--metric", default="p95_ms", choices=["p50_ms", "p95_ms", "p99_ms", "mean_ms"])
+    args = parser.parse_args(argv)
+
+    # Must be set before any project imports so database.py creates the SQLite engine
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{args.database}"
+    os.environ.setdefault("SECRET_KEY", "benchmark-only-key-not-used-in-production-abc")
+    # Every request comes from one client; admission control would turn the run into 429s
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+
+    from httpx import ASGITransport, AsyncClient
+
+    from database import engine
+    from main import app
+
+    seed_start = time.perf_counter()
+    await seed(args.users, args.tasks, args.reseed)
+    print(f"dataset ready: {args.users} users, {args.tasks} tasks ({time.perf_counter() - seed_start:.1f}s)")
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://bench") as client:
+        routes = await run_benchmarks(client, args.requests, args.concurrency, args.only, args.warmup)
+    await engine.dispose()
+
+    results = {
+        "meta": {
+            "users": args.users,
+            "tasks": args.tasks,
+            "requests_per_route": args.requests,
+            "concurrency": args.concurrency,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(UTC).isoformat(),
+        },
+        "routes": routes,
+    }
+    print_table(routes)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if args.only:
+            baseline["routes"] = {name: stats for name, stats in baseline["routes"].items() if name in routes}
+        regressions = compare(results, baseline, args.tolerance, args.metric)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for message in regressions:
+                print(f"  {message}")
+            return 1
+        print(f"\nNo regressions against {args.baseline} ({args.metric}, tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,89 @@
+"""Serialization cost of a task listing, per 10k tasks.
+
+Compares the response pipeline before responses.ApiResponse (TaskPage built from ORM objects,
+then validated and encoded by FastAPI's response_model path) with trusted dict payloads encoded
+by orjson and by MessagePack. No database is involved; the tasks are in-memory ORM objects.
+
+    python -m benchmarks.bench_serialization --tasks 10000 --rounds 5
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import UTC, datetime, timedelta
+
+
+def build_tasks(count: int) -> list:
+    from models import Task, User
+
+    authors = [User(id=i, username=f"user{i}", email=f"user{i}@example.com", password_hash="x", image_file=None) for i in range(1, 51)]
+    now = datetime.now(UTC)
+    return [
+        Task(
+            id=i,
+            user_id=authors[i % len(authors)].id,
+            author=authors[i % len(authors)],
+            task=f"Task number {i}",
+            due=now + timedelta(days=i % 30) if i % 3 else None,
+            done=i % 2 == 0,
+            created=now - timedelta(seconds=i),
+        )
+        for i in range(count)
+    ]
+
+
+async def fastapi_path(tasks: list) -> bytes:
+    # What the list endpoints did before: build TaskPage, let FastAPI re-validate it against
+    # response_model, then encode with the standard JSON encoder
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_model_field
+
+    from schemas import TaskPage
+
+    field = create_model_field("Response_api_list_tasks", TaskPage, mode="serialization")
+    page = TaskPage(items=tasks, next_cursor=None)
+    content = await serialize_response(field=field, response_content=page)
+    return JSONResponse(content).body
+
+
+def payloads(tasks: list) -> dict:
+    from fieldsets import TaskFieldset
+
+    return {"items": TaskFieldset().payloads(tasks), "next_cursor": None}
+
+
+async def orjson_path(tasks: list) -> bytes:
+    from responses import JSON_MEDIA_TYPE, encode
+    return encode(payloads(tasks), JSON_MEDIA_TYPE)
+
+
+async def msgpack_path(tasks: list) -> bytes:
+    from responses import MSGPACK_MEDIA_TYPES, encode
+    return encode(payloads(tasks), MSGPACK_MEDIA_TYPES[0])
+
+
+async def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=10_000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+    os.environ.setdefault("SECRET_KEY", "benchmark-only-key-not-used-in-production-abc")
+
+    tasks = build_tasks(args.tasks)
+    scale = 10_000 / args.tasks
+    print(f"{'pipeline':32} {'ms / 10k tasks':>15} {'bytes':>10}")
+    for name, path in (("pydantic + FastAPI JSON (before)", fastapi_path), ("trusted dicts + orjson", orjson_path), ("trusted dicts + msgpack", msgpack_path)):
+        body = await path(tasks)  # warm up
+        timings = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            await path(tasks)
+            timings.append(time.perf_counter() - start)
+        print(f"{name:32} {1000 * min(timings) * scale:15.1f} {len(body):10d}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,224 @@
+import asyncio
+import importlib
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+from config import settings
+
+# In-process caches. Everything here runs on the event loop thread, so no locking is needed
+
+
+class LRUCache:
+    # Bounded LRU with a per-entry TTL; on_evict is called whenever an entry leaves the cache
+    def __init__(self, maxsize: int, ttl: float, on_evict: Callable[[Hashable, Any], None] | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._on_evict = on_evict
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Does not touch recency or the hit/miss counters
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self.expirations += 1
+            self.misses += 1
+            self._remove(key)
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        # Like get(), but leaves recency and the hit/miss counters alone
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        while len(self._entries) > self.maxsize:
+            oldest = next(iter(self._entries))
+            self.evictions += 1
+            self._remove(oldest)
+
+    def delete(self, key: Hashable) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self._remove(key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def reset_stats(self) -> None:
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, value = self._entries.pop(key)
+        if self._on_evict is not None:
+            self._on_evict(key, value)
+
+
+class CacheBackend(ABC):
+    # Storage behind ResponseCache. Values are JSON-compatible dicts, so a shared store
+    # (Redis, memcached, ...) only has to implement these four calls
+    @abstractmethod
+    async def get(self, key: str) -> Any | None: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float) -> None: ...
+
+    @abstractmethod
+    async def delete(self, keys: list[str]) -> None: ...
+
+    @abstractmethod
+    async def clear(self) -> None: ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    # Per-worker LRU with a size cap and TTL
+    def __init__(self, maxsize: int, ttl: float):
+        self._entries = LRUCache(maxsize, ttl)
+
+    async def get(self, key: str) -> Any | None:
+        return self._entries.get(key)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self._entries.set(key, value, ttl)
+
+    async def delete(self, keys: list[str]) -> None:
+        for key in keys:
+            self._entries.delete(key)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+        self._entries.reset_stats()
+
+    def stats(self) -> dict:
+        return self._entries.stats()
+
+
+class NullBackend(CacheBackend):
+    # Caching disabled: every lookup goes to the loader (single-flight still applies)
+    async def get(self, key: str) -> Any | None:
+        return None
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        pass
+
+    async def delete(self, keys: list[str]) -> None:
+        pass
+
+    async def clear(self) -> None:
+        pass
+
+
+class ResponseCache:
+    # Read-through cache with single-flight: concurrent misses on one key share a single load
+    def __init__(self, backend: CacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.coalesced = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        # Keys invalidated while a load was in flight; that load's (possibly stale) result is not stored
+        self._stale: set[str] = set()
+
+    async def get(self, key: str) -> Any | None:
+        return await self.backend.get(key)
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any | None]]) -> Any | None:
+        value = await self.backend.get(key)
+        if value is not None:
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Mark the exception as retrieved so it isn't logged when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            # Misses (None) are not cached, so a newly created row is visible immediately
+            if value is not None and key not in self._stale:
+                await self.backend.set(key, value, self.ttl)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+            self._stale.discard(key)
+
+    async def invalidate(self, *keys: str) -> None:
+        for key in keys:
+            if key in self._inflight:
+                self._stale.add(key)
+        await self.backend.delete(list(keys))
+
+    async def clear(self) -> None:
+        self.coalesced = 0
+        await self.backend.clear()
+
+    def stats(self) -> dict:
+        return {**self.backend.stats(), "coalesced": self.coalesced, "backend": type(self.backend).__name__}
+
+
+def build_cache_backend(name: str, maxsize: int, ttl: float) -> CacheBackend:
+    # "memory", "none", or "package.module:factory" for an external store
+    if name == "memory":
+        return MemoryBackend(maxsize, ttl)
+    if name == "none":
+        return NullBackend()
+    module_name, _, attribute = name.partition(":")
+    factory = getattr(importlib.import_module(module_name), attribute)
+    return factory()
+
+
+# Cache for single-entity GETs (api_get_task / api_get_user), invalidated by every write to those rows
+response_cache = ResponseCache(
+    build_cache_backend(settings.response_cache_backend, settings.response_cache_max_entries, settings.response_cache_ttl_seconds),
+    settings.response_cache_ttl_seconds,
+)
@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+
+from sqlalchemy import tuple_, update
+
+from cache import response_cache
+from config import settings
+from crud import TASK_COLUMNS, UPDATABLE_FIELDS, batch_update_values, count_done_changes_by_owner, task_cache_key, task_payload
+from database import get_sessionmaker
+from events import broker, user_topic
+from models import Task
+
+# Write-behind for PATCH /api/tasks/{id} (opt-in with WRITE_COALESCING). A burst of toggles on
+# the same task becomes one pending entry whose changes are merged, last value wins. Every
+# window the pending entries are flushed as a group commit: the owners' counter UPDATE and one
+# UPDATE ... CASE id ... WHERE (id, user_id) IN (...) RETURNING, in a single transaction, then
+# the cache is invalidated and task.updated is published once per task. Entries are keyed by
+# task id, so a second owner for a pending task can't be merged in; that request, any request
+# setting a NOT NULL column to null, and any request arriving while max_pending tasks are already
+# waiting, takes the direct write path. Direct writes call take() first, so a pending update
+# never lands on top of a write that was made after it
+
+logger = logging.getLogger("taskmanager.coalesce")
+
+# A null here would fail the whole group commit, not just its own request
+NOT_NULL_FIELDS = frozenset(name for name in UPDATABLE_FIELDS if not Task.__table__.c[name].nullable)
+
+
+@dataclass(slots=True)
+class PendingUpdate:
+    owner_id: int
+    author: dict
+    changes: dict = field(default_factory=dict)
+    # One future per request merged into this entry; each resolves to the flushed row, or None
+    # when the task no longer matched (deleted, or not the owner's)
+    waiters: list[asyncio.Future] = field(default_factory=list)
+
+
+class WriteCoalescer:
+    def __init__(self, window_seconds: float, max_pending: int):
+        self.window = window_seconds
+        self.max_pending = max_pending
+        self._pending: dict[int, PendingUpdate] = {}
+        self._timer: asyncio.Task | None = None
+        # Group commits run one at a time, so a later flush never overtakes an earlier one
+        self._flushing = asyncio.Lock()
+        # Task ids taken from _pending whose flush hasn't finished (a task can be in two batches)
+        self._in_flight: Counter[int] = Counter()
+        self.submitted = 0
+        self.merged = 0
+        self.flushes = 0
+        self.rows = 0
+        self.overflows = 0
+        self.failures = 0
+
+    def offer(self, task_id: int, owner_id: int, changes: dict, author: dict) -> asyncio.Future | None:
+        # Queues changes for the next flush and returns a future for the flushed row; None when
+        # the caller must write directly instead
+        if any(changes.get(name, True) is None for name in NOT_NULL_FIELDS):
+            return None
+        entry = self._pending.get(task_id)
+        if entry is None:
+            if len(self._pending) >= self.max_pending:
+                self.overflows += 1
+                return None
+            entry = self._pending[task_id] = PendingUpdate(owner_id, author)
+        elif entry.owner_id != owner_id:
+            return None
+        else:
+            self.merged += 1
+        self.submitted += 1
+        entry.changes.update(changes)
+        entry.author = author
+        future = asyncio.get_running_loop().create_future()
+        entry.waiters.append(future)
+        if self._timer is None:
+            # A fresh context keeps the flush out of the request's statement count and Server-Timing
+            self._timer = asyncio.create_task(self._flush_later(), context=contextvars.Context())
+        return future
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        batch, self._pending = self._pending, {}
+        if batch:
+            await self._flush(batch)
+
+    async def take(self, task_ids) -> None:
+        # Called before a direct write to these tasks: their pending updates are committed now,
+        # and a flush already under way is waited for, so the direct write comes last
+        batch = {task_id: self._pending.pop(task_id) for task_id in task_ids if task_id in self._pending}
+        if batch or any(self._in_flight[task_id] for task_id in task_ids):
+            # Like the timer's flush, out of the request's context; a separate task also means a
+            # cancelled request doesn't abandon the entries it took
+            await asyncio.create_task(self._flush(batch), context=contextvars.Context())
+
+    async def _flush(self, batch: dict[int, PendingUpdate]) -> None:
+        self._in_flight.update(batch.keys())
+        try:
+            async with self._flushing:
+                if not batch:
+                    return
+                rows, errors = await self._commit_isolated(batch)
+                if rows:
+                    self.flushes += 1
+                    self.rows += len(rows)
+                    await response_cache.invalidate(*(task_cache_key(task_id) for task_id in rows))
+                for task_id, entry in batch.items():
+                    row = rows.get(task_id)
+                    if row is not None:
+                        await broker.publish(user_topic(entry.owner_id), [("task.updated", task_payload(row, entry.author))])
+                    for waiter in entry.waiters:
+                        # A waiter whose request was cancelled is already done
+                        if waiter.done():
+                            continue
+                        if task_id in errors:
+                            waiter.set_exception(errors[task_id])
+                            # Nobody awaits the future of a non-durable write; mark it retrieved
+                            waiter.exception()
+                        else:
+                            waiter.set_result(row)
+        finally:
+            self._in_flight -= Counter(batch.keys())
+
+    async def _commit_isolated(self, batch: dict[int, PendingUpdate]) -> tuple[dict, dict[int, Exception]]:
+        # Returns the flushed rows and the error of each entry that could not be written
+        try:
+            return await self._commit(batch), {}
+        except Exception as exc:
+            if len(batch) == 1:
+                self.failures += 1
+                logger.exception("coalesced update of task %d failed", next(iter(batch)))
+                return {}, {task_id: exc for task_id in batch}
+        # One bad entry fails the whole statement; write them one at a time so only it fails
+        rows, errors = {}, {}
+        for task_id, entry in batch.items():
+            try:
+                rows.update(await self._commit({task_id: entry}))
+            except Exception as exc:
+                self.failures += 1
+                logger.exception("coalesced update of task %d failed", task_id)
+                errors[task_id] = exc
+        return rows, errors
+
+    async def _commit(self, batch: dict[int, PendingUpdate]) -> dict:
+        task_keys = [(task_id, entry.owner_id) for task_id, entry in batch.items()]
+        values = batch_update_values({task_id: entry.changes for task_id, entry in batch.items()})
+        async with get_sessionmaker()() as db:
+            done_keys = [(task_id, entry.owner_id) for task_id, entry in batch.items() if "done" in entry.changes]
+            if done_keys:
+                await count_done_changes_by_owner(db, done_keys, values["done"])
+            stmt = (
+                update(Task)
+                .where(tuple_(Task.id, Task.user_id).in_(task_keys))
+                .values(**values)
+                .returning(*TASK_COLUMNS)
+                .execution_options(synchronize_session=False)
+            )
+            result = await db.execute(stmt)
+            rows = {row.id: row for row in result.all()}
+            await db.commit()
+        return rows
+
+    async def drain(self) -> None:
+        # Called on shutdown: flush what is pending now instead of waiting for the timer
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.write_coalescing,
+            "pending": len(self._pending),
+            "submitted": self.submitted,
+            "merged": self.merged,
+            "flushes": self.flushes,
+            "rows": self.rows,
+            "overflows": self.overflows,
+            "failures": self.failures,
+        }
+
+
+coalescer = WriteCoalescer(settings.write_coalesce_window_ms / 1000, settings.write_coalesce_max_pending)
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -10,7 +12,103 @@ class Settings(BaseSettings):
     )
 
     secret_key: SecretStr
+    # API-only workers skip the HTML home page, templates and static files entirely
+    api_only: bool = False
     algorithm: str = "HS256"
+    # /api/ops/* exposes pools, caches and limiter internals: without a token the routes are
+    # disabled (404); with one, requests must send it in X-Ops-Token
+    ops_token: SecretStr | None = None
     access_token_expire_minutes: int = 30
+    # Refresh tokens rotate on every use; each one stays valid this long if unused
+    refresh_token_expire_days: int = 30
+
+    # Connection pool (per worker). Defaults match SQLAlchemy's own
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = -1
+    db_pool_pre_ping: bool = False
+    # Read replicas for GET listings (comma-separated URLs). A replica that fails to connect is skipped
+    # for db_replica_eject_seconds; a user who wrote reads from the primary for read_your_writes_seconds
+    # (at most read_pin_cache_size users are pinned at once per worker)
+    db_replica_urls: str = ""
+    db_replica_eject_seconds: float = 30
+    read_your_writes_seconds: float = 5
+    read_pin_cache_size: int = 10_000
+    # asyncpg prepared statement cache; PgBouncer mode (transaction pooling) turns server-side statements off
+    db_statement_cache_size: int = 100
+    db_pgbouncer_mode: bool = False
+
+    # Argon2 cost parameters (pwdlib/argon2-cffi defaults)
+    argon2_time_cost: int = 3
+    argon2_memory_cost: int = 65536
+    argon2_parallelism: int = 4
+
+    # Password hashing runs in a bounded worker pool so it never blocks the event loop
+    password_hash_executor: Literal["thread", "process"] = "thread"
+    password_hash_workers: int = 2
+    password_hash_max_pending: int = 32
+    password_hash_retry_after_seconds: int = 1
+
+    # Verified bearer tokens are cached per worker; entries never outlive the token itself
+    token_cache_size: int = 10_000
+    token_cache_ttl_seconds: int = 60
+
+    # Read-through cache for single task/user GETs: "memory", "none" or "package.module:factory"
+    response_cache_backend: str = "memory"
+    response_cache_max_entries: int = 10_000
+    response_cache_ttl_seconds: int = 30
+
+    # Task listings are paginated; clients can ask for up to max_page_size rows per page
+    default_page_size: int = 50
+    max_page_size: int = 200
+
+    # Upper bound on items per /api/tasks/batch request
+    batch_max_items: int = 100
+
+    # Rows fetched from the server-side cursor per streamed export chunk
+    export_chunk_size: int = 1000
+
+    # Admission control (see ratelimit.py): token buckets "requests/seconds" per client and route class.
+    # "login" covers sign-up and login (Argon2); backend is "memory" or "package.module:factory".
+    # Anonymous clients are keyed by IP: behind a proxy, start uvicorn with --proxy-headers and
+    # --forwarded-allow-ips set to the proxy's addresses (render.yaml does), or every anonymous
+    # client shares the proxy's bucket and rate_limit_login becomes a global cap on logins
+    rate_limit_enabled: bool = True
+    rate_limit_backend: str = "memory"
+    rate_limit_max_clients: int = 100_000
+    rate_limit_login: str = "10/60"
+    rate_limit_write: str = "120/60"
+    rate_limit_read: str = "600/60"
+
+    # Write coalescing for PATCH /api/tasks/{id} (see coalesce.py), off by default. Updates to the same
+    # task within the window collapse to the last value and are flushed as one batched UPDATE; with
+    # durable off the request gets 202 before the flush. At most max_pending tasks wait per worker
+    write_coalescing: bool = False
+    write_coalesce_window_ms: float = 20
+    write_coalesce_durable: bool = True
+    write_coalesce_max_pending: int = 1000
+
+    # Idempotency-Key on task creation: how long a stored response can be replayed, and how often
+    # each worker sweeps expired keys
+    idempotency_key_ttl_hours: float = 24
+    idempotency_sweep_interval_seconds: float = 3600
+
+    # Delta sync (GET /api/tasks/changes): rows written in the last sync_settle_seconds are sent again on
+    # the next sync, to cover transactions that commit late; tombstones older than the retention are compacted
+    sync_settle_seconds: float = 5
+    tombstone_retention_days: int = 30
+
+    # Task change feed (GET /api/tasks/stream): "memory" or "package.module:factory" for multi-worker
+    # fan-out, events buffered per connection before a slow client is told to resync, keepalive interval
+    event_backend: str = "memory"
+    event_queue_size: int = 100
+    event_keepalive_seconds: float = 15
+
+    # Per-request instrumentation: Server-Timing header, and a statement budget per request.
+    # Over budget is logged; in strict mode (tests) the statement that exceeds it raises instead
+    server_timing: bool = True
+    query_budget: int = 20
+    query_budget_strict: bool = False
 
 settings = Settings() # Loaded from .env
\ No newline at end of file
@@ -0,0 +1,231 @@
+from datetime import UTC, datetime
+
+from fastapi import HTTPException, status
+from sqlalchemy import DateTime, case, delete, false, func, insert, literal, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Task, TaskTombstone, User, profile_image_path
+
+# Shared SQL helpers for task writes and cached reads. They work on plain columns instead of
+# ORM instances so a whole batch is one statement and nothing has to be refreshed afterwards
+
+# Columns a TaskResponse (and its ETag) needs from tasklist; the author block comes from the caller
+TASK_COLUMNS = (Task.id, Task.user_id, Task.task, Task.due, Task.done, Task.created, Task.version)
+
+UPDATABLE_FIELDS = ("task", "due", "done")
+
+
+# Response payloads (see responses.ApiResponse): plain dicts in the shape of the schemas,
+# built straight from trusted rows instead of being validated through the pydantic models
+
+def user_public_payload(user) -> dict:
+    # user is anything with UserPublic's attributes (a User, the Principal, a row)
+    return {"id": user.id, "username": user.username, "image_file": user.image_file, "image_path": profile_image_path(user.image_file)}
+
+
+def user_private_payload(user) -> dict:
+    return {**user_public_payload(user), "email": user.email}
+
+
+def task_payload(row, author: dict) -> dict:
+    # row is anything with the TASK_COLUMNS attributes (a RETURNING row or a Task); author is a user payload
+    return {
+        "id": row.id,
+        "user_id": row.user_id,
+        "task": row.task,
+        "due": row.due,
+        "done": row.done,
+        "created": row.created,
+        "author": author,
+    }
+
+
+def batch_update_values(changes_by_id: dict[int, dict]) -> dict:
+    # One CASE per column turns N different partial updates into a single UPDATE statement:
+    # SET done = CASE id WHEN 1 THEN true WHEN 7 THEN false ELSE done END, ...
+    values = {}
+    for field in UPDATABLE_FIELDS:
+        whens = {task_id: changes[field] for task_id, changes in changes_by_id.items() if field in changes}
+        if whens:
+            column = getattr(Task, field)
+            values[field] = case(whens, value=Task.id, else_=column)
+    if values:
+        values["version"] = Task.version + 1
+    return values
+
+
+async def classify_misses(db: AsyncSession, missing_ids: list[int]) -> dict[int, int]:
+    # Only runs when a conditional write touched fewer rows than asked for:
+    # tells "does not exist" (404) apart from "belongs to someone else" (403)
+    if not missing_ids:
+        return {}
+    result = await db.execute(select(Task.id).where(Task.id.in_(missing_ids)))
+    existing = set(result.scalars().all())
+    return {task_id: 403 if task_id in existing else 404 for task_id in missing_ids}
+
+
+def owned_task_criteria(task_id: int, owner_id: int, versions: list[int] | None = None) -> tuple:
+    # versions comes from If-Match: None means unconditional, [] means nothing can match
+    criteria = (Task.id == task_id, Task.user_id == owner_id)
+    if versions is None:
+        return criteria
+    return (*criteria, Task.version.in_(versions) if versions else false())
+
+
+async def update_owned_task(db: AsyncSession, task_id: int, owner_id: int, values: dict, versions: list[int] | None = None):
+    # UPDATE tasklist SET ... WHERE id = :id AND user_id = :me RETURNING ... — the ownership
+    # check, the If-Match check and the write are one round trip. Returns None when nothing matched
+    owned = owned_task_criteria(task_id, owner_id, versions)
+    if values:
+        values = {**values, "version": Task.version + 1}
+        stmt = update(Task).where(*owned).values(**values).returning(*TASK_COLUMNS).execution_options(synchronize_session=False)
+    else:
+        # An empty PATCH changes nothing, but the caller still gets the task (or its 403/404)
+        stmt = select(*TASK_COLUMNS).where(*owned)
+    result = await db.execute(stmt)
+    return result.first()
+
+
+async def raise_for_miss(db: AsyncSession, task_id: int, owner_id: int):
+    # A conditional write on an owned, existing task can only miss on its If-Match version
+    result = await db.execute(select(Task.user_id).where(Task.id == task_id))
+    task_owner = result.scalar()
+    if task_owner is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
+    if task_owner != owner_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
+    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Task was modified by another request")
+
+
+# ------------------------------------------------------------
+# Tombstones for delta sync (see sync.py), written in the same transaction as the delete
+# ------------------------------------------------------------
+async def record_deleted_tasks(db: AsyncSession, owner_id: int, task_ids: list[int]):
+    if task_ids:
+        await db.execute(insert(TaskTombstone), [{"task_id": task_id, "user_id": owner_id} for task_id in task_ids])
+
+
+async def delete_user_tasks(db: AsyncSession, user_id: int) -> list[int]:
+    # INSERT ... SELECT writes every tombstone in one statement, then one DELETE removes the tasks.
+    # Callers lock the users row first, so no task can be added for this user in between
+    deleted_at = literal(datetime.now(UTC), DateTime(timezone=True))
+    tombstones = (
+        insert(TaskTombstone)
+        .from_select(["task_id", "user_id", "deleted_at"], select(Task.id, Task.user_id, deleted_at).where(Task.user_id == user_id))
+        .returning(TaskTombstone.task_id)
+    )
+    task_ids = list((await db.execute(tombstones)).scalars().all())
+    await db.execute(delete(Task).where(Task.user_id == user_id).execution_options(synchronize_session=False))
+    return task_ids
+
+
+# ------------------------------------------------------------
+# Task counters on users (task_count, done_count)
+# ------------------------------------------------------------
+# Each task write first adjusts the owner's counters and then touches tasklist, in the same
+# transaction. Locking the users row first in every write path keeps the lock order the same
+# everywhere, and makes concurrent writes by one owner queue up instead of double counting.
+# When the task statement then misses, the caller raises and the whole transaction rolls back
+
+async def count_created_tasks(db: AsyncSession, owner_id: int, done_flags: list[bool]):
+    await db.execute(
+        update(User)
+        .where(User.id == owner_id)
+        .values(task_count=User.task_count + len(done_flags), done_count=User.done_count + sum(done_flags))
+    )
+
+
+async def count_done_changes(db: AsyncSession, owner_id: int, criteria: tuple, new_done):
+    # new_done is a bool, or a CASE id WHEN ... expression for batches; only rows whose done flag
+    # actually flips move the counter: false -> true is +1, true -> false is -1
+    flipped = (
+        select(func.coalesce(func.sum(case((Task.done, -1), else_=1)), 0))
+        .where(*criteria, Task.done != new_done)
+        .scalar_subquery()
+    )
+    await db.execute(update(User).where(User.id == owner_id).values(done_count=User.done_count + flipped))
+
+
+async def count_done_changes_by_owner(db: AsyncSession, task_keys: list[tuple[int, int]], new_done):
+    # count_done_changes for tasks of several owners at once: task_keys are (task id, owner id)
+    # pairs and the flipped count is correlated to each users row, so it stays one UPDATE
+    flipped = (
+        select(func.coalesce(func.sum(case((Task.done, -1), else_=1)), 0))
+        .where(tuple_(Task.id, Task.user_id).in_(task_keys), Task.user_id == User.id, Task.done != new_done)
+        .scalar_subquery()
+    )
+    owner_ids = sorted({owner_id for _, owner_id in task_keys})
+    await db.execute(update(User).where(User.id.in_(owner_ids)).values(done_count=User.done_count + flipped))
+
+
+async def count_deleted_tasks(db: AsyncSession, owner_id: int, criteria: tuple):
+    # criteria are the same WHERE clauses the DELETE that follows will use
+    removed = select(func.count()).select_from(Task).where(*criteria).scalar_subquery()
+    removed_done = select(func.count()).select_from(Task).where(*criteria, Task.done.is_(True)).scalar_subquery()
+    await db.execute(
+        update(User)
+        .where(User.id == owner_id)
+        .values(task_count=User.task_count - removed, done_count=User.done_count - removed_done)
+    )
+
+
+async def rebuild_task_counters(db: AsyncSession) -> int:
+    # Recomputes every user's counters from tasklist; returns how many users had drifted
+    total = select(func.count()).select_from(Task).where(Task.user_id == User.id).scalar_subquery()
+    done = select(func.count()).select_from(Task).where(Task.user_id == User.id, Task.done.is_(True)).scalar_subquery()
+    result = await db.execute(
+        update(User)
+        .where((User.task_count != total) | (User.done_count != done))
+        .values(task_count=total, done_count=done)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+# ------------------------------------------------------------
+# Response cache entries (JSON-compatible, see cache.ResponseCache)
+# ------------------------------------------------------------
+# Task entries hold user_id, not the author: the author block is looked up from its own
+# entry, so renaming a user invalidates one key instead of every task they own
+
+def task_cache_key(task_id: int) -> str:
+    return f"task:{task_id}"
+
+
+def user_cache_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def _isoformat(value):
+    # Same form as the encoded responses ("Z" for UTC), so cached and fresh bodies match
+    return value.isoformat().replace("+00:00", "Z") if value is not None else None
+
+
+async def load_task_entry(db: AsyncSession, task_id: int) -> dict | None:
+    result = await db.execute(select(*TASK_COLUMNS).where(Task.id == task_id))
+    row = result.first()
+    if row is None:
+        return None
+    return {
+        "id": row.id,
+        "user_id": row.user_id,
+        "task": row.task,
+        "due": _isoformat(row.due),
+        "done": row.done,
+        "created": _isoformat(row.created),
+        "version": row.version,
+    }
+
+
+async def load_user_entry(db: AsyncSession, user_id: int) -> dict | None:
+    result = await db.execute(select(User.id, User.username, User.image_file, User.version).where(User.id == user_id))
+    row = result.first()
+    if row is None:
+        return None
+    return {
+        "id": row.id,
+        "username": row.username,
+        "image_file": row.image_file,
+        "image_path": profile_image_path(row.image_file),
+        "version": row.version,
+    }
@@ -1,18 +1,33 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from collections import OrderedDict, deque
+import time
+from uuid import uuid4
+
+from fastapi import Request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 import os
 
-load_dotenv()
+from config import settings
+from timing import current_timings
+
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+def async_url(url: str) -> str:
+    if not url.startswith("postgresql+asyncpg://"):
+        url = url.replace("postgresql://", "postgresql+asyncpg://")
+    return url
 
-if DATABASE_URL:
-    if not DATABASE_URL.startswith("postgresql+asyncpg://"):
-        DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
-else:
-    DATABASE_URL = (
+
+def database_url() -> str:
+    load_dotenv()
+    url = os.getenv("DATABASE_URL")
+    if url:
+        return async_url(url)
+    return (
         # f"postgresql://{os.getenv('DB_USER')}:"
         f"postgresql+asyncpg://{os.getenv('DB_USER')}:" #Async DB URL
         f"{os.getenv('DB_PASSWORD')}@"
@@ -21,12 +36,248 @@ else:
         f"{os.getenv('DB_NAME')}"
     )
 
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # Same pool SQLAlchemy uses for async engines, plus a record of how long each checkout waited.
+    # _do_get is where QueuePool blocks when every connection is checked out
+    wait_samples: int = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: deque[float] = deque(maxlen=self.wait_samples)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.acquisitions += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.recent_waits.append(waited)
+
+    def wait_stats(self) -> dict:
+        recent = sorted(self.recent_waits)
+        return {
+            "acquisitions": self.acquisitions,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": 1000 * self.total_wait / self.acquisitions if self.acquisitions else 0.0,
+            "wait_p95_ms": 1000 * recent[int(0.95 * (len(recent) - 1))] if recent else 0.0,
+            "wait_max_ms": 1000 * self.max_wait,
+        }
+
+
+def is_memory_sqlite(url: str) -> bool:
+    # Same test SQLAlchemy uses to pick StaticPool: no file, ":memory:", or a mode=memory URI
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and (parsed.database in (None, "", ":memory:") or parsed.query.get("mode") == "memory")
+
+
+def engine_options(url: str) -> dict:
+    options = {
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+    if not is_memory_sqlite(url):
+        # An in-memory database lives in its one connection, so it keeps the dialect's default
+        # single-connection pool; a queue pool would give every connection its own empty database
+        options.update(
+            poolclass=InstrumentedPool,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+        )
+    if url.startswith("postgresql+asyncpg://"):
+        if settings.db_pgbouncer_mode:
+            # PgBouncer in transaction mode can hand each statement a different server connection,
+            # so named server-side prepared statements must be disabled or made unique
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+            }
+        else:
+            options["connect_args"] = {"prepared_statement_cache_size": settings.db_statement_cache_size}
+    return options
+
+
 # Create database connection and session
-# engine = create_engine(db_url, echo=True)
-# engine = create_engine(db_url)
-engine = create_async_engine(DATABASE_URL)
-# SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# The engine is built on first use rather than at import, so importing the app (workers, manage.py,
+# tests) doesn't load the database driver or read the environment until a connection is needed
+_engine: AsyncEngine | None = None
+_sessionmaker: async_sessionmaker[AsyncSession] | None = None
+
+
+def _create_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, **engine_options(url))
+    event.listen(engine.sync_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", _stop_query_timer)
+    if url.startswith("sqlite"):
+        # SQLite leaves foreign keys unenforced unless asked per connection; with this, ON DELETE
+        # CASCADE behaves as it does on Postgres
+        event.listen(engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+    return engine
+
+
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def get_engine() -> AsyncEngine:
+    global _engine, _sessionmaker
+    if _engine is None:
+        _engine = _create_engine(database_url())
+        _sessionmaker = async_sessionmaker(_engine, class_=AsyncSession, expire_on_commit=False)
+    return _engine
+
+
+def get_sessionmaker() -> async_sessionmaker[AsyncSession]:
+    get_engine()
+    return _sessionmaker
+
+
+def __getattr__(name: str):
+    # Keeps "from database import engine, AsyncSessionLocal" working; both are created on first access
+    if name == "engine":
+        return get_engine()
+    if name == "AsyncSessionLocal":
+        return get_sessionmaker()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Statement count and DB time of the current request (see timing.py). The hooks run on the
+# sync side of the async engine, in the context of the request that issued the statement
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.record_query(statement)
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings.get()
+    starts = conn.info.get("query_start")
+    if timings is not None and starts:
+        timings.db_time += time.perf_counter() - starts.pop()
+
+
+def _pool_stats(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    if not isinstance(pool, InstrumentedPool):
+        # In-memory SQLite: one shared connection, nothing to saturate
+        return {"pool": type(pool).__name__}
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.db_max_overflow,
+        **pool.wait_stats(),
+    }
+
+
+def pool_stats() -> dict:
+    # Snapshot of the connection pools for this worker: the primary, plus each replica if any
+    stats = _pool_stats(get_engine())
+    replicas = get_replicas()
+    if replicas is not None:
+        stats["replicas"] = replicas.stats()
+    return stats
+
+
+# ------------------------------------------------------------
+# Read replicas (DB_REPLICA_URLS)
+# ------------------------------------------------------------
+class ReplicaSet:
+    # Round-robin over the replica engines. A replica that fails to hand out a connection is
+    # ejected for eject_seconds; while every replica is ejected, reads go to the primary
+    def __init__(self, engines: list[AsyncEngine], eject_seconds: float):
+        self.engines = engines
+        self.sessionmakers = [async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False) for engine in engines]
+        self.eject_seconds = eject_seconds
+        self._next = 0
+        self._ejected_until = [0.0] * len(engines)
+        self.ejections = 0
+
+    def candidates(self) -> list[int]:
+        # Healthy replicas in the order to try them; each call starts one further along
+        now = time.monotonic()
+        count = len(self.engines)
+        start, self._next = self._next, (self._next + 1) % count
+        return [index for index in ((start + offset) % count for offset in range(count)) if self._ejected_until[index] <= now]
+
+    def eject(self, index: int) -> None:
+        self._ejected_until[index] = time.monotonic() + self.eject_seconds
+        self.ejections += 1
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        return [
+            {
+                # Position in DB_REPLICA_URLS; the URLs themselves stay out of the ops endpoints
+                "replica": index,
+                "ejected": self._ejected_until[index] > now,
+                **_pool_stats(engine),
+            }
+            for index, engine in enumerate(self.engines)
+        ]
+
+
+class ReadPins:
+    # Read-your-writes: a user who just wrote reads from the primary for window seconds, so
+    # replica lag never hides their own change. Keyed by user id, so a token refreshed right after
+    # the write keeps the pin; per worker. Deadlines are appended in time order, so expired pins
+    # are always at the front
+    def __init__(self, window: float, maxsize: int):
+        self.window = window
+        self.maxsize = maxsize
+        self._until: OrderedDict[int, float] = OrderedDict()
+
+    def pin(self, key: int | None) -> None:
+        if key is None or self.window <= 0:
+            return
+        now = time.monotonic()
+        self._until.pop(key, None)
+        self._until[key] = now + self.window
+        while self._until and (len(self._until) > self.maxsize or next(iter(self._until.values())) <= now):
+            self._until.popitem(last=False)
+
+    def is_pinned(self, key: int | None) -> bool:
+        deadline = self._until.get(key) if key is not None else None
+        return deadline is not None and deadline > time.monotonic()
+
+    def clear(self) -> None:
+        self._until.clear()
+
+
+_replicas: ReplicaSet | None = None
+read_pins = ReadPins(settings.read_your_writes_seconds, settings.read_pin_cache_size)
+
+
+def get_replicas() -> ReplicaSet | None:
+    global _replicas
+    if _replicas is None and settings.db_replica_urls:
+        urls = [async_url(url.strip()) for url in settings.db_replica_urls.split(",") if url.strip()]
+        _replicas = ReplicaSet([_create_engine(url) for url in urls], settings.db_replica_eject_seconds)
+    return _replicas
+
+
+async def dispose_engines() -> None:
+    get_engine()
+    await _engine.dispose()
+    if _replicas is not None:
+        for engine in _replicas.engines:
+            await engine.dispose()
 
 # Base = declarative_base() This is the "old" way of doing things. Instead we do
 
@@ -34,9 +285,32 @@ class Base(DeclarativeBase):
     pass
 
 async def get_db():
-    async with AsyncSessionLocal() as session:
+    async with get_sessionmaker()() as session:
         yield session   
 
+# Session dependency for read-only endpoints: a healthy replica when DB_REPLICA_URLS is set,
+# otherwise (or when the client is pinned by a recent write) the primary. The connection is
+# taken up front so a dead replica is ejected and the next one tried before the handler runs
+async def get_read_db(request: Request):
+    # auth imports this module, so its helper is imported here rather than at the top
+    from auth import request_user_id
+
+    replicas = get_replicas()
+    if replicas is not None and not read_pins.is_pinned(request_user_id(request)):
+        for index in replicas.candidates():
+            session = replicas.sessionmakers[index]()
+            try:
+                await session.connection()
+            except (DBAPIError, OSError):
+                await session.close()
+                replicas.eject(index)
+                continue
+            async with session:
+                yield session
+            return
+    async with get_sessionmaker()() as session:
+        yield session
+
 #Database session dependency function
 # def get_db():
 #     with SessionLocal() as db:
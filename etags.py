@@ -0,0 +1,48 @@
+from fastapi import HTTPException, status
+
+# ETags are built from row version counters, so checking one only needs the version
+# column(s) — never the full row or its relationships
+
+
+def make_etag(*versions: int) -> str:
+    return '"' + ".".join(str(version) for version in versions) + '"'
+
+
+def parse_etags(header: str, weak: bool = True) -> list[str] | None:
+    # Returns None for "*" (matches any current representation)
+    if header.strip() == "*":
+        return None
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            # If-None-Match uses weak comparison; If-Match only accepts strong tags
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    tags = parse_etags(header)
+    return tags is None or etag in tags
+
+
+def versions_from_if_match(header: str) -> list[tuple[int, ...]] | None:
+    # '"3.1", "4.1"' -> [(3, 1), (4, 1)]; None means "*"
+    tags = parse_etags(header, weak=False)
+    if tags is None:
+        return None
+    versions = []
+    for tag in tags:
+        try:
+            versions.append(tuple(int(part) for part in tag.strip('"').split(".")))
+        except ValueError:
+            continue
+    return versions
+
+
+def precondition_failed(detail: str):
+    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail=detail)
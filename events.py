@@ -0,0 +1,140 @@
+import asyncio
+import importlib
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Callable, Iterable
+from contextlib import contextmanager
+from typing import Any
+
+import orjson
+
+from config import settings
+from responses import ORJSON_OPTIONS
+
+# Task change feed behind GET /api/tasks/stream. The mutating endpoints publish to the owner's
+# topic after they commit; each stream connection holds a Subscription with a bounded queue.
+# Messages are rendered to Server-Sent Events frames once, at publish time, so fan-out only
+# copies bytes and a cross-worker backend only has to carry bytes
+
+
+def user_topic(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def sse_frame(event: str, data: Any) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data, option=ORJSON_OPTIONS) + b"\n\n"
+
+
+# Comment lines are ignored by EventSource; they keep idle connections open through proxies
+KEEPALIVE = b": keepalive\n\n"
+# Sent instead of the events a slow consumer missed; the client should refetch its task list
+RESYNC = sse_frame("resync", {"reason": "Too many events queued for this connection"})
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(maxsize)
+
+    def offer(self, message: bytes) -> bool:
+        # Publishers never wait on a slow consumer. When its queue is full the backlog is
+        # dropped and replaced by a single resync, so memory per connection stays bounded
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            return False
+
+
+class EventBackend(ABC):
+    # Carries messages between workers. publish() sends a message to every worker (this one
+    # included), and each worker hands what it receives to deliver, the broker's local fan-out.
+    # A Redis or Postgres LISTEN/NOTIFY backend subscribes in start() and unsubscribes in stop()
+    deliver: Callable[[str, bytes], None]
+    # True when publish() can only reach this worker, so topics without local subscribers can be skipped
+    in_process = False
+
+    @abstractmethod
+    async def publish(self, topic: str, message: bytes) -> None: ...
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class LocalBackend(EventBackend):
+    # Single worker: publishing is delivering
+    in_process = True
+
+    async def publish(self, topic: str, message: bytes) -> None:
+        self.deliver(topic, message)
+
+
+class EventBroker:
+    def __init__(self, backend: EventBackend, queue_size: int):
+        self.backend = backend
+        self.backend.deliver = self.deliver
+        self.queue_size = queue_size
+        self._topics: dict[str, set[Subscription]] = {}
+        self.published = 0
+        self.resyncs = 0
+
+    @contextmanager
+    def subscribe(self, topic: str):
+        subscription = Subscription(self.queue_size)
+        self._topics.setdefault(topic, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            subscribers = self._topics[topic]
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[topic]
+
+    async def publish(self, topic: str, events: Iterable[tuple[str, Any]]) -> None:
+        # events are (name, data) pairs; nothing is encoded when nobody can be listening
+        if self.backend.in_process and topic not in self._topics:
+            return
+        for event, data in events:
+            self.published += 1
+            await self.backend.publish(topic, sse_frame(event, data))
+
+    def deliver(self, topic: str, message: bytes) -> None:
+        for subscription in self._topics.get(topic, ()):
+            if not subscription.offer(message):
+                self.resyncs += 1
+
+    async def stream(self, topic: str, keepalive: float) -> AsyncIterator[bytes]:
+        # Body of one SSE response. The subscription is registered before "ready" is sent and
+        # removed when the client disconnects (Starlette cancels the iteration)
+        with self.subscribe(topic) as subscription:
+            yield sse_frame("ready", {})
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscription.queue.get(), keepalive)
+                except TimeoutError:
+                    yield KEEPALIVE
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "topics": len(self._topics),
+            "subscribers": sum(len(subscribers) for subscribers in self._topics.values()),
+            "published": self.published,
+            "resyncs": self.resyncs,
+        }
+
+
+def build_event_backend(name: str) -> EventBackend:
+    # "memory", or "package.module:factory" for a backend shared by several workers
+    if name == "memory":
+        return LocalBackend()
+    module_name, _, attribute = name.partition(":")
+    factory = getattr(importlib.import_module(module_name), attribute)
+    return factory()
+
+
+broker = EventBroker(build_event_backend(settings.event_backend), settings.event_queue_size)
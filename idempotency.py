@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import logging
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime, timedelta
+from typing import Annotated
+
+import orjson
+from fastapi import Header, HTTPException, status
+from pydantic import BaseModel
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from models import IdempotencyRecord
+from responses import ORJSON_OPTIONS, ApiResponse
+
+# Idempotency-Key support for the create endpoints. The first request with a key stores its
+# response in idempotency_keys, in the same transaction as the rows it created; a retry with
+# the same key gets that response back without touching tasklist. Duplicates arriving at the
+# same time are serialized per worker by a lock, and across workers by the (user_id, key)
+# primary key: the loser's transaction rolls back and it replays the winner's response
+
+logger = logging.getLogger("taskmanager.idempotency")
+
+IdempotencyKey = Annotated[str | None, Header(alias="Idempotency-Key", min_length=1, max_length=255)]
+
+_locks: dict[tuple[int, str], tuple[asyncio.Lock, int]] = {}
+
+
+@asynccontextmanager
+async def _key_lock(user_id: int, key: str):
+    # One lock per key in use, dropped when its last holder leaves
+    lock, holders = _locks.get((user_id, key), (asyncio.Lock(), 0))
+    _locks[(user_id, key)] = (lock, holders + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, holders = _locks[(user_id, key)]
+        if holders == 1:
+            del _locks[(user_id, key)]
+        else:
+            _locks[(user_id, key)] = (lock, holders - 1)
+
+
+def request_fingerprint(route: str, body: BaseModel) -> str:
+    payload = orjson.dumps(body.model_dump(mode="json"), option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(route.encode() + b"\n" + payload).hexdigest()
+
+
+def _expiry_cutoff() -> datetime:
+    return datetime.now(UTC) - timedelta(hours=settings.idempotency_key_ttl_hours)
+
+
+# A stored key past its TTL but not swept yet: the key is free again, and the new response
+# overwrites the old record instead of being inserted next to it
+_EXPIRED = object()
+
+
+async def _stored_response(db: AsyncSession, user_id: int, key: str, fingerprint: str) -> ApiResponse | object | None:
+    result = await db.execute(select(IdempotencyRecord).where(IdempotencyRecord.user_id == user_id, IdempotencyRecord.key == key))
+    record = result.scalars().first()
+    if record is None:
+        return None
+    created_at = record.created_at if record.created_at.tzinfo else record.created_at.replace(tzinfo=UTC)
+    if created_at < _expiry_cutoff():
+        return _EXPIRED
+    if record.fingerprint != fingerprint:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail="Idempotency-Key was already used for a different request")
+    return ApiResponse(orjson.loads(record.response), status_code=record.status_code, headers={"Idempotent-Replayed": "true"})
+
+
+async def _store(db: AsyncSession, user_id: int, key: str, fingerprint: str, response: ApiResponse, expired: bool) -> bool:
+    # Returns False when another request claimed the key first
+    values = {
+        "fingerprint": fingerprint,
+        "status_code": response.status_code,
+        "response": orjson.dumps(response.content, option=ORJSON_OPTIONS).decode(),
+        "created_at": datetime.now(UTC),
+    }
+    if expired:
+        result = await db.execute(
+            update(IdempotencyRecord)
+            .where(IdempotencyRecord.user_id == user_id, IdempotencyRecord.key == key, IdempotencyRecord.created_at < _expiry_cutoff())
+            .values(**values)
+        )
+        return result.rowcount == 1
+    try:
+        await db.execute(insert(IdempotencyRecord).values(user_id=user_id, key=key, **values))
+    except IntegrityError:
+        return False
+    return True
+
+
+async def commit_once(
+    db: AsyncSession,
+    user_id: int,
+    key: str | None,
+    route: str,
+    body: BaseModel,
+    work: Callable[[], Awaitable[ApiResponse]],
+) -> tuple[ApiResponse, bool]:
+    # Runs work() (which writes but does not commit) and commits. Returns the response and whether
+    # it was replayed; callers only publish events for fresh responses
+    if key is None:
+        response = await work()
+        await db.commit()
+        return response, False
+
+    fingerprint = request_fingerprint(route, body)
+    async with _key_lock(user_id, key):
+        stored = await _stored_response(db, user_id, key, fingerprint)
+        if isinstance(stored, ApiResponse):
+            return stored, True
+        response = await work()
+        if not await _store(db, user_id, key, fingerprint, response, stored is _EXPIRED):
+            # Another worker committed this key first; our writes roll back with the transaction
+            await db.rollback()
+            stored = await _stored_response(db, user_id, key, fingerprint)
+            if not isinstance(stored, ApiResponse):
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is still in progress")
+            return stored, True
+        await db.commit()
+        return response, False
+
+
+async def sweep_idempotency_keys(db: AsyncSession) -> int:
+    # Returns how many expired keys were removed
+    result = await db.execute(delete(IdempotencyRecord).where(IdempotencyRecord.created_at < _expiry_cutoff()))
+    return result.rowcount
+
+
+async def run_sweeper(session_factory) -> None:
+    # Background task started in main.py's lifespan; every worker runs one, which is harmless
+    while True:
+        await asyncio.sleep(settings.idempotency_sweep_interval_seconds)
+        try:
+            async with session_factory() as db:
+                removed = await sweep_idempotency_keys(db)
+                await db.commit()
+            logger.info("swept %d expired idempotency key(s)", removed)
+        except Exception:
+            logger.exception("idempotency key sweep failed")
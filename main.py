@@ -1,85 +1,121 @@
+import time
+
+# Cold start is measured from here: imports, app setup and the startup schema check
+BOOT_STARTED = time.perf_counter()
+
 from fastapi import FastAPI, Request, status
-from fastapi.exceptions import RequestValidationError
-from fastapi.staticfiles import StaticFiles
-from starlette.exceptions import HTTPException as StarletteHTTPException
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import JSONResponse
 
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
 
-from database import Base, engine
+import logging
+
+from auth import password_pool
+from coalesce import coalescer
+from config import settings
+from database import dispose_engines, get_engine, get_sessionmaker, read_pins
+from events import broker
+from idempotency import run_sweeper
+from ratelimit import limiter
+from schema import check_schema
+from timing import RequestTimings, current_timings, logger as timing_logger, process_age
+
+from routers import ops, tasks, users
 
-from routers import tasks, users
+logger = logging.getLogger("taskmanager.startup")
 
 # ============================================================
 # Application Lifespan (Startup / Shutdown)
 # ============================================================
 
 @asynccontextmanager
-async def lifespan(_app: FastAPI):
-    async with engine.begin() as conn:
-         await conn.run_sync(Base.metadata.create_all)
+async def lifespan(app: FastAPI):
+    # The schema is created by "python manage.py create-schema"; workers only check its version
+    async with get_engine().connect() as conn:
+        await check_schema(conn)
+    age = process_age()
+    app.state.startup["ready_ms"] = round(1000 * (time.perf_counter() - BOOT_STARTED), 1)
+    app.state.startup["process_ms"] = round(1000 * age, 1) if age is not None else None
+    await broker.backend.start()
+    sweeper = asyncio.create_task(run_sweeper(get_sessionmaker()))
+    logger.info("worker ready", extra={"startup": app.state.startup})
     yield
-    await engine.dispose()
+    sweeper.cancel()
+    # Coalesced task updates still waiting for their window are written before the pool closes
+    await coalescer.drain()
+    await broker.backend.stop()
+    password_pool.shutdown()
+    await dispose_engines()
 
 app = FastAPI(lifespan=lifespan)
 
-app.include_router(users.router, prefix="/api/users", tags=["users"])
-app.include_router(tasks.router, prefix="/api/tasks", tags=["tasks"])
-
 # ============================================================
-# Jinja2 Templates + StaticFiles
+# Request instrumentation (Server-Timing + query budget, see timing.py)
 # ============================================================
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    if not settings.server_timing:
+        return await call_next(request)
+    timings = RequestTimings(request.method, request.url.path)
+    token = current_timings.set(timings)
+    try:
+        response = await call_next(request)
+    finally:
+        current_timings.reset(token)
+    # For streamed responses (task export) this covers the work done before the first chunk
+    response.headers["Server-Timing"] = timings.server_timing()
+    if timing_logger.isEnabledFor(logging.DEBUG):
+        timing_logger.debug("request timing", extra={"timing": timings.as_dict(response.status_code)})
+    return response
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+# ============================================================
+# Read-your-writes (see get_read_db in database.py)
+# ============================================================
+# A successful write pins its user to the primary for a few seconds, so their next listings
+# don't come from a replica that hasn't caught up yet. get_current_user records who wrote
+@app.middleware("http")
+async def pin_writers_to_primary(request: Request, call_next):
+    response = await call_next(request)
+    if settings.db_replica_urls and request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        read_pins.pin(getattr(request.state, "user_id", None))
+    return response
 
 # ============================================================
-# Home route
+# Admission control (token buckets, see ratelimit.py)
 # ============================================================
-@app.get("/", include_in_schema=False, name="home")
-async def root(request: Request):
-    return templates.TemplateResponse(request, "home.html")
+# Declared last so it wraps everything else: a rejected request costs no DB connection, no Argon2
+# and no routing. Every limited route gets the RateLimit-* headers
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    if not settings.rate_limit_enabled:
+        return await call_next(request)
+    decision = await limiter.check(request)
+    if decision is None:
+        return await call_next(request)
+    if not decision.allowed:
+        return JSONResponse({"detail": "Too many requests"}, status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers=decision.headers())
+    response = await call_next(request)
+    response.headers.update(decision.headers())
+    return response
+
+app.include_router(users.router, prefix="/api/users", tags=["users"])
+app.include_router(tasks.router, prefix="/api/tasks", tags=["tasks"])
+app.include_router(ops.router, prefix="/api/ops", tags=["ops"])
 
 # ============================================================
-# Exception Handlers
+# Home page, error pages and static files (see routers/pages.py)
 # ============================================================
+# API-only workers keep FastAPI's JSON error handlers for every path
+if not settings.api_only:
+    from routers import pages
+
+    pages.install(app)
 
-# This deals with the Starlette exceptions
-@app.exception_handler(StarletteHTTPException)
-async def general_http_exception_handler(request: Request, exception: StarletteHTTPException):
-    message = (
-        exception.detail
-        if exception.detail
-        else "An error occurred. Please check your request and try again."
-    )
-
-    if request.url.path.startswith("/api"):
-        return await http_exception_handler(request, exception)
-    
-    return templates.TemplateResponse(
-        request,
-        "error.html",
-        {
-            "status_code": exception.status_code,
-            "title": exception.status_code,
-            "message": message,
-        },
-        status_code=exception.status_code
-    )
-
-# Validation error handler
-@app.exception_handler(RequestValidationError)
-async def validation_exception_handler(request: Request, exception: RequestValidationError):
-    if request.url.path.startswith("/api"):
-        return await request_validation_exception_handler(request, exception)
-    return templates.TemplateResponse(
-        request,
-        "error.html",
-        {
-            "status_code": status.HTTP_422_UNPROCESSABLE_CONTENT,
-            "title": status.HTTP_422_UNPROCESSABLE_CONTENT,
-            "message": "Invalid request. Please check your input and try again.",
-        },
-        status_code=status.HTTP_422_UNPROCESSABLE_CONTENT
-    )
\ No newline at end of file
+# Reported by GET /api/ops/startup; ready_ms and process_ms are filled in once lifespan startup ends
+app.state.startup = {
+    "api_only": settings.api_only,
+    "import_ms": round(1000 * (time.perf_counter() - BOOT_STARTED), 1),
+    "ready_ms": None,
+    "process_ms": None,
+}
@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+
+from auth import prune_refresh_tokens
+from config import settings
+from database import AsyncSessionLocal, engine
+from crud import rebuild_task_counters
+from idempotency import sweep_idempotency_keys
+from models import SCHEMA_VERSION
+from schema import create_schema as create_database_schema
+from search import rebuild_search_index
+from sync import compact_tombstones as compact_task_tombstones
+
+# Maintenance commands: python manage.py <command>
+
+
+async def create_schema():
+    # Run once per deploy, before the workers start; they refuse a database with another version
+    async with engine.begin() as conn:
+        await create_database_schema(conn)
+    print(f"Created and upgraded tables; schema version is {SCHEMA_VERSION}")
+
+
+async def rebuild_counters():
+    async with AsyncSessionLocal() as db:
+        fixed = await rebuild_task_counters(db)
+        await db.commit()
+    print(f"Rebuilt task counters; {fixed} user(s) had drifted")
+
+
+async def rebuild_search():
+    async with AsyncSessionLocal() as db:
+        await rebuild_search_index(db)
+        await db.commit()
+    print("Rebuilt the task search index")
+
+
+async def compact_tombstones():
+    # Meant for a daily cron; sync cursors older than the retention get 410 and start over
+    async with AsyncSessionLocal() as db:
+        removed = await compact_task_tombstones(db)
+        await db.commit()
+    print(f"Removed {removed} tombstone(s) older than {settings.tombstone_retention_days} days")
+
+
+async def sweep_idempotency():
+    # Workers already sweep on a timer; this is for running it by hand or from cron
+    async with AsyncSessionLocal() as db:
+        removed = await sweep_idempotency_keys(db)
+        await db.commit()
+    print(f"Removed {removed} idempotency key(s) older than {settings.idempotency_key_ttl_hours:g} hours")
+
+
+async def prune_refresh():
+    async with AsyncSessionLocal() as db:
+        removed = await prune_refresh_tokens(db)
+        await db.commit()
+    print(f"Removed {removed} expired refresh token(s)")
+
+
+COMMANDS = {
+    "create-schema": create_schema,
+    "rebuild-counters": rebuild_counters,
+    "rebuild-search": rebuild_search,
+    "compact-tombstones": compact_tombstones,
+    "sweep-idempotency-keys": sweep_idempotency,
+    "prune-refresh-tokens": prune_refresh,
+}
+
+
+async def run(command: str):
+    try:
+        await COMMANDS[command]()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Task Manager maintenance commands")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    asyncio.run(run(args.command))
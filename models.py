@@ -2,36 +2,161 @@ from __future__ import annotations
 
 from datetime import UTC, datetime
 
-from sqlalchemy import ForeignKey, Integer, String, DateTime, Boolean, Identity
+from sqlalchemy import DDL, ForeignKey, Integer, String, DateTime, Boolean, Identity, Index, Text, event, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from database import Base
 
+
+# Bump whenever a model changes shape. manage.py create-schema records it in schema_version and
+# app startup refuses to serve a database stamped with a different one (see schema.py)
+SCHEMA_VERSION = 5
+
+
+def profile_image_path(image_file: str | None) -> str:
+    if image_file:
+        return f"/media/profile_pics/{image_file}"
+    return "static/profile_pics/default.jpg"
+
+
 class User(Base):
     __tablename__ = "users"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
-    username: Mapped[str] = mapped_column(String(50), unique=True, nullable=False)
+    # Usernames keep their case and are unique case-insensitively (ux_users_username_lower below);
+    # emails are stored lowercased, so the plain unique index serves login lookups
+    username: Mapped[str] = mapped_column(String(50), nullable=False)
     email: Mapped[str] = mapped_column(String(120), unique=True, nullable=False)
     password_hash: Mapped[str] = mapped_column(String(200), nullable=False)
     image_file: Mapped[str | None] = mapped_column(String(200), nullable=True, default=None)
+    # Bumped on every write; exposed as the ETag and checked against If-Match
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+    # Denormalized task counters, kept in step by every task write (see crud.py). They are changed
+    # with Core UPDATEs only, so they don't bump version; manage.py rebuild-counters repairs drift
+    task_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    done_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
 
     # Cascade delete every task linked to a user once deleted
     tasklist: Mapped[list[Task]] = relationship("Task", back_populates="author", cascade="all, delete-orphan")
 
+    # ORM flushes add "WHERE version = :old" and bump it, so concurrent edits raise StaleDataError
+    __mapper_args__ = {"version_id_col": version}
+
     @property
     def image_path(self) -> str:
-        if self.image_file:
-            return f"/media/profile_pics/{self.image_file}"
-        return "static/profile_pics/default.jpg"
+        return profile_image_path(self.image_file)
+
+
+# Expression index, so WHERE lower(username) = ... is an index seek and signups can't race past it
+Index("ux_users_username_lower", func.lower(User.username), unique=True)
 
 # Updated to 2.0 style declarative (SQLAlchemy 2.0+)
 class Task(Base):
     __tablename__ = "tasklist"
+    # Composite indexes back every filter/sort combination of the task listings (see pagination.py),
+    # globally and per user. The per-user ones also cover lookups by user_id alone
+    __table_args__ = (
+        Index("ix_tasklist_created_id", "created", "id"),
+        Index("ix_tasklist_due_id", "due", "id"),
+        Index("ix_tasklist_done_created_id", "done", "created", "id"),
+        Index("ix_tasklist_done_due_id", "done", "due", "id"),
+        Index("ix_tasklist_user_created_id", "user_id", "created", "id"),
+        Index("ix_tasklist_user_due_id", "user_id", "due", "id"),
+        Index("ix_tasklist_user_done_created_id", "user_id", "done", "created", "id"),
+        Index("ix_tasklist_user_done_due_id", "user_id", "done", "due", "id"),
+        # Delta sync (GET /api/tasks/changes) pages through recent writes in this order
+        Index("ix_tasklist_updated_at_id", "updated_at", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False, index=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
     task: Mapped[str] = mapped_column(String(100), nullable=False)
     created: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(UTC))
     due: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
     done: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
-    author: Mapped[User] = relationship("User", back_populates="tasklist")
\ No newline at end of file
+    # Bumped on every write; task writes are Core UPDATEs (see crud.py), which bump it explicitly
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+    # Set on insert and by every UPDATE, Core ones included (onupdate applies to them too)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+    author: Mapped[User] = relationship("User", back_populates="tasklist")
+
+    __mapper_args__ = {"version_id_col": version}
+
+# A deleted task, so delta sync can tell clients to drop it. No foreign keys: tombstones outlive
+# the task and its owner. Compacted after a retention window (manage.py compact-tombstones)
+class TaskTombstone(Base):
+    __tablename__ = "task_tombstones"
+    __table_args__ = (Index("ix_task_tombstones_deleted_at_id", "deleted_at", "id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    task_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    deleted_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(UTC))
+
+# The stored response of a create request sent with an Idempotency-Key (see idempotency.py).
+# Written in the same transaction as the tasks it created; expired rows are swept on a timer
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index("ix_idempotency_keys_created_at", "created_at"),)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # sha256 of the request, so a key reused for a different request is refused instead of replayed
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+    status_code: Mapped[int] = mapped_column(Integer, nullable=False)
+    response: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(UTC))
+
+# A refresh token (see auth.py); only its sha256 is stored. A login starts a family, and each
+# refresh marks the presented token used and issues the next one in the same family
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    __table_args__ = (
+        Index("ix_refresh_tokens_family_id", "family_id"),
+        Index("ix_refresh_tokens_expires_at", "expires_at"),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    token_hash: Mapped[str] = mapped_column(String(64), nullable=False, unique=True)
+    # Removed with the user by the database (SQLite connections turn foreign keys on, see database.py)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    family_id: Mapped[str] = mapped_column(String(32), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(UTC))
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    used_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    revoked_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+# ------------------------------------------------------------
+# Full-text search over Task.task (queried by search.py)
+# ------------------------------------------------------------
+# Postgres: a generated tsvector column with a GIN index, so the database keeps it in sync.
+# It is not mapped on Task because SQLite has no such column type
+SEARCH_CONFIG = "english"
+
+POSTGRES_SEARCH_DDL = (
+    f"ALTER TABLE tasklist ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', task)) STORED",
+    "CREATE INDEX ix_tasklist_search_vector ON tasklist USING gin (search_vector)",
+)
+for statement in POSTGRES_SEARCH_DDL:
+    event.listen(Task.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+# SQLite: a contentless FTS5 table keyed by task id, kept in sync by triggers. The owner column
+# holds a "u<user_id>" token so "only my tasks" is part of the MATCH itself; the rank function
+# gives it no weight. Contentless tables need the old values to delete a row, which triggers have
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE tasklist_fts USING fts5(task, owner, content='', tokenize='porter unicode61')",
+    "INSERT INTO tasklist_fts(tasklist_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    """CREATE TRIGGER tasklist_fts_insert AFTER INSERT ON tasklist BEGIN
+        INSERT INTO tasklist_fts(rowid, task, owner) VALUES (new.id, new.task, 'u' || new.user_id);
+    END""",
+    """CREATE TRIGGER tasklist_fts_update AFTER UPDATE OF task ON tasklist WHEN old.task IS NOT new.task BEGIN
+        INSERT INTO tasklist_fts(tasklist_fts, rowid, task, owner) VALUES ('delete', old.id, old.task, 'u' || old.user_id);
+        INSERT INTO tasklist_fts(rowid, task, owner) VALUES (new.id, new.task, 'u' || new.user_id);
+    END""",
+    """CREATE TRIGGER tasklist_fts_delete AFTER DELETE ON tasklist BEGIN
+        INSERT INTO tasklist_fts(tasklist_fts, rowid, task, owner) VALUES ('delete', old.id, old.task, 'u' || old.user_id);
+    END""",
+)
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(Task.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Task.__table__, "before_drop", DDL("DROP TABLE IF EXISTS tasklist_fts").execute_if(dialect="sqlite"))
@@ -0,0 +1,146 @@
+import base64
+import binascii
+import json
+from datetime import UTC, datetime
+from typing import Annotated, Literal
+
+from fastapi import HTTPException, Query, status
+from sqlalchemy import Select, or_, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from models import Task
+
+# Keyset pagination: a page is "WHERE (key, id) > (:key, :id) ORDER BY key, id LIMIT n",
+# so with an index on (key, id) a deep page costs the same as the first one (no OFFSET scan)
+
+# Reusable query parameters for paginated listings
+PageLimit = Annotated[int, Query(ge=1, le=settings.max_page_size)]
+PageAfter = Annotated[str | None, Query(description="Opaque cursor returned as next_cursor by the previous page")]
+
+TaskSort = Literal["created", "due", "-due"]
+
+# sort name -> (column, descending, nullable)
+SORT_KEYS = {
+    "created": (Task.created, False, False),
+    "due": (Task.due, False, True),
+    "-due": (Task.due, True, True),
+}
+
+
+def as_utc(value: datetime | None) -> datetime | None:
+    # SQLite's DateTime drops tzinfo and compares the wall-clock time, so filter bounds are
+    # converted to UTC first; naive values are taken as UTC
+    if value is None:
+        return None
+    return value.astimezone(UTC) if value.tzinfo is not None else value.replace(tzinfo=UTC)
+
+
+class TaskListParams:
+    # Injected with Depends(); every filter/sort combination is served by one of the composite indexes on Task
+    def __init__(
+        self,
+        limit: PageLimit = settings.default_page_size,
+        after: PageAfter = None,
+        done: bool | None = None,
+        due_before: datetime | None = None,
+        due_after: datetime | None = None,
+        overdue: bool | None = None,
+        sort: TaskSort = "created",
+    ):
+        self.limit = limit
+        self.after = after
+        self.done = done
+        self.due_before = as_utc(due_before)
+        self.due_after = as_utc(due_after)
+        self.overdue = overdue
+        self.sort = sort
+
+    def apply_filters(self, stmt: Select) -> Select:
+        if self.done is not None:
+            stmt = stmt.where(Task.done.is_(self.done))
+        if self.due_before is not None:
+            stmt = stmt.where(Task.due < self.due_before)
+        if self.due_after is not None:
+            stmt = stmt.where(Task.due > self.due_after)
+        if self.overdue is True:
+            stmt = stmt.where(Task.done.is_(False), Task.due < datetime.now(UTC))
+        elif self.overdue is False:
+            stmt = stmt.where(or_(Task.done.is_(True), Task.due.is_(None), Task.due >= datetime.now(UTC)))
+        return stmt
+
+    @property
+    def excludes_null_due(self) -> bool:
+        return self.due_before is not None or self.due_after is not None or self.overdue is True
+
+
+def pack_cursor(*parts) -> str:
+    # Cursors are opaque to clients; they only carry the sort key of the last row they saw
+    payload = json.dumps(parts, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def unpack_cursor(cursor: str) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        parts = json.loads(base64.urlsafe_b64decode(padded))
+        if not isinstance(parts, list):
+            raise ValueError("cursor is not a list")
+        return parts
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def encode_cursor(sort: str, value: datetime | None, task_id: int) -> str:
+    return pack_cursor(sort, value.isoformat() if value is not None else None, task_id)
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple[datetime | None, int]:
+    parts = unpack_cursor(cursor)
+    try:
+        cursor_sort, value, task_id = parts
+        if cursor_sort != sort:
+            raise ValueError("cursor was issued for a different sort order")
+        return (datetime.fromisoformat(value) if value is not None else None), int(task_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def _keyset(stmt: Select, column, descending: bool, after: tuple[datetime, int] | None) -> Select:
+    key = tuple_(column, Task.id)
+    if after is not None:
+        stmt = stmt.where(key < after if descending else key > after)
+    if descending:
+        return stmt.order_by(column.desc(), Task.id.desc())
+    return stmt.order_by(column, Task.id)
+
+
+async def paginate_tasks(db: AsyncSession, stmt: Select, params: TaskListParams) -> tuple[list[Task], str | None]:
+    column, descending, nullable = SORT_KEYS[params.sort]
+    value, last_id = decode_cursor(params.after, params.sort) if params.after is not None else (None, None)
+    stmt = params.apply_filters(stmt)
+    # Fetch one extra row to know whether another page exists without a COUNT query
+    wanted = params.limit + 1
+
+    tasks: list[Task] = []
+    # Rows with a sort value come first; a cursor with a NULL value means we are already past them
+    if last_id is None or value is not None:
+        segment = stmt.where(column.is_not(None)) if nullable else stmt
+        after = (value, last_id) if last_id is not None else None
+        result = await db.execute(_keyset(segment, column, descending, after).limit(wanted))
+        tasks = list(result.scalars().all())
+
+    # NULLs sort last in both directions. Paging them separately by id keeps every query an
+    # index range scan on both Postgres (NULLS LAST) and SQLite (NULLS FIRST)
+    if nullable and len(tasks) < wanted and not params.excludes_null_due:
+        segment = stmt.where(column.is_(None))
+        if last_id is not None and value is None:
+            segment = segment.where(Task.id > last_id)
+        result = await db.execute(segment.order_by(Task.id).limit(wanted - len(tasks)))
+        tasks.extend(result.scalars().all())
+
+    next_cursor = None
+    if len(tasks) > params.limit:
+        tasks = tasks[:params.limit]
+        next_cursor = encode_cursor(params.sort, getattr(tasks[-1], column.key), tasks[-1].id)
+    return tasks, next_cursor
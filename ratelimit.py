@@ -0,0 +1,155 @@
+import importlib
+import math
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+from starlette.requests import Request
+
+from auth import request_user_id
+from cache import LRUCache
+from config import settings
+
+# Admission control: token buckets per route class (login, write, read) and per client, checked
+# by the middleware in main.py before a request reaches routing, the DB pool or Argon2.
+# Authenticated clients are keyed by user id (from the principal cache, or the token's own
+# claims, never the database), anonymous ones by IP, so a user can't escape by changing address
+
+
+@dataclass(frozen=True, slots=True)
+class Limit:
+    # "10/60": bursts of up to 10 requests, refilled at 10 per 60 seconds
+    requests: int
+    seconds: float
+
+    @classmethod
+    def parse(cls, spec: str) -> "Limit":
+        requests, _, seconds = spec.partition("/")
+        return cls(int(requests), float(seconds))
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.seconds
+
+    @property
+    def policy(self) -> str:
+        return f"{self.requests};w={self.seconds:g}"
+
+
+@dataclass(slots=True)
+class Decision:
+    allowed: bool
+    limit: Limit
+    tokens: float
+
+    def headers(self) -> dict[str, str]:
+        # RateLimit-Reset is how long until the bucket is full again
+        headers = {
+            "RateLimit-Limit": str(self.limit.requests),
+            "RateLimit-Remaining": str(math.floor(self.tokens)),
+            "RateLimit-Reset": str(math.ceil((self.limit.requests - self.tokens) / self.limit.rate)),
+            "RateLimit-Policy": self.limit.policy,
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil((1 - self.tokens) / self.limit.rate))
+        return headers
+
+
+class RateLimitBackend(ABC):
+    # Bucket storage. A shared store (e.g. Redis with a small Lua script) makes the limits
+    # global instead of per worker; take() must then be atomic on the store's side
+    @abstractmethod
+    async def take(self, key: str, limit: Limit) -> tuple[bool, float]:
+        # Takes one token if there is one; returns (allowed, tokens left)
+        ...
+
+    async def clear(self) -> None:
+        pass
+
+
+class MemoryBackend(RateLimitBackend):
+    # Per-worker buckets. An untouched bucket refills completely within limit.seconds, so its
+    # entry expires then and a missing entry simply means "full"
+    def __init__(self, maxsize: int):
+        self._buckets = LRUCache(maxsize, math.inf)
+
+    async def take(self, key: str, limit: Limit) -> tuple[bool, float]:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        tokens = limit.requests if bucket is None else min(limit.requests, bucket[0] + (now - bucket[1]) * limit.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets.set(key, (tokens, now), ttl=limit.seconds)
+        return allowed, tokens
+
+    async def clear(self) -> None:
+        self._buckets.clear()
+
+
+def build_rate_limit_backend(name: str) -> RateLimitBackend:
+    # "memory", or "package.module:factory" for a store shared by every worker
+    if name == "memory":
+        return MemoryBackend(settings.rate_limit_max_clients)
+    module_name, _, attribute = name.partition(":")
+    factory = getattr(importlib.import_module(module_name), attribute)
+    return factory()
+
+
+# Signing up and logging in both run Argon2, so they share the strict "login" class
+LOGIN_ROUTES = {("POST", "/api/users/token"), ("POST", "/api/users")}
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def route_class(method: str, path: str) -> str | None:
+    if not path.startswith("/api/"):
+        return None
+    if (method, path.rstrip("/")) in LOGIN_ROUTES:
+        return "login"
+    return "read" if method in READ_METHODS else "write"
+
+
+def client_key(request: Request) -> str:
+    user_id = request_user_id(request)
+    if user_id is not None:
+        return f"user:{user_id}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend, limits: dict[str, Limit]):
+        self.backend = backend
+        self.limits = limits
+        self.allowed = 0
+        self.limited = 0
+
+    async def check(self, request: Request) -> Decision | None:
+        # None when the route is not limited
+        kind = route_class(request.method, request.url.path)
+        if kind is None:
+            return None
+        limit = self.limits[kind]
+        allowed, tokens = await self.backend.take(f"{kind}:{client_key(request)}", limit)
+        if allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+        return Decision(allowed, limit, tokens)
+
+    async def clear(self) -> None:
+        self.allowed = 0
+        self.limited = 0
+        await self.backend.clear()
+
+    def stats(self) -> dict:
+        return {"backend": type(self.backend).__name__, "allowed": self.allowed, "limited": self.limited}
+
+
+limiter = RateLimiter(
+    build_rate_limit_backend(settings.rate_limit_backend),
+    {
+        "login": Limit.parse(settings.rate_limit_login),
+        "write": Limit.parse(settings.rate_limit_write),
+        "read": Limit.parse(settings.rate_limit_read),
+    },
+)
@@ -0,0 +1,71 @@
+from datetime import datetime
+from typing import Any
+
+import msgpack
+import orjson
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+# Response pipeline for the API routers. Handlers build plain dicts from data that is already
+# trusted (database rows, the cached principal, cache entries) and return ApiResponse, which
+# skips FastAPI's response_model validation and encodes with orjson, or with MessagePack when
+# the client asks for it. response_model stays on the routes for the OpenAPI schema only
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# OPT_UTC_Z writes UTC as "Z", the same as pydantic did; naive datetimes (SQLite) stay naive
+ORJSON_OPTIONS = orjson.OPT_UTC_Z
+
+
+def _msgpack_default(value: Any) -> Any:
+    # Datetimes go out as the same ISO strings the JSON responses use
+    if isinstance(value, datetime):
+        iso = value.isoformat()
+        return iso[:-6] + "Z" if iso.endswith("+00:00") else iso
+    raise TypeError(f"Cannot encode {type(value).__name__} as MessagePack")
+
+
+def negotiate(accept: str | None) -> str:
+    # Picks MessagePack only when the client prefers it over JSON; anything else gets JSON
+    if not accept:
+        return JSON_MEDIA_TYPE
+    best, best_quality = JSON_MEDIA_TYPE, -1.0
+    for part in accept.split(","):
+        media_type, _, params = part.strip().partition(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in MSGPACK_MEDIA_TYPES and quality > best_quality and quality > 0:
+            best, best_quality = MSGPACK_MEDIA_TYPES[0], quality
+        elif media_type in (JSON_MEDIA_TYPE, "application/*", "*/*") and quality > best_quality:
+            best, best_quality = JSON_MEDIA_TYPE, quality
+    return best
+
+
+def encode(content: Any, media_type: str) -> bytes:
+    if media_type == JSON_MEDIA_TYPE:
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
+    return msgpack.packb(content, default=_msgpack_default, datetime=False)
+
+
+class ApiResponse(Response):
+    # The body is encoded when the response is sent, since only then is the request's
+    # Accept header at hand (handlers don't need a Request parameter for this)
+    def __init__(self, content: Any, status_code: int = 200, headers: dict[str, str] | None = None):
+        self.content = content
+        super().__init__(content=b"", status_code=status_code, headers=headers)
+
+    async def __call__(self, scope, receive, send) -> None:
+        media_type = negotiate(Headers(scope=scope).get("accept"))
+        self.body = encode(self.content, media_type)
+        self.headers["content-type"] = media_type
+        self.headers["content-length"] = str(len(self.body))
+        self.headers["vary"] = "Accept"
+        await super().__call__(scope, receive, send)
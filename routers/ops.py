@@ -0,0 +1,48 @@
+import secrets
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+
+from auth import password_pool, token_cache
+from cache import response_cache
+from coalesce import coalescer
+from config import settings
+from database import pool_stats
+from events import broker
+from ratelimit import limiter
+
+
+
+def require_ops_token(x_ops_token: Annotated[str | None, Header()] = None):
+    if settings.ops_token is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if x_ops_token is None or not secrets.compare_digest(x_ops_token, settings.ops_token.get_secret_value()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid ops token")
+
+
+router = APIRouter(dependencies=[Depends(require_ops_token)])
+# ============================================================
+# Operational ENDPOINTS
+# ============================================================
+# IN-PROCESS CACHE AND RUNTIME COUNTERS (per worker)
+@router.get("/stats")
+async def api_runtime_stats():
+    return {
+        "token_cache": token_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "password_pool": password_pool.stats(),
+        "events": broker.stats(),
+        "rate_limit": limiter.stats(),
+        "write_coalescer": coalescer.stats(),
+    }
+
+# DATABASE CONNECTION POOL SATURATION (per worker)
+@router.get("/pool")
+async def api_pool_stats():
+    return pool_stats()
+
+# COLD START OF THIS WORKER: import_ms covers imports and app setup, ready_ms adds the startup
+# schema check, process_ms counts from process start (interpreter and server imports included)
+@router.get("/startup")
+async def api_startup_stats(request: Request):
+    return request.app.state.startup
@@ -0,0 +1,72 @@
+from fastapi import APIRouter, FastAPI, Request, status
+from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+# HTML side of the app: home page, error pages and static files. main.py only imports this
+# module when API_ONLY is off, so API workers never load Jinja2 or scan the template folder
+
+router = APIRouter()
+
+# ============================================================
+# Jinja2 Templates + StaticFiles
+# ============================================================
+
+templates = Jinja2Templates(directory="templates")
+
+# ============================================================
+# Home route
+# ============================================================
+@router.get("/", include_in_schema=False, name="home")
+async def root(request: Request):
+    return templates.TemplateResponse(request, "home.html")
+
+# ============================================================
+# Exception Handlers
+# ============================================================
+
+# This deals with the Starlette exceptions
+async def general_http_exception_handler(request: Request, exception: StarletteHTTPException):
+    message = (
+        exception.detail
+        if exception.detail
+        else "An error occurred. Please check your request and try again."
+    )
+
+    if request.url.path.startswith("/api"):
+        return await http_exception_handler(request, exception)
+    
+    return templates.TemplateResponse(
+        request,
+        "error.html",
+        {
+            "status_code": exception.status_code,
+            "title": exception.status_code,
+            "message": message,
+        },
+        status_code=exception.status_code
+    )
+
+# Validation error handler
+async def validation_exception_handler(request: Request, exception: RequestValidationError):
+    if request.url.path.startswith("/api"):
+        return await request_validation_exception_handler(request, exception)
+    return templates.TemplateResponse(
+        request,
+        "error.html",
+        {
+            "status_code": status.HTTP_422_UNPROCESSABLE_CONTENT,
+            "title": status.HTTP_422_UNPROCESSABLE_CONTENT,
+            "message": "Invalid request. Please check your input and try again.",
+        },
+        status_code=status.HTTP_422_UNPROCESSABLE_CONTENT
+    )
+
+
+def install(app: FastAPI) -> None:
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+    app.include_router(router)
+    app.add_exception_handler(StarletteHTTPException, general_http_exception_handler)
+    app.add_exception_handler(RequestValidationError, validation_exception_handler)
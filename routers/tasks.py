@@ -1,102 +1,303 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy import select
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
 from models import Task, User
-from database import get_db
-from schemas import TaskCreate, TaskResponse, TaskUpdate
+from database import get_db, get_read_db
+from schemas import TaskBatchCreate, TaskBatchResponse, TaskBatchUpdate, TaskChanges, TaskCreate, TaskPage, TaskResponse, TaskUpdate
+from crud import (
+    TASK_COLUMNS, batch_update_values, classify_misses, count_created_tasks, count_deleted_tasks, count_done_changes,
+    load_task_entry, load_user_entry, owned_task_criteria, raise_for_miss, record_deleted_tasks, task_cache_key, task_payload,
+    update_owned_task, user_cache_key, user_public_payload,
+)
+from cache import response_cache
+from events import broker, user_topic
+from etags import etag_matches, make_etag, versions_from_if_match
+from responses import ApiResponse
+from pagination import SORT_KEYS, PageAfter, PageLimit, TaskListParams, paginate_tasks
+from search import search_tasks
+from sync import task_changes
+from fieldsets import TaskFieldset
+from idempotency import IdempotencyKey, commit_once
+from coalesce import coalescer
 
 from auth import CurrentUser
 
+from config import settings
+
 router = APIRouter()
+
+
+def task_etag(task_version: int, author_version: int) -> str:
+    # A task response embeds its author, so renaming the author must change the task's ETag too
+    return make_etag(task_version, author_version)
+
+
+def if_match_task_versions(if_match: str | None, current_user) -> list[int] | None:
+    # Turns If-Match into the task versions a write may apply to (None = unconditional).
+    # The author half of the tag is checked here against the principal, the task half in SQL.
+    # Tags without an author half come from responses that did not embed the author
+    if if_match is None:
+        return None
+    versions = versions_from_if_match(if_match)
+    if versions is None:
+        return None
+    return [version[0] for version in versions if len(version) == 1 or (len(version) == 2 and version[1] == current_user.version)]
 # ============================================================
 # Task ENDPOINTS
 # ============================================================
 # GET THE LIST OF TASKS
-@router.get("", response_model=list[TaskResponse])
-async def api_list_tasks(db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(Task).options(selectinload(Task.author)))
-    tasks = result.scalars().all()
-    return tasks
+@router.get("", response_model=TaskPage)
+async def api_list_tasks(db: Annotated[AsyncSession, Depends(get_read_db)], params: Annotated[TaskListParams, Depends()], fieldset: Annotated[TaskFieldset, Depends()]):
+    stmt = fieldset.loader_options(select(Task), SORT_KEYS[params.sort][0])
+    tasks, next_cursor = await paginate_tasks(db, stmt, params)
+    return ApiResponse({"items": fieldset.payloads(tasks), "next_cursor": next_cursor})
 
 # CREATE A NEW TASK
+# With an Idempotency-Key header, a retry replays the first response instead of inserting again
 @router.post("", response_model=TaskResponse, status_code=status.HTTP_201_CREATED)
-async def api_create_task(task: TaskCreate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
-    
-    new_task = Task(
-        task = task.task,
-        due = task.due,
-        done = task.done,
-        user_id = current_user.id
+async def api_create_task(task: TaskCreate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], idempotency_key: IdempotencyKey = None):
+    async def insert_task() -> ApiResponse:
+        await count_created_tasks(db, current_user.id, [task.done])
+        # INSERT ... RETURNING gives back everything the response needs; the author is the current user
+        stmt = insert(Task).values(task=task.task, due=task.due, done=task.done, user_id=current_user.id).returning(*TASK_COLUMNS)
+        row = (await db.execute(stmt)).first()
+        return ApiResponse(task_payload(row, user_public_payload(current_user)), status_code=status.HTTP_201_CREATED)
+
+    response, replayed = await commit_once(db, current_user.id, idempotency_key, "POST /api/tasks", task, insert_task)
+    if not replayed:
+        await broker.publish(user_topic(current_user.id), [("task.created", response.content)])
+    return response
+
+# ============================================================
+# Search (declared before /{task_id} so "search" is not parsed as an id)
+# ============================================================
+# FULL-TEXT SEARCH OVER YOUR OWN TASKS, best match first
+@router.get("/search", response_model=TaskPage)
+async def api_search_tasks(
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    current_user: CurrentUser,
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    limit: PageLimit = settings.default_page_size,
+    after: PageAfter = None,
+):
+    rows, next_cursor = await search_tasks(db, current_user.id, q, limit, after)
+    author = user_public_payload(current_user)
+    return ApiResponse({"items": [task_payload(row, author) for row in rows], "next_cursor": next_cursor})
+
+# ============================================================
+# Delta sync (declared before /{task_id} so "changes" is not parsed as an id)
+# ============================================================
+# TASKS WRITTEN OR DELETED SINCE A CURSOR (see sync.py). Call it without since to get a first cursor.
+# Reads the primary: a replica lagging by more than SYNC_SETTLE_SECONDS could make a client skip rows
+@router.get("/changes", response_model=TaskChanges)
+async def api_task_changes(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    fieldset: Annotated[TaskFieldset, Depends()],
+    since: Annotated[str | None, Query(description="next_cursor from the previous sync")] = None,
+    limit: PageLimit = settings.default_page_size,
+):
+    return ApiResponse(await task_changes(db, fieldset, since, limit))
+
+# ============================================================
+# Change feed (declared before /{task_id} so "stream" is not parsed as an id)
+# ============================================================
+# SERVER-SENT EVENTS FOR YOUR OWN TASKS: task.created, task.updated (with the task as the
+# responses return it), task.deleted ({"id": ...}), and resync when this connection fell behind
+@router.get("/stream", response_class=StreamingResponse)
+async def api_stream_tasks(current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
+    # The stream can stay open for hours; don't keep the auth lookup's connection checked out
+    await db.close()
+    return StreamingResponse(
+        broker.stream(user_topic(current_user.id), settings.event_keepalive_seconds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    db.add(new_task)
+
+# ============================================================
+# Batch ENDPOINTS (declared before /{task_id} so "batch" is not parsed as an id)
+# ============================================================
+MISS_DETAILS = {status.HTTP_403_FORBIDDEN: "Not authorized", status.HTTP_404_NOT_FOUND: "Task not found"}
+
+
+def batch_result(task_id: int, result_status: int, task: dict | None = None, detail: str | None = None) -> dict:
+    # One TaskBatchResult
+    return {"id": task_id, "status": result_status, "task": task, "detail": detail}
+
+
+# CREATE MANY TASKS: one multi-row INSERT ... RETURNING (Idempotency-Key works as for single creates)
+@router.post("/batch", response_model=TaskBatchResponse, status_code=status.HTTP_201_CREATED)
+async def api_create_tasks_batch(batch: TaskBatchCreate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], idempotency_key: IdempotencyKey = None):
+    async def insert_tasks() -> ApiResponse:
+        rows = [
+            {"task": item.task, "due": item.due, "done": item.done, "user_id": current_user.id}
+            for item in batch.items
+        ]
+        await count_created_tasks(db, current_user.id, [item.done for item in batch.items])
+        # sort_by_parameter_order would make SQLite fall back to one INSERT per row; ids are
+        # handed out in VALUES order within one statement, so sorting by id restores input order
+        result = await db.execute(insert(Task).returning(*TASK_COLUMNS), rows)
+        created = sorted(result.all(), key=lambda row: row.id)
+        author = user_public_payload(current_user)
+        return ApiResponse({"results": [batch_result(row.id, status.HTTP_201_CREATED, task_payload(row, author)) for row in created]}, status_code=status.HTTP_201_CREATED)
+
+    response, replayed = await commit_once(db, current_user.id, idempotency_key, "POST /api/tasks/batch", batch, insert_tasks)
+    if not replayed:
+        await broker.publish(user_topic(current_user.id), [("task.created", result["task"]) for result in response.content["results"]])
+    return response
+
+# PARTIAL UPDATE OF MANY TASKS: one UPDATE ... WHERE id IN (...) AND user_id = :me RETURNING
+@router.patch("/batch", response_model=TaskBatchResponse)
+async def api_update_tasks_batch(batch: TaskBatchUpdate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
+    changes_by_id = {item.id: item.model_dump(exclude_unset=True, exclude={"id"}) for item in batch.items}
+    ids = list(changes_by_id)
+    values = batch_update_values(changes_by_id)
+    await coalescer.take(ids)
+
+    owned = (Task.id.in_(ids), Task.user_id == current_user.id)
+    if "done" in values:
+        done_ids = [task_id for task_id, changes in changes_by_id.items() if "done" in changes]
+        await count_done_changes(db, current_user.id, (Task.id.in_(done_ids), Task.user_id == current_user.id), values["done"])
+    if values:
+        stmt = update(Task).where(*owned).values(**values).returning(*TASK_COLUMNS).execution_options(synchronize_session=False)
+    else:
+        # Nothing to change, but ownership still has to be reported per item
+        stmt = select(*TASK_COLUMNS).where(*owned)
+    result = await db.execute(stmt)
+    updated = {row.id: row for row in result.all()}
+    misses = await classify_misses(db, [task_id for task_id in ids if task_id not in updated])
+    await db.commit()
+    await response_cache.invalidate(*(task_cache_key(task_id) for task_id in updated))
+
+    author = user_public_payload(current_user)
+    payloads = {task_id: task_payload(row, author) for task_id, row in updated.items()}
+    await broker.publish(user_topic(current_user.id), [("task.updated", payloads[task_id]) for task_id in ids if task_id in payloads])
+    results = []
+    for task_id in ids:
+        if task_id in payloads:
+            results.append(batch_result(task_id, status.HTTP_200_OK, payloads[task_id]))
+        else:
+            results.append(batch_result(task_id, misses[task_id], detail=MISS_DETAILS[misses[task_id]]))
+    return ApiResponse({"results": results})
+
+# DELETE MANY TASKS: one DELETE ... WHERE id IN (...) AND user_id = :me RETURNING id
+@router.delete("/batch", response_model=TaskBatchResponse)
+async def api_delete_tasks_batch(ids: Annotated[list[int], Query(min_length=1, max_length=settings.batch_max_items)], current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
+    ids = list(dict.fromkeys(ids))
+    await coalescer.take(ids)
+    await count_deleted_tasks(db, current_user.id, (Task.id.in_(ids), Task.user_id == current_user.id))
+    stmt = delete(Task).where(Task.id.in_(ids), Task.user_id == current_user.id).returning(Task.id).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    deleted = set(result.scalars().all())
+    await record_deleted_tasks(db, current_user.id, [task_id for task_id in ids if task_id in deleted])
+    misses = await classify_misses(db, [task_id for task_id in ids if task_id not in deleted])
     await db.commit()
-    await db.refresh(new_task, attribute_names=["author"])
-    return new_task
+    await response_cache.invalidate(*(task_cache_key(task_id) for task_id in deleted))
+    await broker.publish(user_topic(current_user.id), [("task.deleted", {"id": task_id}) for task_id in ids if task_id in deleted])
+
+    return ApiResponse({"results": [
+        batch_result(task_id, status.HTTP_204_NO_CONTENT)
+        if task_id in deleted
+        else batch_result(task_id, misses[task_id], detail=MISS_DETAILS[misses[task_id]])
+        for task_id in ids
+    ]})
 
 # GET SPECIFIC TASK
+# Reads the primary, not a replica: what it loads fills the shared response cache, and a lagging
+# replica could put a row back into it right after a write invalidated it
 @router.get("/{task_id}", response_model=TaskResponse)
-async def api_get_task(task_id: int, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(Task).options(selectinload(Task.author)).where(Task.id == task_id))
-    task = result.scalars().first()
-    if task:
-            return task
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
-
-# FULL TASK UPDATE
-@router.put("/{task_id}", response_model=TaskResponse)
-async def api_update_task(task_id: int, task_data: TaskCreate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(Task).options(selectinload(Task.author)).where(Task.id == task_id))
-    task = result.scalars().first()
+async def api_get_task(task_id: int, db: Annotated[AsyncSession, Depends(get_db)], fieldset: Annotated[TaskFieldset, Depends()], if_none_match: Annotated[str | None, Header()] = None):
+    if if_none_match is not None:
+        task = await response_cache.get(task_cache_key(task_id))
+        if not fieldset.expand_author:
+            if task:
+                versions = (task["version"],)
+            else:
+                result = await db.execute(select(Task.version).where(Task.id == task_id))
+                versions = result.first()
+        else:
+            author = await response_cache.get(user_cache_key(task["user_id"])) if task else None
+            if task and author:
+                versions = (task["version"], author["version"])
+            else:
+                # Conditional GET: compare versions only, without loading the task or its author
+                result = await db.execute(select(Task.version, User.version).select_from(Task).join(Task.author).where(Task.id == task_id))
+                versions = result.first()
+        if versions is not None and etag_matches(if_none_match, make_etag(*versions)):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": make_etag(*versions)})
 
+    task = await response_cache.get_or_load(task_cache_key(task_id), lambda: load_task_entry(db, task_id))
     if not task:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
-    
-    if task.user_id != current_user.id:
-         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
+    if not fieldset.expand_author:
+        # Same resource, different representation: the ETag only covers what the body contains
+        return ApiResponse(fieldset.entry_payload(task, None), headers={"ETag": make_etag(task["version"])})
 
-    task.task = task_data.task
-    task.due = task_data.due
-    task.done = task_data.done
+    author = await response_cache.get_or_load(user_cache_key(task["user_id"]), lambda: load_user_entry(db, task["user_id"]))
+    if not author:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
+    return ApiResponse(fieldset.entry_payload(task, author), headers={"ETag": task_etag(task["version"], author["version"])})
 
+# FULL TASK UPDATE
+@router.put("/{task_id}", response_model=TaskResponse)
+async def api_update_task(task_id: int, task_data: TaskCreate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], if_match: Annotated[str | None, Header()] = None):
+    versions = if_match_task_versions(if_match, current_user)
+    await coalescer.take([task_id])
+    await count_done_changes(db, current_user.id, owned_task_criteria(task_id, current_user.id, versions), task_data.done)
+    row = await update_owned_task(db, task_id, current_user.id, task_data.model_dump(), versions)
+    if row is None:
+        await raise_for_miss(db, task_id, current_user.id)
     await db.commit()
-    await db.refresh(task, attribute_names=["author"]) #This does a refresh and loads the author relatioship
-    return task
+    await response_cache.invalidate(task_cache_key(task_id))
+    # The owner is the current user, so the author block comes from the cached principal instead of a refresh
+    payload = task_payload(row, user_public_payload(current_user))
+    await broker.publish(user_topic(current_user.id), [("task.updated", payload)])
+    return ApiResponse(payload, headers={"ETag": task_etag(row.version, current_user.version)})
 
 # PARTIAL TASK UPDATE
 @router.patch("/{task_id}", response_model=TaskResponse)
-async def api_partial_update_task(task_id: int, task_data: TaskUpdate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(Task).where(Task.id == task_id))
-    task = result.scalars().first()
-
-    if not task:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
-    
-    if task.user_id != current_user.id:
-         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    
+async def api_partial_update_task(task_id: int, task_data: TaskUpdate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], if_match: Annotated[str | None, Header()] = None):
     update_data = task_data.model_dump(exclude_unset=True) # This takes ONLY the fields that have content
-    for field, value in update_data.items():
-        setattr(task, field, value)
-
+    versions = if_match_task_versions(if_match, current_user)
+    # With write coalescing on, unconditional updates wait for the next group commit (see coalesce.py)
+    if settings.write_coalescing and update_data and versions is None:
+        author = user_public_payload(current_user)
+        flushed = coalescer.offer(task_id, current_user.id, update_data, author)
+        if flushed is not None:
+            if not settings.write_coalesce_durable:
+                return ApiResponse({"id": task_id, "pending": update_data}, status_code=status.HTTP_202_ACCEPTED)
+            row = await flushed
+            if row is None:
+                await raise_for_miss(db, task_id, current_user.id)
+            return ApiResponse(task_payload(row, author), headers={"ETag": task_etag(row.version, current_user.version)})
+    # Direct writes go after any pending coalesced update of the same task, never under it
+    await coalescer.take([task_id])
+    if update_data.get("done") is not None:
+        await count_done_changes(db, current_user.id, owned_task_criteria(task_id, current_user.id, versions), update_data["done"])
+    row = await update_owned_task(db, task_id, current_user.id, update_data, versions)
+    if row is None:
+        await raise_for_miss(db, task_id, current_user.id)
     await db.commit()
-    await db.refresh(task, attribute_names=["author"])
-    return task
+    await response_cache.invalidate(task_cache_key(task_id))
+    payload = task_payload(row, user_public_payload(current_user))
+    await broker.publish(user_topic(current_user.id), [("task.updated", payload)])
+    return ApiResponse(payload, headers={"ETag": task_etag(row.version, current_user.version)})
     
 # DELETE TASK
 @router.delete("/{task_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def api_delete_task(task_id: int, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(Task).where(Task.id == task_id))
-    task = result.scalars().first()
-    if not task:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
-    
-    if task.user_id != current_user.id:
-         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    
-    await db.delete(task)
+async def api_delete_task(task_id: int, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], if_match: Annotated[str | None, Header()] = None):
+    versions = if_match_task_versions(if_match, current_user)
+    await coalescer.take([task_id])
+    await count_deleted_tasks(db, current_user.id, owned_task_criteria(task_id, current_user.id, versions))
+    stmt = delete(Task).where(*owned_task_criteria(task_id, current_user.id, versions)).returning(Task.id).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    if result.scalar() is None:
+        await raise_for_miss(db, task_id, current_user.id)
+    await record_deleted_tasks(db, current_user.id, [task_id])
     await db.commit()
+    await response_cache.invalidate(task_cache_key(task_id))
+    await broker.publish(user_topic(current_user.id), [("task.deleted", {"id": task_id})])
     return {"Message": "Entry deleted"}
\ No newline at end of file
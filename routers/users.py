@@ -1,54 +1,91 @@
-from typing import Annotated
+import csv
+import io
+from typing import Annotated, Literal
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy import select
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+import orjson
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
 
 from models import Task, User
-from database import get_db
-from schemas import TaskResponse, UserCreate, UserPublic, UserPrivate, UserUpdate, Token
+from database import get_db, get_read_db
+from schemas import TaskPage, TaskStats, UserCreate, UserPublic, UserPrivate, UserUpdate, Token, TokenRefresh
+from pagination import SORT_KEYS, TaskListParams, paginate_tasks
+from fieldsets import TaskFieldset
 
-from datetime import timedelta
+from datetime import UTC, datetime, timedelta
 from fastapi.security import OAuth2PasswordRequestForm
 
-from sqlalchemy import func
+from sqlalchemy import case, func
 
-from auth import create_access_token, hash_password, verify_password, CurrentUser
+from auth import create_access_token, hash_password_async, issue_refresh_token, revoke_refresh_token, rotate_refresh_token, verify_password_async, token_cache, CurrentUser
 
 from config import settings
+from cache import response_cache
+from crud import delete_user_tasks, load_user_entry, task_cache_key, user_cache_key, user_private_payload
+from etags import etag_matches, make_etag, precondition_failed, versions_from_if_match
+from responses import ORJSON_OPTIONS, ApiResponse
 
 router = APIRouter()
+
+
+def check_user_if_match(if_match: str | None, user: User):
+    # User ETags are just the row version; the ORM also re-checks it in the UPDATE/DELETE WHERE clause
+    if if_match is None:
+        return
+    versions = versions_from_if_match(if_match)
+    if versions is not None and (user.version,) not in versions:
+        precondition_failed("User was modified by another request")
+
+
+# Unique constraints on users, by the name each database reports: asyncpg gives the constraint
+# or index name, SQLite the index name, or table.column for a column-level UNIQUE
+EMAIL_CONSTRAINTS = {"users_email_key", "users.email"}
+# users_username_key / users.username: the case-sensitive constraint of databases made before
+# ux_users_username_lower (Postgres drops it on upgrade, SQLite keeps it)
+USERNAME_CONSTRAINTS = {"ux_users_username_lower", "users_username_key", "users.username"}
+
+
+def violated_constraint(exc: IntegrityError) -> str | None:
+    name = getattr(exc.orig.__cause__, "constraint_name", None)
+    if name is None:
+        # SQLite: "UNIQUE constraint failed: users.email" or "... failed: index 'ux_users_username_lower'"
+        message = str(exc.orig)
+        if message.startswith("UNIQUE constraint failed: "):
+            name = message.removeprefix("UNIQUE constraint failed: ").removeprefix("index ").strip("'")
+    return name
+
+
+def raise_duplicate_user(exc: IntegrityError, email_detail: str):
+    name = violated_constraint(exc)
+    if name in EMAIL_CONSTRAINTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=email_detail) from None
+    if name in USERNAME_CONSTRAINTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists") from None
+    # Not a duplicate user (e.g. a NOT NULL or foreign key failure): don't dress it up as one
+    raise exc
 # ============================================================
 # User ENDPOINTS
 # ============================================================
 # CREATE NEW USER
 @router.post("", response_model=UserPrivate, status_code=status.HTTP_201_CREATED)
 async def api_create_user(user: UserCreate, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(User).where(func.lower(User.username) == user.username.lower()))
-    existing_user = result.scalars().first()
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username already exists"
-        )
-    result = await db.execute(select(User).where(func.lower(User.email) == user.email.lower()))
-    existing_email = result.scalars().first()
-    if existing_email:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already exists"
-        )
-    new_user = User(
+    # One INSERT ... RETURNING; the unique indexes reject duplicates, even concurrent ones
+    stmt = insert(User).values(
         username = user.username,
         email = user.email.lower(),
-        password_hash = hash_password(user.password)
-    )
-
-    db.add(new_user)
-    await db.commit()
-    await db.refresh(new_user) #Not strictly neccessary
-    return new_user
+        password_hash = await hash_password_async(user.password)
+    ).returning(User.id, User.username, User.email, User.image_file)
+    try:
+        new_user = (await db.execute(stmt)).one()
+        await db.commit()
+    except IntegrityError as exc:
+        await db.rollback()
+        raise_duplicate_user(exc, email_detail="Email already exists")
+    return ApiResponse(user_private_payload(new_user), status_code=status.HTTP_201_CREATED)
 
 
 @router.post("/token", response_model=Token)
@@ -56,24 +93,42 @@ async def login_for_access_token(
      form_data: Annotated[OAuth2PasswordRequestForm, Depends()], 
      db: Annotated[AsyncSession, Depends(get_db)]
     ):
-    result = await db.execute(select(User).where(func.lower(User.email) == form_data.username.lower()))
+    # Emails are stored lowercased, so this is a seek on the unique email index
+    result = await db.execute(select(User).where(User.email == form_data.username.lower()))
     user = result.scalars().first()
 
-    if not user or not verify_password(form_data.password, user.password_hash):
+    if not user or not await verify_password_async(form_data.password, user.password_hash):
          raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password", headers={"WWW-Authenticate": "Bearer"})
     
     access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
     acces_token = create_access_token(data={"sub":str(user.id)}, expires_delta=access_token_expires)
+    refresh_token = await issue_refresh_token(db, user.id)
+    await db.commit()
 
-    return Token(access_token=acces_token, token_type="bearer")
+    return ApiResponse({"access_token": acces_token, "token_type": "bearer", "refresh_token": refresh_token})
+
+# NEW ACCESS TOKEN FROM A REFRESH TOKEN: no password hashing, the refresh token is rotated
+@router.post("/token/refresh", response_model=Token)
+async def refresh_access_token(body: TokenRefresh, db: Annotated[AsyncSession, Depends(get_db)]):
+    user_id, refresh_token = await rotate_refresh_token(db, body.refresh_token)
+    await db.commit()
+    access_token = create_access_token(data={"sub": str(user_id)}, expires_delta=timedelta(minutes=settings.access_token_expire_minutes))
+    return ApiResponse({"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token})
+
+# LOGOUT: revokes the refresh token and every token rotated from the same login
+@router.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_token(body: TokenRefresh, db: Annotated[AsyncSession, Depends(get_db)]):
+    await revoke_refresh_token(db, body.refresh_token)
+    await db.commit()
+    return {"Message": "Refresh token revoked"}
 
 @router.get("/me", response_model=UserPrivate)
 async def get_current_user(current_user: CurrentUser):
-    return current_user
+    return ApiResponse(user_private_payload(current_user))
 
 # PARTIAL USER UPDATE
 @router.patch("/{user_id}", response_model=UserPrivate)
-async def api_update_user(user_id: int, user_update: UserUpdate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
+async def api_update_user(user_id: int, user_update: UserUpdate, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], if_match: Annotated[str | None, Header()] = None):
 
     if user_id != current_user.id:
          raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
@@ -83,18 +138,8 @@ async def api_update_user(user_id: int, user_update: UserUpdate, current_user: C
 
     if not user:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    
-    if user_update.username is not None and user_update.username.lower() != user.username.lower():
-         result = await db.execute(select(User).where(func.lower(User.username) == user_update.username.lower()))
-         existing_user = result.scalars().first()
-         if existing_user:
-              raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists")
-         
-    if user_update.email is not None and user_update.email.lower() != user.email.lower():
-         result = await db.execute(select(User).where(func.lower(User.email) == user_update.email.lower()))
-         existing_email = result.scalars().first()
-         if existing_email:
-              raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
+
+    check_user_if_match(if_match, user)
     
     if user_update.username is not None:
          user.username = user_update.username
@@ -103,45 +148,146 @@ async def api_update_user(user_id: int, user_update: UserUpdate, current_user: C
     if user_update.image_file is not None:
          user.image_file = user_update.image_file
 
-    await db.commit()
+    try:
+        await db.commit()
+    except StaleDataError:
+        # Another request updated the row between our SELECT and UPDATE
+        precondition_failed("User was modified by another request")
+    except IntegrityError as exc:
+        await db.rollback()
+        raise_duplicate_user(exc, email_detail="Email already registered")
+    # Cached principals and profile responses for this user would otherwise keep the old username/email
+    token_cache.invalidate_user(user_id)
+    await response_cache.invalidate(user_cache_key(user_id))
     await db.refresh(user)
-    return user
+    return ApiResponse(user_private_payload(user), headers={"ETag": make_etag(user.version)})
 
 # GET USER INFO
+# Reads the primary for the same reason as GET /api/tasks/{task_id}: it fills the response cache
 @router.get("/{user_id}", response_model=UserPublic)
-async def api_get_user(user_id: int, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalars().first()
+async def api_get_user(user_id: int, db: Annotated[AsyncSession, Depends(get_db)], if_none_match: Annotated[str | None, Header()] = None):
+    if if_none_match is not None:
+        cached = await response_cache.get(user_cache_key(user_id))
+        if cached is not None:
+            version = cached["version"]
+        else:
+            # Conditional GET: compare the version column only
+            result = await db.execute(select(User.version).where(User.id == user_id))
+            version = result.scalar()
+        if version is not None and etag_matches(if_none_match, make_etag(version)):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": make_etag(version)})
+
+    user = await response_cache.get_or_load(user_cache_key(user_id), lambda: load_user_entry(db, user_id))
 
     if user:
-        return user
+        body = {key: value for key, value in user.items() if key != "version"}
+        return ApiResponse(body, headers={"ETag": make_etag(user["version"])})
     
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
 # GET TASKS FOR A SPECIFIC USER
-@router.get("/{user_id}/tasks", response_model=list[TaskResponse])
-async def api_get_user_tasks(user_id: int, db: Annotated[AsyncSession, Depends(get_db)]):
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalars().first()
-    if not user:
+@router.get("/{user_id}/tasks", response_model=TaskPage)
+async def api_get_user_tasks(user_id: int, db: Annotated[AsyncSession, Depends(get_read_db)], params: Annotated[TaskListParams, Depends()], fieldset: Annotated[TaskFieldset, Depends()]):
+    result = await db.execute(select(User.id).where(User.id == user_id))
+    if result.scalar() is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     
-    result = await db.execute(select(Task).options(selectinload(Task.author)).where(Task.user_id == user_id))
-    tasks = result.scalars().all()
-    return tasks
+    stmt = fieldset.loader_options(select(Task), SORT_KEYS[params.sort][0]).where(Task.user_id == user_id)
+    tasks, next_cursor = await paginate_tasks(db, stmt, params)
+    return ApiResponse({"items": fieldset.payloads(tasks), "next_cursor": next_cursor})
+
+# TASK STATISTICS FOR A USER
+# Totals come from the counters on users; the time windows from one GROUP BY over the
+# (user_id, done, due) index, limited to unfinished tasks due within the next week
+@router.get("/{user_id}/tasks/stats", response_model=TaskStats)
+async def api_get_user_task_stats(user_id: int, db: Annotated[AsyncSession, Depends(get_read_db)]):
+    result = await db.execute(select(User.task_count, User.done_count).where(User.id == user_id))
+    counters = result.first()
+    if counters is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    now = datetime.now(UTC)
+    window = case((Task.due < now, "overdue"), else_="due_this_week").label("window")
+    result = await db.execute(
+        select(window, func.count())
+        .where(Task.user_id == user_id, Task.done.is_(False), Task.due < now + timedelta(days=7))
+        .group_by(window)
+    )
+    windows = dict(result.all())
+    return ApiResponse({
+        "total": counters.task_count,
+        "done": counters.done_count,
+        "open": counters.task_count - counters.done_count,
+        "overdue": windows.get("overdue", 0),
+        "due_this_week": windows.get("due_this_week", 0),
+    })
+
+# EXPORT EVERY TASK OF A USER (streamed, constant memory)
+EXPORT_COLUMNS = (Task.id, Task.user_id, Task.task, Task.due, Task.done, Task.created)
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def _export_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+def _encode_ndjson(rows) -> bytes:
+    return b"".join(orjson.dumps(dict(row._mapping), option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+def _encode_csv(rows) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_export_value(value) for value in row] for row in rows)
+    return buffer.getvalue().encode()
+
+@router.get("/{user_id}/tasks/export")
+async def api_export_user_tasks(user_id: int, db: Annotated[AsyncSession, Depends(get_read_db)], format: Literal["ndjson", "csv"] = "ndjson"):
+    result = await db.execute(select(User.id).where(User.id == user_id))
+    if result.scalar() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    # Plain columns through a server-side cursor: rows are fetched, encoded and sent
+    # export_chunk_size at a time instead of being materialized as ORM objects
+    stmt = (
+        select(*EXPORT_COLUMNS)
+        .where(Task.user_id == user_id)
+        .order_by(Task.created, Task.id)
+        .execution_options(yield_per=settings.export_chunk_size)
+    )
+    encode = _encode_csv if format == "csv" else _encode_ndjson
+
+    async def chunks():
+        if format == "csv":
+            yield _encode_csv([[column.key for column in EXPORT_COLUMNS]])
+        result = await db.stream(stmt)
+        async for partition in result.partitions():
+            yield encode(partition)
+
+    return StreamingResponse(
+        chunks(),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="user-{user_id}-tasks.{format}"'},
+    )
 
 # DELETE USER
 @router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def api_delete_user(user_id: int, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)]):
+async def api_delete_user(user_id: int, current_user: CurrentUser, db: Annotated[AsyncSession, Depends(get_db)], if_match: Annotated[str | None, Header()] = None):
     if user_id != current_user.id:
          raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
     
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalars().first()
+    # Locks the users row first, the lock order every task write uses, and checks If-Match in the
+    # same statement. Then tombstones and both DELETEs are one statement each, however many tasks
+    criteria = [User.id == user_id]
+    versions = versions_from_if_match(if_match) if if_match is not None else None
+    if versions is not None:
+        criteria.append(User.version.in_([version[0] for version in versions if len(version) == 1]))
+    stmt = update(User).where(*criteria).values(version=User.version + 1).returning(User.id).execution_options(synchronize_session=False)
+    if (await db.execute(stmt)).scalar() is None:
+        exists = (await db.execute(select(User.id).where(User.id == user_id))).scalar()
+        if exists is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        precondition_failed("User was modified by another request")
 
-    if not user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    
-    await db.delete(user)
+    task_ids = await delete_user_tasks(db, user_id)
+    await db.execute(delete(User).where(User.id == user_id).execution_options(synchronize_session=False))
     await db.commit()
+    token_cache.invalidate_user(user_id)
+    await response_cache.invalidate(user_cache_key(user_id), *(task_cache_key(task_id) for task_id in task_ids))
     return {"Message": "User and tasks deleted"}
\ No newline at end of file
@@ -0,0 +1,140 @@
+from sqlalchemy import delete, func, insert, inspect, select, text, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from crud import rebuild_task_counters
+from database import Base
+from models import POSTGRES_SEARCH_DDL, SCHEMA_VERSION, SQLITE_SEARCH_DDL, SchemaVersion, Task
+
+# Schema creation is an explicit step (python manage.py create-schema), run once per deploy.
+# Workers only compare the stamped version with the one this build expects: one indexed read
+# instead of create_all's reflection round trips on every boot.
+#
+# create_all only adds missing tables, so create_schema also upgrades tables made by earlier
+# builds (columns, indexes, search), then checks the live schema against the models and only
+# stamps the version when nothing is missing
+
+
+class SchemaMismatch(RuntimeError):
+    pass
+
+
+# Columns added to tables that already existed, with the value existing rows get
+ADDED_COLUMNS = {
+    # Row versions behind ETags
+    ("users", "version"): "1",
+    ("tasklist", "version"): "1",
+    # Task counters; recounted from tasklist right after
+    ("users", "task_count"): "0",
+    ("users", "done_count"): "0",
+    # Delta sync; copied from created right after
+    ("tasklist", "updated_at"): "'1970-01-01 00:00:00'",
+}
+
+# Indexes earlier builds created that are now covered by others
+OBSOLETE_INDEXES = (
+    # The per-user composite listing indexes all start with user_id
+    ("tasklist", "ix_tasklist_user_id"),
+)
+
+
+def _index_names(sync_conn, table_name: str) -> set[str]:
+    if sync_conn.dialect.name == "sqlite":
+        # SQLAlchemy skips expression indexes when reflecting SQLite, so ask sqlite_master
+        rows = sync_conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"), {"table": table_name})
+        return set(rows.scalars())
+    return {index["name"] for index in inspect(sync_conn).get_indexes(table_name)}
+
+
+def _has_search(sync_conn) -> bool:
+    inspector = inspect(sync_conn)
+    if sync_conn.dialect.name == "postgresql":
+        return "search_vector" in {column["name"] for column in inspector.get_columns("tasklist")}
+    return inspector.has_table("tasklist_fts")
+
+
+def _add_columns(sync_conn) -> list[tuple[str, str]]:
+    inspector = inspect(sync_conn)
+    preparer = sync_conn.dialect.identifier_preparer
+    added = []
+    for (table_name, column_name), default in ADDED_COLUMNS.items():
+        if column_name in {column["name"] for column in inspector.get_columns(table_name)}:
+            continue
+        column_type = Base.metadata.tables[table_name].c[column_name].type.compile(dialect=sync_conn.dialect)
+        sync_conn.execute(text(
+            f"ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(column_name)} {column_type} NOT NULL DEFAULT {default}"
+        ))
+        added.append((table_name, column_name))
+    return added
+
+
+def _upgrade_indexes_and_search(sync_conn) -> None:
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        existing = _index_names(sync_conn, table.name)
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            # An index over a column no step added is left for _missing to report
+            if index.name not in existing and {column.name for column in index.columns} <= columns:
+                index.create(sync_conn)
+    for table_name, index_name in OBSOLETE_INDEXES:
+        if index_name in _index_names(sync_conn, table_name):
+            sync_conn.execute(text(f"DROP INDEX {index_name}"))
+    if sync_conn.dialect.name == "postgresql":
+        # Replaced by ux_users_username_lower; SQLite can't drop it without rebuilding the table,
+        # and there it is harmless (anything it rejects, the lower() index rejects too)
+        sync_conn.execute(text("ALTER TABLE users DROP CONSTRAINT IF EXISTS users_username_key"))
+
+    if not _has_search(sync_conn):
+        # The generated Postgres column fills itself; the SQLite FTS table is filled here
+        for statement in POSTGRES_SEARCH_DDL if sync_conn.dialect.name == "postgresql" else SQLITE_SEARCH_DDL:
+            sync_conn.execute(text(statement))
+        if sync_conn.dialect.name == "sqlite":
+            sync_conn.execute(text("INSERT INTO tasklist_fts(rowid, task, owner) SELECT id, task, 'u' || user_id FROM tasklist"))
+
+
+def _missing(sync_conn) -> list[str]:
+    # Whatever the models expect that the live database still lacks
+    inspector = inspect(sync_conn)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            missing.append(f"table {table.name}")
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing += [f"column {table.name}.{column.name}" for column in table.columns if column.name not in columns]
+        indexes = _index_names(sync_conn, table.name)
+        missing += [f"index {index.name}" for index in table.indexes if index.name not in indexes]
+    if not _has_search(sync_conn):
+        missing.append("task search index")
+    return missing
+
+
+async def create_schema(conn: AsyncConnection) -> None:
+    await conn.run_sync(Base.metadata.create_all)
+    added = await conn.run_sync(_add_columns)
+    if ("users", "task_count") in added:
+        await rebuild_task_counters(conn)
+    if ("tasklist", "updated_at") in added:
+        await conn.execute(update(Task).values(updated_at=func.coalesce(Task.created, func.now())))
+    await conn.run_sync(_upgrade_indexes_and_search)
+
+    missing = await conn.run_sync(_missing)
+    if missing:
+        # Raising rolls the transaction back, so the old stamp (if any) stays
+        raise SchemaMismatch(f"Database schema does not match this build, missing: {', '.join(missing)}")
+    await conn.execute(delete(SchemaVersion))
+    await conn.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION))
+
+
+async def check_schema(conn: AsyncConnection) -> None:
+    try:
+        found = (await conn.execute(select(func.max(SchemaVersion.version)))).scalar()
+    except DBAPIError:
+        # No schema_version table: the schema was never created by this build's command
+        found = None
+    if found != SCHEMA_VERSION:
+        raise SchemaMismatch(
+            f"Database schema version is {found}, this build expects {SCHEMA_VERSION}; "
+            "run `python manage.py create-schema`"
+        )
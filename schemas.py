@@ -1,6 +1,8 @@
-from pydantic import BaseModel, ConfigDict, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, field_validator
 from datetime import datetime
 
+from config import settings
+
 
 class UserBase(BaseModel):
     username: str = Field(min_length=1, max_length=50)
@@ -28,6 +30,10 @@ class UserUpdate(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str
+
+class TokenRefresh(BaseModel):
+    refresh_token: str = Field(min_length=1, max_length=200)
 
 # This is shared for creating and returning tasks
 class TaskBase(BaseModel):
@@ -54,3 +60,61 @@ class TaskResponse(TaskBase):
     user_id: int
     created: datetime
     author: UserPublic
+
+
+# A page of tasks; pass next_cursor back as ?after= to get the following page
+class TaskPage(BaseModel):
+    items: list[TaskResponse]
+    next_cursor: str | None
+
+
+# Delta sync: apply items (upserts by id), then drop the deleted ids; call again while has_more
+class TaskChanges(BaseModel):
+    items: list[TaskResponse]
+    deleted: list[int]
+    next_cursor: str
+    has_more: bool
+
+
+# Per-user task aggregates; due_this_week counts unfinished tasks due in the next 7 days
+class TaskStats(BaseModel):
+    total: int
+    done: int
+    open: int
+    overdue: int
+    due_this_week: int
+
+
+# Batch operations: every item gets its own result so one bad id doesn't fail the whole batch
+class TaskBatchCreate(BaseModel):
+    items: list[TaskCreate] = Field(min_length=1, max_length=settings.batch_max_items)
+
+class TaskBatchUpdateItem(TaskUpdate):
+    id: int
+
+    # The batch UPDATE would write them into NOT NULL columns and fail every item with a 500
+    @field_validator("task", "done")
+    @classmethod
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError("May be omitted, but not null")
+        return value
+
+class TaskBatchUpdate(BaseModel):
+    items: list[TaskBatchUpdateItem] = Field(min_length=1, max_length=settings.batch_max_items)
+
+    @field_validator("items")
+    @classmethod
+    def unique_ids(cls, items: list[TaskBatchUpdateItem]) -> list[TaskBatchUpdateItem]:
+        if len({item.id for item in items}) != len(items):
+            raise ValueError("Each task id may appear only once per batch")
+        return items
+
+class TaskBatchResult(BaseModel):
+    id: int
+    status: int
+    task: TaskResponse | None = None
+    detail: str | None = None
+
+class TaskBatchResponse(BaseModel):
+    results: list[TaskBatchResult]
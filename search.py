@@ -0,0 +1,96 @@
+import re
+
+from fastapi import HTTPException, status
+from sqlalchemy import column, func, literal_column, or_, select, table, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud import TASK_COLUMNS
+from models import SEARCH_CONFIG, Task
+from pagination import pack_cursor, unpack_cursor
+
+# Ranked, per-user full-text search over Task.task, paginated by (rank, id) like the listings.
+# The index behind it is dialect specific (see the end of models.py)
+
+# SQLite FTS5 table; "rank" is the bm25 score configured on it (lower is better)
+tasklist_fts = table("tasklist_fts", column("rowid"), column("rank"))
+
+WORD = re.compile(r"\w+")
+
+
+def _fts5_query(q: str, user_id: int) -> str | None:
+    # Free text -> an FTS5 expression. Every word is quoted, so user input can't use FTS5 syntax,
+    # and the words are limited to the task column so they can never match an owner token
+    words = WORD.findall(q)
+    if not words:
+        return None
+    terms = " AND ".join(f'"{word}"' for word in words)
+    return f"owner : u{user_id} AND task : ({terms})"
+
+
+def _search_statement(dialect: str, q: str, user_id: int):
+    # Returns (statement, score expression, descending) or None when q has nothing to search for
+    if dialect == "postgresql":
+        query = func.plainto_tsquery(SEARCH_CONFIG, q)
+        vector = literal_column("tasklist.search_vector")
+        score = func.ts_rank_cd(vector, query)
+        stmt = select(*TASK_COLUMNS, score.label("score")).where(Task.user_id == user_id, vector.op("@@")(query))
+        return stmt, score, True
+
+    match = _fts5_query(q, user_id)
+    if match is None:
+        return None
+    score = tasklist_fts.c.rank
+    stmt = (
+        select(*TASK_COLUMNS, score.label("score"))
+        .select_from(tasklist_fts)
+        .join(Task, Task.id == tasklist_fts.c.rowid)
+        .where(literal_column("tasklist_fts").op("MATCH")(match))
+    )
+    return stmt, score, False
+
+
+def _decode_search_cursor(cursor: str) -> tuple[float, int]:
+    parts = unpack_cursor(cursor)
+    try:
+        kind, score, task_id = parts
+        if kind != "search":
+            raise ValueError("cursor was not issued by search")
+        return float(score), int(task_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+async def search_tasks(db: AsyncSession, user_id: int, q: str, limit: int, after: str | None = None) -> tuple[list, str | None]:
+    built = _search_statement(db.get_bind().dialect.name, q, user_id)
+    if built is None:
+        return [], None
+    stmt, score, descending = built
+
+    if after is not None:
+        last_score, last_id = _decode_search_cursor(after)
+        if descending:
+            stmt = stmt.where(or_(score < last_score, (score == last_score) & (Task.id > last_id)))
+        else:
+            stmt = stmt.where(tuple_(score, Task.id) > (last_score, last_id))
+    stmt = stmt.order_by(score.desc() if descending else score, Task.id).limit(limit + 1)
+
+    rows = (await db.execute(stmt)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = pack_cursor("search", rows[-1].score, rows[-1].id)
+    return rows, next_cursor
+
+
+async def rebuild_search_index(db: AsyncSession) -> None:
+    # For databases created before search existed (create_all never alters a table) or whose index
+    # drifted. Idempotent; on SQLite the FTS table must already exist
+    if db.get_bind().dialect.name == "postgresql":
+        await db.execute(text(
+            "ALTER TABLE tasklist ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', task)) STORED"
+        ))
+        await db.execute(text("CREATE INDEX IF NOT EXISTS ix_tasklist_search_vector ON tasklist USING gin (search_vector)"))
+        return
+    await db.execute(text("INSERT INTO tasklist_fts(tasklist_fts) VALUES ('delete-all')"))
+    await db.execute(text("INSERT INTO tasklist_fts(rowid, task, owner) SELECT id, task, 'u' || user_id FROM tasklist"))
@@ -0,0 +1,95 @@
+from datetime import UTC, datetime, timedelta
+
+from fastapi import HTTPException, status
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from fieldsets import TaskFieldset
+from models import Task, TaskTombstone
+from pagination import pack_cursor, unpack_cursor
+
+# Delta sync: GET /api/tasks/changes returns the tasks written and the tasks deleted since a
+# cursor. Both come from an index range scan, on (updated_at, id) over tasklist and on
+# (deleted_at, id) over task_tombstones, so a sync costs the number of changes, not the table size.
+# The cursor holds one (timestamp, id) position per stream
+
+Position = tuple[datetime, int]
+
+
+def _utc(value: datetime) -> datetime:
+    # SQLite hands datetimes back naive; they are UTC
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value
+
+
+def settled_position() -> Position:
+    # A transaction can commit after others that started later, with an older timestamp. A sync
+    # that ends "now" would skip its rows, so a finished sync resumes sync_settle_seconds back and
+    # the client sees those recent rows twice (applying a change is idempotent)
+    return datetime.now(UTC) - timedelta(seconds=settings.sync_settle_seconds), 0
+
+
+def encode_sync_cursor(tasks: Position, tombstones: Position) -> str:
+    return pack_cursor("changes", tasks[0].isoformat(), tasks[1], tombstones[0].isoformat(), tombstones[1])
+
+
+def decode_sync_cursor(cursor: str) -> tuple[Position, Position]:
+    parts = unpack_cursor(cursor)
+    try:
+        kind, task_at, task_id, tombstone_at, tombstone_id = parts
+        if kind != "changes":
+            raise ValueError("cursor was not issued by the changes feed")
+        return (_utc(datetime.fromisoformat(task_at)), int(task_id)), (_utc(datetime.fromisoformat(tombstone_at)), int(tombstone_id))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def _advance(start: Position, rows: list, limit: int, position) -> tuple[list, Position, bool]:
+    # Returns the rows to send, where the next sync resumes and whether more rows are waiting
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, position(rows[-1]), True
+    return rows, max(start, settled_position()), False
+
+
+async def task_changes(db: AsyncSession, fieldset: TaskFieldset, since: str | None, limit: int) -> dict:
+    if since is None:
+        # First sync: take a cursor, then download GET /api/tasks; nothing written after the cursor is lost
+        start = settled_position()
+        return {"items": [], "deleted": [], "next_cursor": encode_sync_cursor(start, start), "has_more": False}
+
+    task_start, tombstone_start = decode_sync_cursor(since)
+    if tombstone_start[0] < datetime.now(UTC) - timedelta(days=settings.tombstone_retention_days):
+        # Deletes from before the retention window may already be compacted away
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Cursor expired; download the task list again and start over with a new cursor")
+
+    stmt = (
+        fieldset.loader_options(select(Task), Task.updated_at)
+        .where(tuple_(Task.updated_at, Task.id) > task_start)
+        .order_by(Task.updated_at, Task.id)
+        .limit(limit + 1)
+    )
+    tasks = list((await db.execute(stmt)).scalars().all())
+    stmt = (
+        select(TaskTombstone.id, TaskTombstone.task_id, TaskTombstone.deleted_at)
+        .where(tuple_(TaskTombstone.deleted_at, TaskTombstone.id) > tombstone_start)
+        .order_by(TaskTombstone.deleted_at, TaskTombstone.id)
+        .limit(limit + 1)
+    )
+    tombstones = (await db.execute(stmt)).all()
+
+    tasks, task_end, more_tasks = _advance(task_start, tasks, limit, lambda task: (_utc(task.updated_at), task.id))
+    tombstones, tombstone_end, more_tombstones = _advance(tombstone_start, tombstones, limit, lambda row: (_utc(row.deleted_at), row.id))
+    return {
+        "items": fieldset.payloads(tasks),
+        "deleted": [row.task_id for row in tombstones],
+        "next_cursor": encode_sync_cursor(task_end, tombstone_end),
+        "has_more": more_tasks or more_tombstones,
+    }
+
+
+async def compact_tombstones(db: AsyncSession) -> int:
+    # Returns how many tombstones were older than the retention window
+    cutoff = datetime.now(UTC) - timedelta(days=settings.tombstone_retention_days)
+    result = await db.execute(delete(TaskTombstone).where(TaskTombstone.deleted_at < cutoff))
+    return result.rowcount
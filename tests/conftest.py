@@ -4,14 +4,26 @@ import os
 os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///./test.db"
 # Provide a fallback so tests run in CI without a .env file
 os.environ.setdefault("SECRET_KEY", "ci-test-only-key-not-used-in-production-abc")
-
+# Any request that runs more statements than this fails the test (catches N+1 regressions)
+os.environ["QUERY_BUDGET"] = "5"
+os.environ["QUERY_BUDGET_STRICT"] = "true"
+os.environ["OPS_TOKEN"] = "ops-test-token"
+# create_all never alters existing tables, so start from a fresh file to pick up model changes
+if os.path.exists("./test.db"):
+    os.remove("./test.db")
+
+import pytest
 import pytest_asyncio
 from httpx import AsyncClient, ASGITransport
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database import engine, AsyncSessionLocal, Base, get_db
+from database import engine, AsyncSessionLocal, Base, get_db, get_read_db, read_pins
 from main import app
-from auth import hash_password
+from auth import hash_password, token_cache
+from cache import response_cache
+from ratelimit import limiter
+from crud import count_created_tasks
 from models import User, Task
 
 
@@ -21,18 +33,43 @@ async def override_get_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+# Tests have no replicas; the replica routing tests drop this override
+app.dependency_overrides[get_read_db] = override_get_db
 
 
 @pytest_asyncio.fixture(autouse=True)
 async def reset_database():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    # Row ids are reused after the tables are emptied, so cached principals must not leak between tests
+    token_cache.clear()
+    await response_cache.clear()
+    read_pins.clear()
+    await limiter.clear()
     yield
     async with engine.begin() as conn:
         for table in reversed(Base.metadata.sorted_tables):
             await conn.execute(table.delete())
 
 
+@pytest.fixture
+def query_counter():
+    # Records every SQL statement sent to the database while the test runs
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+
+@pytest.fixture
+def ops_headers():
+    return {"X-Ops-Token": "ops-test-token"}
+
+
 @pytest_asyncio.fixture
 async def client():
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
@@ -99,6 +136,8 @@ async def test_task(db_session: AsyncSession, test_user: User):
         done=False,
     )
     db_session.add(task)
+    # Keep the owner's task counters in step, as the API does
+    await count_created_tasks(db_session, test_user.id, [task.done])
     await db_session.commit()
     await db_session.refresh(task)
     return task
@@ -1,9 +1,10 @@
+import time
 from datetime import timedelta
 
 import pytest
 from httpx import AsyncClient
 
-from auth import create_access_token
+from auth import Principal, PrincipalCache, create_access_token, password_pool, verify_password_async
 
 
 class TestLogin:
@@ -52,6 +53,19 @@ class TestLogin:
         )
         assert response.status_code == 422
 
+    async def test_login_sheds_load_when_hash_pool_full(self, client: AsyncClient, test_user, monkeypatch):
+        monkeypatch.setattr(password_pool, "max_pending", 0)
+        response = await client.post(
+            "/api/users/token",
+            data={"username": "test@example.com", "password": "password123"},
+        )
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(password_pool.retry_after)
+
+    async def test_verify_password_async(self, test_user):
+        assert await verify_password_async("password123", test_user.password_hash) is True
+        assert await verify_password_async("wrongpassword", test_user.password_hash) is False
+
 
 class TestTokenValidation:
     async def test_invalid_token(self, client: AsyncClient):
@@ -82,3 +96,125 @@ class TestTokenValidation:
             headers={"Authorization": f"Bearer {token}"},
         )
         assert response.status_code == 401
+
+
+class TestTokenCache:
+    async def test_repeat_requests_hit_cache(self, client: AsyncClient, auth_headers, ops_headers):
+        await client.get("/api/users/me", headers=auth_headers)
+        await client.get("/api/users/me", headers=auth_headers)
+        stats = (await client.get("/api/ops/stats", headers=ops_headers)).json()["token_cache"]
+        assert stats["misses"] == 1
+        assert stats["hits"] == 1
+        assert stats["size"] == 1
+
+    async def test_update_invalidates_cached_user(self, client: AsyncClient, test_user, auth_headers):
+        await client.get("/api/users/me", headers=auth_headers)
+        await client.patch(f"/api/users/{test_user.id}", json={"username": "renamed"}, headers=auth_headers)
+        response = await client.get("/api/users/me", headers=auth_headers)
+        assert response.json()["username"] == "renamed"
+
+    async def test_delete_invalidates_cached_user(self, client: AsyncClient, test_user, auth_headers):
+        await client.get("/api/users/me", headers=auth_headers)
+        await client.delete(f"/api/users/{test_user.id}", headers=auth_headers)
+        response = await client.get("/api/users/me", headers=auth_headers)
+        assert response.status_code == 401
+
+    def test_entry_never_outlives_token(self):
+        cache = PrincipalCache(maxsize=10, ttl=60)
+        principal = Principal(id=1, username="u", email="u@example.com", image_file=None, version=1)
+        cache.set("expired", {"sub": "1", "exp": time.time() - 1}, principal)
+        assert cache.get("expired") is None
+
+    def test_bounded_size(self):
+        cache = PrincipalCache(maxsize=2, ttl=60)
+        claims = {"sub": "1", "exp": time.time() + 60}
+        for token in ("a", "b", "c"):
+            cache.set(token, claims, Principal(id=1, username="u", email="u@example.com", image_file=None, version=1))
+        assert cache.get("a") is None
+        assert cache.get("c") is not None
+        assert cache.stats()["evictions"] == 1
+
+
+class TestRefreshTokens:
+    async def login(self, client: AsyncClient) -> dict:
+        response = await client.post("/api/users/token", data={"username": "test@example.com", "password": "password123"})
+        assert response.status_code == 200
+        return response.json()
+
+    async def refresh(self, client: AsyncClient, refresh_token: str):
+        return await client.post("/api/users/token/refresh", json={"refresh_token": refresh_token})
+
+    async def test_refresh_rotates_without_password_hashing(self, client: AsyncClient, test_user, monkeypatch):
+        tokens = await self.login(client)
+
+        async def no_hashing(*args):
+            raise AssertionError("refresh must not hash passwords")
+
+        monkeypatch.setattr(password_pool, "run", no_hashing)
+        response = await self.refresh(client, tokens["refresh_token"])
+        assert response.status_code == 200
+        data = response.json()
+        assert data["token_type"] == "bearer"
+        assert data["refresh_token"] != tokens["refresh_token"]
+        me = await client.get("/api/users/me", headers={"Authorization": f"Bearer {data['access_token']}"})
+        assert me.json()["id"] == test_user.id
+        # The next token in the family works too
+        assert (await self.refresh(client, data["refresh_token"])).status_code == 200
+
+    async def test_refresh_is_two_statements(self, client: AsyncClient, test_user, query_counter):
+        tokens = await self.login(client)
+        query_counter.clear()
+        assert (await self.refresh(client, tokens["refresh_token"])).status_code == 200
+        assert len(query_counter) == 2
+
+    async def test_only_the_hash_is_stored(self, client: AsyncClient, test_user, db_session):
+        from sqlalchemy import select
+
+        from auth import hash_refresh_token
+        from models import RefreshToken
+
+        tokens = await self.login(client)
+        stored = (await db_session.execute(select(RefreshToken.token_hash))).scalars().all()
+        assert stored == [hash_refresh_token(tokens["refresh_token"])]
+
+    async def test_reuse_revokes_the_family(self, client: AsyncClient, test_user):
+        first = await self.login(client)
+        other_device = await self.login(client)
+        second = (await self.refresh(client, first["refresh_token"])).json()
+        # The old token shows up again: someone copied it
+        response = await self.refresh(client, first["refresh_token"])
+        assert response.status_code == 401
+        assert (await self.refresh(client, second["refresh_token"])).status_code == 401
+        # Other logins are separate families
+        assert (await self.refresh(client, other_device["refresh_token"])).status_code == 200
+
+    async def test_revoke_logs_the_family_out(self, client: AsyncClient, test_user):
+        first = await self.login(client)
+        second = (await self.refresh(client, first["refresh_token"])).json()
+        response = await client.post("/api/users/token/revoke", json={"refresh_token": first["refresh_token"]})
+        assert response.status_code == 204
+        assert (await self.refresh(client, second["refresh_token"])).status_code == 401
+        # Unknown tokens are accepted and change nothing
+        response = await client.post("/api/users/token/revoke", json={"refresh_token": "unknown"})
+        assert response.status_code == 204
+
+    async def test_expired_and_unknown_tokens_are_rejected(self, client: AsyncClient, test_user, db_session, monkeypatch):
+        from auth import prune_refresh_tokens
+        from config import settings
+
+        monkeypatch.setattr(settings, "refresh_token_expire_days", -1)
+        tokens = await self.login(client)
+        assert (await self.refresh(client, tokens["refresh_token"])).status_code == 401
+        assert (await self.refresh(client, "not-a-token")).status_code == 401
+        assert await prune_refresh_tokens(db_session) == 1
+
+    async def test_deleting_the_user_removes_its_tokens(self, client: AsyncClient, test_user, db_session):
+        from sqlalchemy import func, select
+
+        from models import RefreshToken
+
+        tokens = await self.login(client)
+        headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+        assert (await client.delete(f"/api/users/{test_user.id}", headers=headers)).status_code == 204
+        assert (await db_session.execute(select(func.count()).select_from(RefreshToken))).scalar() == 0
+        assert (await self.refresh(client, tokens["refresh_token"])).status_code == 401
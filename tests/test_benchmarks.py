@@ -0,0 +1,26 @@
+from benchmarks.bench_endpoints import compare, percentile, summarize
+
+
+class TestBenchmarkReport:
+    def test_percentiles(self):
+        samples = [i / 1000 for i in range(1, 101)]
+        stats = summarize(samples, wall_time=2.0, errors=0)
+        assert stats["p50_ms"] == 50
+        assert stats["p95_ms"] == 95
+        assert stats["p99_ms"] == 99
+        assert stats["throughput_rps"] == 50
+        assert percentile([], 95) == 0.0
+
+    def test_compare_flags_slowdowns_past_tolerance(self):
+        baseline = {"routes": {"GET /api/tasks": {"p95_ms": 10.0, "errors": 0}, "POST /api/tasks": {"p95_ms": 10.0, "errors": 0}}}
+        results = {"routes": {"GET /api/tasks": {"p95_ms": 12.0, "errors": 0}, "POST /api/tasks": {"p95_ms": 13.0, "errors": 0}}}
+        regressions = compare(results, baseline, tolerance=0.25)
+        assert len(regressions) == 1
+        assert regressions[0].startswith("POST /api/tasks")
+
+    def test_compare_flags_new_errors_and_missing_routes(self):
+        baseline = {"routes": {"GET /api/tasks": {"p95_ms": 10.0, "errors": 0}, "GET /api/users/me": {"p95_ms": 1.0, "errors": 0}}}
+        results = {"routes": {"GET /api/tasks": {"p95_ms": 5.0, "errors": 3}}}
+        regressions = compare(results, baseline, tolerance=0.25)
+        assert any("3 errors" in message for message in regressions)
+        assert any("GET /api/users/me: missing" in message for message in regressions)
@@ -0,0 +1,376 @@
+import os
+import subprocess
+import sys
+from datetime import timedelta
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy import event, text
+
+import database
+from database import ReplicaSet, ReadPins, engine, engine_options, get_read_db
+from main import app
+from ratelimit import Limit
+from schema import SchemaMismatch, create_schema
+
+
+class TestOpsAccess:
+    @pytest.mark.parametrize("path", ["/api/ops/stats", "/api/ops/pool", "/api/ops/startup"])
+    async def test_ops_routes_need_the_token(self, client: AsyncClient, path):
+        assert (await client.get(path)).status_code == 401
+        assert (await client.get(path, headers={"X-Ops-Token": "wrong"})).status_code == 401
+
+    async def test_ops_routes_are_off_without_a_token(self, client: AsyncClient, ops_headers, monkeypatch):
+        from config import settings
+
+        monkeypatch.setattr(settings, "ops_token", None)
+        assert (await client.get("/api/ops/stats", headers=ops_headers)).status_code == 404
+
+
+class TestPoolStats:
+    async def test_pool_stats_report_saturation(self, client: AsyncClient, test_task, ops_headers):
+        await client.get("/api/tasks")
+        response = await client.get("/api/ops/pool", headers=ops_headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert {"size", "checked_out", "idle", "overflow", "max_overflow", "wait_avg_ms", "wait_p95_ms", "wait_max_ms"} <= set(data)
+        assert data["acquisitions"] > 0
+
+    def test_pgbouncer_mode_disables_prepared_statements(self, monkeypatch):
+        from config import settings
+
+        monkeypatch.setattr(settings, "db_pgbouncer_mode", True)
+        connect_args = engine_options("postgresql+asyncpg://u:p@host/db")["connect_args"]
+        assert connect_args["statement_cache_size"] == 0
+        assert connect_args["prepared_statement_cache_size"] == 0
+        assert connect_args["prepared_statement_name_func"]() != connect_args["prepared_statement_name_func"]()
+
+    def test_statement_cache_size_is_configurable(self, monkeypatch):
+        from config import settings
+
+        monkeypatch.setattr(settings, "db_statement_cache_size", 500)
+        connect_args = engine_options("postgresql+asyncpg://u:p@host/db")["connect_args"]
+        assert connect_args == {"prepared_statement_cache_size": 500}
+
+    def test_sqlite_gets_no_asyncpg_arguments(self):
+        assert "connect_args" not in engine_options("sqlite+aiosqlite:///./test.db")
+
+    def test_file_databases_get_the_instrumented_pool(self):
+        for url in ("postgresql+asyncpg://u:p@host/db", "sqlite+aiosqlite:///./test.db"):
+            assert engine_options(url)["poolclass"] is database.InstrumentedPool
+
+    @pytest.mark.parametrize("url", ["sqlite+aiosqlite://", "sqlite+aiosqlite:///:memory:"])
+    async def test_memory_sqlite_keeps_one_database(self, url):
+        # Every session must see the same in-memory database, so the dialect's StaticPool stays
+        memory = database._create_engine(url)
+        try:
+            assert "poolclass" not in engine_options(url)
+            async with memory.begin() as conn:
+                await conn.execute(text("CREATE TABLE probe (id INTEGER)"))
+            async with memory.connect() as first, memory.connect() as second:
+                for conn in (first, second):
+                    assert (await conn.execute(text("SELECT count(*) FROM probe"))).scalar() == 0
+            assert database._pool_stats(memory) == {"pool": "StaticPool"}
+        finally:
+            await memory.dispose()
+
+
+class TestServerTiming:
+    async def test_server_timing_header(self, client: AsyncClient, auth_headers):
+        response = await client.get("/api/users/me", headers=auth_headers)
+        assert response.status_code == 200
+        metrics = {metric.split(";")[0]: metric for metric in response.headers["Server-Timing"].split(", ")}
+        assert {"db", "auth", "total"} <= set(metrics)
+        assert 'desc="1 queries"' in metrics["db"]
+
+    async def test_cached_principal_runs_no_queries(self, client: AsyncClient, auth_headers):
+        await client.get("/api/users/me", headers=auth_headers)
+        response = await client.get("/api/users/me", headers=auth_headers)
+        assert 'desc="0 queries"' in response.headers["Server-Timing"]
+
+    async def test_strict_budget_fails_request(self, client: AsyncClient, test_task, monkeypatch):
+        from config import settings
+        from timing import QueryBudgetExceeded
+
+        monkeypatch.setattr(settings, "query_budget", 1)
+        with pytest.raises(QueryBudgetExceeded, match="GET /api/tasks ran 2 statements"):
+            await client.get("/api/tasks")
+
+    async def test_budget_is_only_logged_when_not_strict(self, client: AsyncClient, test_task, monkeypatch, caplog):
+        from config import settings
+
+        monkeypatch.setattr(settings, "query_budget", 1)
+        monkeypatch.setattr(settings, "query_budget_strict", False)
+        with caplog.at_level("WARNING", logger="taskmanager.timing"):
+            response = await client.get("/api/tasks")
+        assert response.status_code == 200
+        assert "budget 1" in caplog.text
+
+    async def test_debug_record(self, client: AsyncClient, caplog):
+        with caplog.at_level("DEBUG", logger="taskmanager.timing"):
+            await client.get("/api/tasks")
+        record = next(record for record in caplog.records if record.message == "request timing")
+        assert record.timing["path"] == "/api/tasks"
+        assert record.timing["status"] == 200
+        assert record.timing["queries"] >= 1
+
+
+class TestStartup:
+    async def test_startup_refuses_unstamped_schema(self):
+        # The fixtures create the tables with create_all, which leaves schema_version empty
+        with pytest.raises(SchemaMismatch, match="manage.py create-schema"):
+            async with app.router.lifespan_context(app):
+                pass
+
+    async def test_startup_reports_cold_start(self, client: AsyncClient, ops_headers):
+        async with engine.begin() as conn:
+            await create_schema(conn)
+        async with app.router.lifespan_context(app):
+            response = await client.get("/api/ops/startup", headers=ops_headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["api_only"] is False
+        assert 0 < data["import_ms"] <= data["ready_ms"]
+
+    @pytest.fixture
+    async def baseline_engine(self, tmp_path):
+        # A database as the first release's create_all left it, with some data
+        baseline = database._create_engine(f"sqlite+aiosqlite:///{tmp_path}/baseline.db")
+        async with baseline.begin() as conn:
+            for statement in (
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(50) NOT NULL UNIQUE, email VARCHAR(120) NOT NULL UNIQUE, password_hash VARCHAR(200) NOT NULL, image_file VARCHAR(200))",
+                "CREATE INDEX ix_users_id ON users (id)",
+                "CREATE TABLE tasklist (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), task VARCHAR(100) NOT NULL, created DATETIME, due DATETIME, done BOOLEAN NOT NULL)",
+                "CREATE INDEX ix_tasklist_id ON tasklist (id)",
+                "CREATE INDEX ix_tasklist_user_id ON tasklist (user_id)",
+                "INSERT INTO users VALUES (1, 'old', 'old@example.com', 'x', NULL)",
+                "INSERT INTO tasklist VALUES (1, 1, 'Water the plants', '2026-01-01 10:00:00.000000', NULL, 1)",
+                "INSERT INTO tasklist VALUES (2, 1, 'Buy paint', '2026-01-02 10:00:00.000000', NULL, 0)",
+            ):
+                await conn.exec_driver_sql(statement)
+        yield baseline
+        await baseline.dispose()
+
+    async def test_create_schema_upgrades_a_baseline_database(self, baseline_engine):
+        from sqlalchemy import select, text
+
+        from models import Task, User
+        from schema import check_schema
+
+        async with baseline_engine.begin() as conn:
+            await create_schema(conn)
+        async with baseline_engine.begin() as conn:
+            await check_schema(conn)
+            user = (await conn.execute(select(User.version, User.task_count, User.done_count))).one()
+            assert tuple(user) == (1, 2, 1)
+            updated = (await conn.execute(select(Task.updated_at).order_by(Task.id))).scalars().all()
+            assert [value.date().isoformat() for value in updated] == ["2026-01-01", "2026-01-02"]
+            found = (await conn.execute(text("SELECT rowid FROM tasklist_fts WHERE tasklist_fts MATCH 'paint'"))).scalars().all()
+            assert found == [2]
+            indexes = (await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))).scalars().all()
+            assert "ux_users_username_lower" in indexes and "ix_tasklist_user_done_due_id" in indexes
+            assert "ix_tasklist_user_id" not in indexes
+            # Writes that need the new columns work, and a second run changes nothing
+            await conn.execute(text("INSERT INTO users (username, email, password_hash) VALUES ('new', 'new@example.com', 'x')"))
+            await create_schema(conn)
+
+    async def test_create_schema_refuses_to_stamp_what_it_cannot_fix(self, baseline_engine):
+        from schema import check_schema
+
+        async with baseline_engine.begin() as conn:
+            # A table this build knows, with a column no upgrade step adds
+            await conn.exec_driver_sql("CREATE TABLE idempotency_keys (user_id INTEGER, key VARCHAR(255), PRIMARY KEY (user_id, key))")
+        with pytest.raises(SchemaMismatch, match="idempotency_keys.fingerprint"):
+            async with baseline_engine.begin() as conn:
+                await create_schema(conn)
+        with pytest.raises(SchemaMismatch, match="version is None"):
+            async with baseline_engine.begin() as conn:
+                await check_schema(conn)
+
+    async def test_html_pages_are_served_by_default(self, client: AsyncClient):
+        response = await client.get("/")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/html")
+
+    def test_api_only_mode_skips_html_and_database_setup(self):
+        # A fresh interpreter, since the mode is fixed when main is imported
+        script = (
+            "import sys, database, main\n"
+            "paths = {getattr(route, 'path', None) for route in main.app.routes}\n"
+            "assert '/' not in paths and '/static' not in paths and '/api/tasks' in paths, paths\n"
+            "assert 'jinja2' not in sys.modules\n"
+            "assert database._engine is None\n"
+        )
+        env = {**os.environ, "API_ONLY": "true"}
+        result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+
+class TestReadReplicas:
+    @pytest.fixture
+    async def replicas(self, monkeypatch):
+        # Two "replicas": one that can't connect, and one on the test database file
+        from config import settings
+
+        dead = database._create_engine("sqlite+aiosqlite:///./no-such-dir/replica.db")
+        live = database._create_engine("sqlite+aiosqlite:///./test.db")
+        statements = []
+        event.listen(live.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        replica_set = ReplicaSet([dead, live], eject_seconds=30)
+        replica_set.statements = statements
+        monkeypatch.setattr(database, "_replicas", replica_set)
+        monkeypatch.setattr(settings, "db_replica_urls", "configured")
+        monkeypatch.delitem(app.dependency_overrides, get_read_db)
+        yield replica_set
+        await dead.dispose()
+        await live.dispose()
+
+    async def test_listings_read_from_a_healthy_replica(self, client: AsyncClient, test_task, replicas, ops_headers):
+        for _ in range(3):
+            response = await client.get("/api/tasks")
+            assert response.status_code == 200
+            assert [item["id"] for item in response.json()["items"]] == [test_task.id]
+        assert any("FROM tasklist" in statement for statement in replicas.statements)
+        # The dead replica was tried once, then skipped
+        assert replicas.ejections == 1
+        stats = (await client.get("/api/ops/pool", headers=ops_headers)).json()["replicas"]
+        assert [replica["ejected"] for replica in stats] == [True, False]
+        # Replicas are reported by position, never by URL
+        assert [replica["replica"] for replica in stats] == [0, 1]
+        assert "sqlite" not in str(stats)
+
+    async def test_falls_back_to_primary_when_every_replica_is_ejected(self, client: AsyncClient, test_task, replicas):
+        replicas.eject(0)
+        replicas.eject(1)
+        response = await client.get("/api/tasks")
+        assert response.status_code == 200
+        assert len(response.json()["items"]) == 1
+        assert replicas.statements == []
+
+    async def test_writer_reads_own_writes_from_primary(self, client: AsyncClient, auth_headers, replicas):
+        response = await client.post("/api/tasks", json={"task": "Fresh", "due": None, "done": False}, headers=auth_headers)
+        assert response.status_code == 201
+        response = await client.get("/api/tasks", headers=auth_headers)
+        assert [item["task"] for item in response.json()["items"]] == ["Fresh"]
+        assert replicas.statements == []
+        # Other clients are not pinned
+        await client.get("/api/tasks")
+        assert replicas.statements
+
+    async def test_pin_survives_a_new_access_token(self, client: AsyncClient, test_user, auth_headers, replicas):
+        from auth import create_access_token
+
+        response = await client.post("/api/tasks", json={"task": "Fresh", "due": None, "done": False}, headers=auth_headers)
+        assert response.status_code == 201
+        # As after POST /api/users/token/refresh: same user, different Authorization header
+        refreshed = {"Authorization": f"Bearer {create_access_token({'sub': str(test_user.id)}, expires_delta=timedelta(minutes=5))}"}
+        assert refreshed != auth_headers
+        response = await client.get("/api/tasks", headers=refreshed)
+        assert [item["task"] for item in response.json()["items"]] == ["Fresh"]
+        assert replicas.statements == []
+
+    def test_round_robin_skips_ejected(self):
+        replica_set = ReplicaSet([engine, engine, engine], eject_seconds=30)
+        assert replica_set.candidates() == [0, 1, 2]
+        assert replica_set.candidates() == [1, 2, 0]
+        replica_set.eject(2)
+        assert replica_set.candidates() == [0, 1]
+
+    def test_pins_expire(self, monkeypatch):
+        pins = ReadPins(window=5, maxsize=2)
+        pins.pin(1)
+        assert pins.is_pinned(1) and not pins.is_pinned(2) and not pins.is_pinned(None)
+        pins.pin(2)
+        pins.pin(3)
+        assert not pins.is_pinned(1)
+        now = database.time.monotonic()
+        monkeypatch.setattr(database.time, "monotonic", lambda: now + 6)
+        assert not pins.is_pinned(3)
+
+
+class TestAdmissionControl:
+    @pytest.fixture
+    def limits(self, monkeypatch):
+        from ratelimit import limiter
+
+        def set_limit(kind: str, spec: str):
+            monkeypatch.setitem(limiter.limits, kind, Limit.parse(spec))
+        return set_limit
+
+    async def test_login_is_limited_per_ip_before_any_work(self, client: AsyncClient, test_user, limits, query_counter):
+        limits("login", "2/60")
+        for _ in range(2):
+            response = await client.post("/api/users/token", data={"username": "test@example.com", "password": "wrong"})
+            assert response.status_code == 401
+        query_counter.clear()
+        response = await client.post("/api/users/token", data={"username": "test@example.com", "password": "password123"})
+        assert response.status_code == 429
+        assert response.json() == {"detail": "Too many requests"}
+        assert response.headers["Retry-After"] == "30"
+        assert response.headers["RateLimit-Remaining"] == "0"
+        assert response.headers["RateLimit-Policy"] == "2;w=60"
+        assert query_counter == []
+
+    async def test_anonymous_clients_behind_a_proxy_get_their_own_bucket(self, test_user, limits):
+        # What uvicorn --proxy-headers does in front of the app
+        from httpx import ASGITransport
+        from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+        limits("login", "1/60")
+        proxied = ProxyHeadersMiddleware(app, trusted_hosts="*")
+        async with AsyncClient(transport=ASGITransport(app=proxied, client=("10.0.0.1", 123)), base_url="http://test") as behind_proxy:
+            for address in ("203.0.113.1", "203.0.113.2"):
+                response = await behind_proxy.post(
+                    "/api/users/token",
+                    data={"username": "test@example.com", "password": "wrong"},
+                    headers={"X-Forwarded-For": address},
+                )
+                assert response.status_code == 401
+            response = await behind_proxy.post(
+                "/api/users/token",
+                data={"username": "test@example.com", "password": "wrong"},
+                headers={"X-Forwarded-For": "203.0.113.1"},
+            )
+            assert response.status_code == 429
+
+    async def test_writes_are_limited_per_user(self, client: AsyncClient, auth_headers, auth_headers2, limits):
+        limits("write", "1/60")
+        body = {"task": "One", "done": False, "due": None}
+        assert (await client.post("/api/tasks", json=body, headers=auth_headers)).status_code == 201
+        assert (await client.post("/api/tasks", json=body, headers=auth_headers)).status_code == 429
+        # Same IP, different user: separate bucket
+        assert (await client.post("/api/tasks", json=body, headers=auth_headers2)).status_code == 201
+        # Reads are another class
+        assert (await client.get("/api/users/me", headers=auth_headers)).status_code == 200
+
+    async def test_rate_limit_headers(self, client: AsyncClient, limits):
+        limits("read", "5/10")
+        response = await client.get("/api/tasks")
+        assert response.headers["RateLimit-Limit"] == "5"
+        assert response.headers["RateLimit-Remaining"] == "4"
+        assert response.headers["RateLimit-Reset"] == "2"
+        assert "Retry-After" not in response.headers
+        assert "RateLimit-Limit" not in (await client.get("/")).headers
+
+    async def test_bucket_refills(self, monkeypatch):
+        from ratelimit import MemoryBackend
+
+        backend = MemoryBackend(maxsize=10)
+        limit = Limit.parse("2/10")
+        now = database.time.monotonic()
+        assert (await backend.take("k", limit))[0]
+        assert (await backend.take("k", limit))[0]
+        assert not (await backend.take("k", limit))[0]
+        # One token back after 5 seconds
+        monkeypatch.setattr(database.time, "monotonic", lambda: now + 6)
+        allowed, tokens = await backend.take("k", limit)
+        assert allowed and tokens < 1
+
+    def test_route_classes(self):
+        from ratelimit import route_class
+
+        assert route_class("POST", "/api/users/token") == "login"
+        assert route_class("POST", "/api/users") == "login"
+        assert route_class("PATCH", "/api/users/1") == "write"
+        assert route_class("GET", "/api/tasks") == "read"
+        assert route_class("GET", "/static/style.css") is None
@@ -1,17 +1,28 @@
+import asyncio
+import json
+
 import pytest
 from httpx import AsyncClient
+from sqlalchemy.exc import IntegrityError
+
+from auth import token_cache
+from cache import MemoryBackend, ResponseCache, response_cache
+from config import settings
+from database import engine
+from events import EventBroker, LocalBackend, broker, user_topic
+from main import app
 
 
 class TestGetTasks:
     async def test_get_all_tasks_empty(self, client: AsyncClient):
         response = await client.get("/api/tasks")
         assert response.status_code == 200
-        assert response.json() == []
+        assert response.json() == {"items": [], "next_cursor": None}
 
     async def test_get_all_tasks(self, client: AsyncClient, test_task):
         response = await client.get("/api/tasks")
         assert response.status_code == 200
-        data = response.json()
+        data = response.json()["items"]
         assert isinstance(data, list)
         assert len(data) == 1
         assert data[0]["task"] == "Test task"
@@ -31,6 +42,114 @@ class TestGetTasks:
         assert response.status_code == 404
 
 
+class TestTaskPagination:
+    async def test_pages_cover_every_task_once(self, client: AsyncClient, auth_headers):
+        for i in range(5):
+            await client.post("/api/tasks", json={"task": f"Task {i}", "done": False, "due": None}, headers=auth_headers)
+
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 2} if cursor is None else {"limit": 2, "after": cursor}
+            response = await client.get("/api/tasks", params=params)
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page["items"]) <= 2
+            seen.extend(item["task"] for item in page["items"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        assert seen == [f"Task {i}" for i in range(5)]
+
+    async def test_last_full_page_has_no_cursor(self, client: AsyncClient, test_task):
+        response = await client.get("/api/tasks", params={"limit": 1})
+        assert response.status_code == 200
+        assert response.json()["next_cursor"] is None
+
+    async def test_invalid_cursor(self, client: AsyncClient):
+        response = await client.get("/api/tasks", params={"after": "not-a-cursor"})
+        assert response.status_code == 400
+
+    async def test_limit_above_maximum(self, client: AsyncClient):
+        response = await client.get("/api/tasks", params={"limit": 10_000})
+        assert response.status_code == 422
+
+
+class TestTaskFiltersAndSort:
+    async def _create(self, client, headers, name, due, done=False):
+        response = await client.post("/api/tasks", json={"task": name, "done": done, "due": due}, headers=headers)
+        assert response.status_code == 201
+
+    async def _names(self, client, **params):
+        response = await client.get("/api/tasks", params=params)
+        assert response.status_code == 200
+        return [item["task"] for item in response.json()["items"]]
+
+    async def test_filter_done(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "open", None)
+        await self._create(client, auth_headers, "closed", None, done=True)
+        assert await self._names(client, done="true") == ["closed"]
+        assert await self._names(client, done="false") == ["open"]
+
+    async def test_filter_due_range(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "early", "2030-01-01T00:00:00")
+        await self._create(client, auth_headers, "late", "2030-06-01T00:00:00")
+        await self._create(client, auth_headers, "no due", None)
+        assert await self._names(client, due_before="2030-03-01T00:00:00") == ["early"]
+        assert await self._names(client, due_after="2030-03-01T00:00:00") == ["late"]
+
+    async def test_filter_due_range_with_offsets(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "ten utc", "2030-01-01T10:00:00Z")
+        # 09:00Z and 11:00Z: compared by instant, not by the wall-clock time as written
+        assert await self._names(client, due_before="2030-01-01T11:00:00+02:00") == []
+        assert await self._names(client, due_after="2030-01-01T09:00:00-02:00") == []
+        assert await self._names(client, due_before="2030-01-01T13:00:00+02:00") == ["ten utc"]
+        assert await self._names(client, due_after="2030-01-01T07:00:00-02:00") == ["ten utc"]
+
+    async def test_filter_overdue(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "overdue", "2000-01-01T00:00:00")
+        await self._create(client, auth_headers, "finished", "2000-01-01T00:00:00", done=True)
+        await self._create(client, auth_headers, "upcoming", "2999-01-01T00:00:00")
+        await self._create(client, auth_headers, "no due", None)
+        assert await self._names(client, overdue="true") == ["overdue"]
+        assert await self._names(client, overdue="false") == ["finished", "upcoming", "no due"]
+
+    async def test_sort_by_due_puts_missing_due_last(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "no due", None)
+        await self._create(client, auth_headers, "late", "2030-06-01T00:00:00")
+        await self._create(client, auth_headers, "early", "2030-01-01T00:00:00")
+        assert await self._names(client, sort="due") == ["early", "late", "no due"]
+        assert await self._names(client, sort="-due") == ["late", "early", "no due"]
+
+    async def test_sort_by_due_paginates_across_missing_due(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "no due 1", None)
+        await self._create(client, auth_headers, "b", "2030-02-01T00:00:00")
+        await self._create(client, auth_headers, "no due 2", None)
+        await self._create(client, auth_headers, "a", "2030-01-01T00:00:00")
+
+        seen = []
+        params = {"sort": "due", "limit": 1}
+        while True:
+            page = (await client.get("/api/tasks", params=params)).json()
+            seen.extend(item["task"] for item in page["items"])
+            if page["next_cursor"] is None:
+                break
+            params["after"] = page["next_cursor"]
+        assert seen == ["a", "b", "no due 1", "no due 2"]
+
+    async def test_cursor_from_other_sort_rejected(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "one", None)
+        await self._create(client, auth_headers, "two", None)
+        cursor = (await client.get("/api/tasks", params={"limit": 1})).json()["next_cursor"]
+        response = await client.get("/api/tasks", params={"sort": "due", "after": cursor})
+        assert response.status_code == 400
+
+    async def test_invalid_sort(self, client: AsyncClient):
+        response = await client.get("/api/tasks", params={"sort": "task"})
+        assert response.status_code == 422
+
+
 FUTURE_DUE = "2027-01-01T12:00:00"
 
 
@@ -170,6 +289,244 @@ class TestPartialUpdateTask:
         assert response.status_code == 404
 
 
+class TestMutationRoundTrips:
+    # With the principal cached, a mutation is a single UPDATE/DELETE ... RETURNING, plus the
+    # owner's counter UPDATE when task_count/done_count can change, and a DELETE's tombstone INSERT.
+    # Only a miss pays for one extra probe to tell 403 from 404
+    async def _warm(self, client, headers):
+        await client.get("/api/users/me", headers=headers)
+
+    async def test_put_is_two_statements(self, client: AsyncClient, test_task, auth_headers, query_counter):
+        await self._warm(client, auth_headers)
+        query_counter.clear()
+        response = await client.put(
+            f"/api/tasks/{test_task.id}",
+            json={"task": "Updated", "done": True, "due": FUTURE_DUE},
+            headers=auth_headers,
+        )
+        assert response.status_code == 200
+        assert response.json()["author"]["username"] == "testuser"
+        assert len(query_counter) == 2
+
+    async def test_patch_without_done_is_one_statement(self, client: AsyncClient, test_task, auth_headers, query_counter):
+        await self._warm(client, auth_headers)
+        query_counter.clear()
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"task": "Renamed"}, headers=auth_headers)
+        assert response.status_code == 200
+        assert len(query_counter) == 1
+
+    async def test_patch_done_is_two_statements(self, client: AsyncClient, test_task, auth_headers, query_counter):
+        await self._warm(client, auth_headers)
+        query_counter.clear()
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        assert response.status_code == 200
+        assert len(query_counter) == 2
+
+    async def test_delete_is_three_statements(self, client: AsyncClient, test_task, auth_headers, query_counter):
+        await self._warm(client, auth_headers)
+        query_counter.clear()
+        response = await client.delete(f"/api/tasks/{test_task.id}", headers=auth_headers)
+        assert response.status_code == 204
+        assert len(query_counter) == 3
+
+    async def test_miss_adds_one_probe(self, client: AsyncClient, test_task, auth_headers2, query_counter):
+        await self._warm(client, auth_headers2)
+        query_counter.clear()
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers2)
+        assert response.status_code == 403
+        assert len(query_counter) == 3
+
+    async def test_empty_patch_returns_task(self, client: AsyncClient, test_task, auth_headers):
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={}, headers=auth_headers)
+        assert response.status_code == 200
+        assert response.json()["task"] == "Test task"
+
+
+class TestSparseFieldsets:
+    async def test_fields_limit_columns_and_skip_author(self, client: AsyncClient, test_task, query_counter):
+        response = await client.get("/api/tasks", params={"fields": "id,task,done"})
+        assert response.status_code == 200
+        assert response.json()["items"] == [{"id": test_task.id, "task": "Test task", "done": False}]
+        # One SELECT on tasklist, without the unrequested columns and without loading the author
+        assert len(query_counter) == 1
+        assert "tasklist.due" not in query_counter[0]
+        assert "users" not in query_counter[0]
+
+    async def test_expand_author(self, client: AsyncClient, test_task):
+        response = await client.get("/api/tasks", params={"fields": "task", "expand": "author"})
+        item = response.json()["items"][0]
+        assert set(item) == {"id", "task", "author"}
+        assert item["author"]["username"] == "testuser"
+
+    async def test_default_is_full_response(self, client: AsyncClient, test_task):
+        item = (await client.get("/api/tasks")).json()["items"][0]
+        assert set(item) == {"id", "user_id", "task", "due", "done", "created", "author"}
+
+    async def test_unknown_field(self, client: AsyncClient):
+        response = await client.get("/api/tasks", params={"fields": "id,password_hash"})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Unknown field(s): password_hash"
+        response = await client.get("/api/tasks", params={"expand": "tasks"})
+        assert response.status_code == 400
+
+    async def test_cursor_with_sparse_fields(self, client: AsyncClient, auth_headers):
+        for i in range(3):
+            await client.post("/api/tasks", json={"task": f"Task {i}", "done": False, "due": FUTURE_DUE}, headers=auth_headers)
+        first = (await client.get("/api/tasks", params={"fields": "task", "sort": "due", "limit": 2})).json()
+        second = (await client.get("/api/tasks", params={"fields": "task", "sort": "due", "limit": 2, "after": first["next_cursor"]})).json()
+        assert [item["task"] for item in first["items"] + second["items"]] == ["Task 0", "Task 1", "Task 2"]
+        assert set(second["items"][0]) == {"id", "task"}
+
+    async def test_user_tasks_fields(self, client: AsyncClient, test_user, test_task):
+        response = await client.get(f"/api/users/{test_user.id}/tasks", params={"fields": "done,due"})
+        assert response.json()["items"] == [{"id": test_task.id, "due": None, "done": False}]
+
+    async def test_single_task_fields(self, client: AsyncClient, test_task, query_counter):
+        response = await client.get(f"/api/tasks/{test_task.id}", params={"fields": "task"})
+        assert response.json() == {"id": test_task.id, "task": "Test task"}
+        # The body has no author block, so neither has the ETag
+        assert response.headers["ETag"] == '"1"'
+        assert not any("FROM users" in statement for statement in query_counter)
+
+        response = await client.get(f"/api/tasks/{test_task.id}", params={"fields": "task"}, headers={"If-None-Match": '"1"'})
+        assert response.status_code == 304
+
+    async def test_if_match_with_task_only_etag(self, client: AsyncClient, test_task, auth_headers):
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers={**auth_headers, "If-Match": '"1"'})
+        assert response.status_code == 200
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": False}, headers={**auth_headers, "If-Match": '"1"'})
+        assert response.status_code == 412
+
+
+class TestTaskETags:
+    async def test_get_returns_etag(self, client: AsyncClient, test_task):
+        response = await client.get(f"/api/tasks/{test_task.id}")
+        assert response.headers["ETag"] == '"1.1"'
+
+    async def test_conditional_get_not_modified(self, client: AsyncClient, test_task, query_counter):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["ETag"]
+        await response_cache.clear()
+        query_counter.clear()
+        response = await client.get(f"/api/tasks/{test_task.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.content == b""
+        # Only the version columns are read on the 304 path
+        assert len(query_counter) == 1
+        assert "tasklist.task" not in query_counter[0]
+
+    async def test_write_changes_etag(self, client: AsyncClient, test_task, auth_headers):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["ETag"]
+        patched = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        assert patched.headers["ETag"] == '"2.1"'
+        response = await client.get(f"/api/tasks/{test_task.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] == patched.headers["ETag"]
+
+    async def test_author_rename_changes_etag(self, client: AsyncClient, test_user, test_task, auth_headers):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["ETag"]
+        await client.patch(f"/api/users/{test_user.id}", json={"username": "renamed"}, headers=auth_headers)
+        response = await client.get(f"/api/tasks/{test_task.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["author"]["username"] == "renamed"
+
+    async def test_if_match_current_version(self, client: AsyncClient, test_task, auth_headers):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["ETag"]
+        response = await client.patch(
+            f"/api/tasks/{test_task.id}", json={"done": True}, headers={**auth_headers, "If-Match": etag}
+        )
+        assert response.status_code == 200
+
+    async def test_if_match_stale_version(self, client: AsyncClient, test_task, auth_headers):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["ETag"]
+        await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+
+        stale = {**auth_headers, "If-Match": etag}
+        response = await client.put(
+            f"/api/tasks/{test_task.id}", json={"task": "Lost update", "done": False, "due": FUTURE_DUE}, headers=stale
+        )
+        assert response.status_code == 412
+        assert (await client.delete(f"/api/tasks/{test_task.id}", headers=stale)).status_code == 412
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["done"] is True
+
+    async def test_if_match_still_reports_forbidden(self, client: AsyncClient, test_task, auth_headers2):
+        response = await client.patch(
+            f"/api/tasks/{test_task.id}", json={"done": True}, headers={**auth_headers2, "If-Match": '"1.1"'}
+        )
+        assert response.status_code == 403
+
+
+class TestTaskResponseCache:
+    async def test_repeat_get_served_from_cache(self, client: AsyncClient, test_task, query_counter):
+        first = await client.get(f"/api/tasks/{test_task.id}")
+        query_counter.clear()
+        second = await client.get(f"/api/tasks/{test_task.id}")
+        assert second.json() == first.json()
+        assert second.headers["ETag"] == first.headers["ETag"]
+        assert len(query_counter) == 0
+
+    async def test_conditional_get_from_cache(self, client: AsyncClient, test_task, query_counter):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["ETag"]
+        query_counter.clear()
+        response = await client.get(f"/api/tasks/{test_task.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert len(query_counter) == 0
+
+    async def test_update_invalidates(self, client: AsyncClient, test_task, auth_headers):
+        await client.get(f"/api/tasks/{test_task.id}")
+        await client.put(
+            f"/api/tasks/{test_task.id}", json={"task": "Updated", "done": True, "due": None}, headers=auth_headers
+        )
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["task"] == "Updated"
+
+    async def test_batch_update_invalidates(self, client: AsyncClient, test_task, auth_headers):
+        await client.get(f"/api/tasks/{test_task.id}")
+        await client.patch("/api/tasks/batch", json={"items": [{"id": test_task.id, "done": True}]}, headers=auth_headers)
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["done"] is True
+
+    async def test_batch_delete_invalidates(self, client: AsyncClient, test_task, auth_headers):
+        await client.get(f"/api/tasks/{test_task.id}")
+        await client.delete("/api/tasks/batch", params={"ids": [test_task.id]}, headers=auth_headers)
+        assert (await client.get(f"/api/tasks/{test_task.id}")).status_code == 404
+
+    async def test_author_rename_visible_on_cached_task(self, client: AsyncClient, test_user, test_task, auth_headers):
+        await client.get(f"/api/tasks/{test_task.id}")
+        await client.patch(f"/api/users/{test_user.id}", json={"username": "renamed"}, headers=auth_headers)
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["author"]["username"] == "renamed"
+
+    async def test_concurrent_misses_share_one_load(self):
+        cache = ResponseCache(MemoryBackend(maxsize=10, ttl=60), ttl=60)
+        loads = 0
+
+        async def loader():
+            nonlocal loads
+            loads += 1
+            await asyncio.sleep(0.01)
+            return {"id": 1}
+
+        results = await asyncio.gather(*(cache.get_or_load("task:1", loader) for _ in range(5)))
+        assert results == [{"id": 1}] * 5
+        assert loads == 1
+        assert cache.stats()["coalesced"] == 4
+
+    async def test_invalidation_during_load_is_not_cached(self):
+        cache = ResponseCache(MemoryBackend(maxsize=10, ttl=60), ttl=60)
+
+        async def loader():
+            await cache.invalidate("task:1")
+            return {"id": 1, "stale": True}
+
+        await cache.get_or_load("task:1", loader)
+        assert await cache.get("task:1") is None
+
+    async def test_size_cap_evicts(self):
+        cache = ResponseCache(MemoryBackend(maxsize=2, ttl=60), ttl=60)
+        for task_id in range(3):
+            await cache.get_or_load(f"task:{task_id}", lambda: asyncio.sleep(0, result={"ok": True}))
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["size"] == 2
+
+
 class TestDeleteTask:
     async def test_delete_task_success(self, client: AsyncClient, test_task, auth_headers):
         response = await client.delete(f"/api/tasks/{test_task.id}", headers=auth_headers)
@@ -189,3 +546,672 @@ class TestDeleteTask:
     async def test_delete_task_not_found(self, client: AsyncClient, auth_headers):
         response = await client.delete("/api/tasks/99999", headers=auth_headers)
         assert response.status_code == 404
+
+
+class TestBatchTasks:
+    async def test_batch_create(self, client: AsyncClient, test_user, auth_headers):
+        response = await client.post(
+            "/api/tasks/batch",
+            json={"items": [
+                {"task": "First", "done": False, "due": FUTURE_DUE},
+                {"task": "Second", "done": True, "due": None},
+            ]},
+            headers=auth_headers,
+        )
+        assert response.status_code == 201
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == [201, 201]
+        assert [r["task"]["task"] for r in results] == ["First", "Second"]
+        assert results[0]["task"]["author"]["username"] == "testuser"
+        assert results[0]["task"]["user_id"] == test_user.id
+
+        listing = (await client.get("/api/tasks")).json()["items"]
+        assert [t["task"] for t in listing] == ["First", "Second"]
+
+    async def test_batch_create_unauthenticated(self, client: AsyncClient):
+        response = await client.post("/api/tasks/batch", json={"items": [{"task": "x", "done": False, "due": None}]})
+        assert response.status_code == 401
+
+    async def test_batch_create_too_many_items(self, client: AsyncClient, auth_headers):
+        items = [{"task": f"t{i}", "done": False, "due": None} for i in range(settings.batch_max_items + 1)]
+        response = await client.post("/api/tasks/batch", json={"items": items}, headers=auth_headers)
+        assert response.status_code == 422
+
+    async def test_batch_create_empty(self, client: AsyncClient, auth_headers):
+        response = await client.post("/api/tasks/batch", json={"items": []}, headers=auth_headers)
+        assert response.status_code == 422
+
+    async def test_batch_update_reports_each_item(self, client: AsyncClient, test_task, auth_headers, auth_headers2):
+        other = (await client.post("/api/tasks", json={"task": "Other", "done": False, "due": None}, headers=auth_headers2)).json()
+        response = await client.patch(
+            "/api/tasks/batch",
+            json={"items": [
+                {"id": test_task.id, "done": True},
+                {"id": other["id"], "done": True},
+                {"id": 99999, "task": "Ghost"},
+            ]},
+            headers=auth_headers,
+        )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == [200, 403, 404]
+        assert results[0]["task"]["done"] is True
+        assert results[0]["task"]["task"] == "Test task"
+
+        assert (await client.get(f"/api/tasks/{other['id']}")).json()["done"] is False
+
+    async def test_batch_update_different_fields_per_item(self, client: AsyncClient, auth_headers):
+        created = (await client.post(
+            "/api/tasks/batch",
+            json={"items": [{"task": "a", "done": False, "due": None}, {"task": "b", "done": False, "due": None}]},
+            headers=auth_headers,
+        )).json()["results"]
+        a, b = created[0]["id"], created[1]["id"]
+        response = await client.patch(
+            "/api/tasks/batch",
+            json={"items": [{"id": a, "task": "renamed"}, {"id": b, "done": True, "due": FUTURE_DUE}]},
+            headers=auth_headers,
+        )
+        results = response.json()["results"]
+        assert results[0]["task"]["task"] == "renamed"
+        assert results[0]["task"]["done"] is False
+        assert results[1]["task"]["task"] == "b"
+        assert results[1]["task"]["done"] is True
+        assert results[1]["task"]["due"] is not None
+
+    async def test_batch_update_duplicate_ids(self, client: AsyncClient, test_task, auth_headers):
+        response = await client.patch(
+            "/api/tasks/batch",
+            json={"items": [{"id": test_task.id, "done": True}, {"id": test_task.id, "done": False}]},
+            headers=auth_headers,
+        )
+        assert response.status_code == 422
+
+    async def test_batch_update_rejects_nulls_for_required_fields(self, client: AsyncClient, test_task, auth_headers):
+        for item in ({"id": test_task.id, "done": None}, {"id": test_task.id, "task": None}):
+            response = await client.patch("/api/tasks/batch", json={"items": [item]}, headers=auth_headers)
+            assert response.status_code == 422
+        # due is nullable: clearing it is still allowed
+        response = await client.patch("/api/tasks/batch", json={"items": [{"id": test_task.id, "due": None}]}, headers=auth_headers)
+        assert response.status_code == 200
+        assert response.json()["results"][0]["task"]["due"] is None
+
+    async def test_batch_delete(self, client: AsyncClient, test_task, auth_headers, auth_headers2):
+        other = (await client.post("/api/tasks", json={"task": "Other", "done": False, "due": None}, headers=auth_headers2)).json()
+        response = await client.delete(
+            "/api/tasks/batch",
+            params={"ids": [test_task.id, other["id"], 99999]},
+            headers=auth_headers,
+        )
+        assert response.status_code == 200
+        assert [r["status"] for r in response.json()["results"]] == [204, 403, 404]
+        assert (await client.get(f"/api/tasks/{test_task.id}")).status_code == 404
+        assert (await client.get(f"/api/tasks/{other['id']}")).status_code == 200
+
+
+class TestTaskSearch:
+    async def _create(self, client, headers, *texts):
+        response = await client.post("/api/tasks/batch", json={"items": [{"task": text, "done": False, "due": None} for text in texts]}, headers=headers)
+        return [item["id"] for item in response.json()["results"]]
+
+    async def test_search_ranks_matches(self, client: AsyncClient, auth_headers):
+        ids = await self._create(client, auth_headers, "Remember milk among the many things to pick up this weekend", "Walk the dog", "Milk milk", "Buying groceries")
+        response = await client.get("/api/tasks/search", params={"q": "milk"}, headers=auth_headers)
+        assert response.status_code == 200
+        items = response.json()["items"]
+        # Denser matches rank higher; the other tasks do not match at all
+        assert [item["id"] for item in items] == [ids[2], ids[0]]
+        assert items[0]["author"]["username"] == "testuser"
+
+    async def test_search_requires_every_word_and_stems(self, client: AsyncClient, auth_headers):
+        ids = await self._create(client, auth_headers, "Buy milk", "Buying groceries", "Milk only")
+        response = await client.get("/api/tasks/search", params={"q": "buy milk"}, headers=auth_headers)
+        assert [item["id"] for item in response.json()["items"]] == [ids[0]]
+        response = await client.get("/api/tasks/search", params={"q": "buys"}, headers=auth_headers)
+        assert {item["id"] for item in response.json()["items"]} == {ids[0], ids[1]}
+
+    async def test_search_is_scoped_to_current_user(self, client: AsyncClient, auth_headers, auth_headers2, test_user):
+        await self._create(client, auth_headers2, "Secret milk plan")
+        mine = await self._create(client, auth_headers, "My milk")
+        response = await client.get("/api/tasks/search", params={"q": "milk"}, headers=auth_headers)
+        assert [item["id"] for item in response.json()["items"]] == mine
+        # Words are confined to the task text, so an owner token can't be searched for
+        response = await client.get("/api/tasks/search", params={"q": f"u{test_user.id}"}, headers=auth_headers)
+        assert response.json()["items"] == []
+
+    async def test_search_follows_updates_and_deletes(self, client: AsyncClient, auth_headers):
+        ids = await self._create(client, auth_headers, "Call mom", "Call dad")
+        await client.patch(f"/api/tasks/{ids[0]}", json={"task": "Visit mom"}, headers=auth_headers)
+        await client.delete(f"/api/tasks/{ids[1]}", headers=auth_headers)
+        assert (await client.get("/api/tasks/search", params={"q": "call"}, headers=auth_headers)).json()["items"] == []
+        response = await client.get("/api/tasks/search", params={"q": "visit"}, headers=auth_headers)
+        assert [item["id"] for item in response.json()["items"]] == [ids[0]]
+
+    async def test_search_pagination(self, client: AsyncClient, auth_headers):
+        ids = await self._create(client, auth_headers, *[f"Report {i}" for i in range(5)])
+        seen, after = [], None
+        while True:
+            params = {"q": "report", "limit": 2, **({"after": after} if after else {})}
+            page = (await client.get("/api/tasks/search", params=params, headers=auth_headers)).json()
+            seen += [item["id"] for item in page["items"]]
+            after = page["next_cursor"]
+            if after is None:
+                break
+        assert sorted(seen) == ids
+        assert len(seen) == len(set(seen))
+
+    async def test_search_input_is_not_fts_syntax(self, client: AsyncClient, auth_headers):
+        await self._create(client, auth_headers, "Fix the NEAR-term bug")
+        for q in ['"unbalanced', "owner:u1 OR *", "NEAR(", "---"]:
+            response = await client.get("/api/tasks/search", params={"q": q}, headers=auth_headers)
+            assert response.status_code == 200
+
+    async def test_search_requires_auth(self, client: AsyncClient):
+        response = await client.get("/api/tasks/search", params={"q": "milk"})
+        assert response.status_code == 401
+
+    async def test_search_invalid_cursor(self, client: AsyncClient, auth_headers):
+        response = await client.get("/api/tasks/search", params={"q": "milk", "after": "bm90LWEtY3Vyc29y"}, headers=auth_headers)
+        assert response.status_code == 400
+
+    async def test_rebuild_search_index(self, client: AsyncClient, db_session, auth_headers):
+        from sqlalchemy import text
+
+        from search import rebuild_search_index
+
+        ids = await self._create(client, auth_headers, "Water plants")
+        await db_session.execute(text("INSERT INTO tasklist_fts(tasklist_fts) VALUES ('delete-all')"))
+        await db_session.commit()
+        assert (await client.get("/api/tasks/search", params={"q": "plants"}, headers=auth_headers)).json()["items"] == []
+        await rebuild_search_index(db_session)
+        await db_session.commit()
+        response = await client.get("/api/tasks/search", params={"q": "plants"}, headers=auth_headers)
+        assert [item["id"] for item in response.json()["items"]] == ids
+
+
+class TestResponseEncoding:
+    async def test_msgpack_negotiation(self, client: AsyncClient, test_task):
+        import msgpack
+
+        as_json = await client.get("/api/tasks")
+        as_msgpack = await client.get("/api/tasks", headers={"Accept": "application/msgpack"})
+        assert as_msgpack.headers["content-type"] == "application/msgpack"
+        assert as_msgpack.headers["vary"] == "Accept"
+        assert msgpack.unpackb(as_msgpack.content) == as_json.json()
+
+    async def test_json_is_default(self, client: AsyncClient, test_task):
+        for accept in (None, "*/*", "text/html", "application/json, application/msgpack;q=0.5"):
+            headers = {"Accept": accept} if accept else {}
+            response = await client.get(f"/api/tasks/{test_task.id}", headers=headers)
+            assert response.headers["content-type"] == "application/json"
+
+    async def test_msgpack_on_writes_and_users(self, client: AsyncClient, test_user, auth_headers):
+        import msgpack
+
+        headers = {**auth_headers, "Accept": "application/json;q=0.5, application/x-msgpack"}
+        created = await client.post("/api/tasks", json={"task": "Packed", "done": False, "due": FUTURE_DUE}, headers=headers)
+        assert created.status_code == 201
+        assert msgpack.unpackb(created.content)["due"] == "2027-01-01T12:00:00"
+        me = await client.get("/api/users/me", headers=headers)
+        assert msgpack.unpackb(me.content)["email"] == "test@example.com"
+
+    async def test_cached_and_fresh_bodies_match(self, client: AsyncClient, auth_headers):
+        created = (await client.post("/api/tasks", json={"task": "Same", "done": False, "due": FUTURE_DUE}, headers=auth_headers)).json()
+        first = (await client.get(f"/api/tasks/{created['id']}")).json()
+        cached = (await client.get(f"/api/tasks/{created['id']}")).json()
+        listed = (await client.get("/api/tasks")).json()["items"][0]
+        assert created == first == cached == listed
+
+
+def read_frames(subscription) -> list[tuple[str, dict]]:
+    # Drains a broker subscription into (event, data) pairs
+    frames = []
+    while not subscription.queue.empty():
+        event, data = subscription.queue.get_nowait().decode().strip().split("\n")
+        frames.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return frames
+
+
+class TestTaskStream:
+    async def test_mutations_publish_to_owner(self, client: AsyncClient, test_user, auth_headers, test_user2):
+        with broker.subscribe(user_topic(test_user.id)) as mine, broker.subscribe(user_topic(test_user2.id)) as theirs:
+            created = (await client.post("/api/tasks", json={"task": "Watch me", "done": False, "due": None}, headers=auth_headers)).json()
+            await client.patch(f"/api/tasks/{created['id']}", json={"done": True}, headers=auth_headers)
+            await client.put(f"/api/tasks/{created['id']}", json={"task": "Renamed", "done": True, "due": None}, headers=auth_headers)
+            batch = (await client.post("/api/tasks/batch", json={"items": [{"task": "A", "done": False, "due": None}]}, headers=auth_headers)).json()
+            batch_id = batch["results"][0]["id"]
+            await client.patch("/api/tasks/batch", json={"items": [{"id": batch_id, "done": True}, {"id": 999999, "done": True}]}, headers=auth_headers)
+            await client.delete("/api/tasks/batch", params={"ids": [batch_id, 999999]}, headers=auth_headers)
+            await client.delete(f"/api/tasks/{created['id']}", headers=auth_headers)
+
+            frames = read_frames(mine)
+            assert read_frames(theirs) == []
+        assert [event for event, _ in frames] == [
+            "task.created", "task.updated", "task.updated", "task.created", "task.updated", "task.deleted", "task.deleted",
+        ]
+        assert frames[0][1] == created
+        assert frames[2][1]["task"] == "Renamed"
+        assert frames[5][1] == {"id": batch_id}
+        assert frames[6][1] == {"id": created["id"]}
+
+    async def test_failed_writes_publish_nothing(self, client: AsyncClient, test_task, auth_headers2, test_user):
+        with broker.subscribe(user_topic(test_user.id)) as subscription:
+            response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers2)
+            assert response.status_code == 403
+            assert read_frames(subscription) == []
+
+    async def test_slow_consumer_gets_resync(self):
+        small = EventBroker(LocalBackend(), queue_size=2)
+        with small.subscribe("user:1") as subscription:
+            await small.publish("user:1", [("task.deleted", {"id": task_id}) for task_id in range(3)])
+            assert read_frames(subscription) == [("resync", {"reason": "Too many events queued for this connection"})]
+        assert small.resyncs == 1
+        assert small.stats()["subscribers"] == 0
+
+    async def test_nothing_is_encoded_without_subscribers(self):
+        quiet = EventBroker(LocalBackend(), queue_size=2)
+        await quiet.publish("user:1", [("task.deleted", {"id": 1})])
+        assert quiet.published == 0
+
+    async def test_stream_requires_auth(self, client: AsyncClient):
+        response = await client.get("/api/tasks/stream")
+        assert response.status_code == 401
+
+    async def test_stream_endpoint(self, client: AsyncClient, auth_headers, test_user):
+        # httpx's ASGI transport waits for the whole body, so the endpoint is driven as raw ASGI
+        disconnect = asyncio.Event()
+        sent: asyncio.Queue = asyncio.Queue()
+
+        async def receive():
+            if not hasattr(receive, "started"):
+                receive.started = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await sent.put(message)
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+            "path": "/api/tasks/stream", "raw_path": b"/api/tasks/stream", "root_path": "", "query_string": b"",
+            "headers": [(b"host", b"test"), (b"authorization", auth_headers["Authorization"].encode())],
+            "client": ("127.0.0.1", 1234), "server": ("test", 80),
+        }
+        # Force a database lookup for the token, whose connection must be released before streaming
+        token_cache.clear()
+        checked_out = engine.pool.checkedout()
+        stream = asyncio.create_task(app(scope, receive, send))
+        start = await asyncio.wait_for(sent.get(), 5)
+        assert start["status"] == 200
+        assert (b"content-type", b"text/event-stream; charset=utf-8") in start["headers"]
+        assert (await asyncio.wait_for(sent.get(), 5))["body"].startswith(b"event: ready")
+        assert engine.pool.checkedout() == checked_out
+
+        await client.post("/api/tasks", json={"task": "Pushed", "done": False, "due": None}, headers=auth_headers)
+        body = (await asyncio.wait_for(sent.get(), 5))["body"]
+        assert body.startswith(b"event: task.created\ndata: ") and b'"Pushed"' in body
+
+        disconnect.set()
+        await asyncio.wait_for(stream, 5)
+        assert broker.stats()["subscribers"] == 0
+
+
+class TestTaskChanges:
+    @pytest.fixture(autouse=True)
+    def no_settle_window(self, monkeypatch):
+        monkeypatch.setattr(settings, "sync_settle_seconds", 0)
+
+    async def sync(self, client: AsyncClient, since: str | None = None, **params) -> dict:
+        if since is not None:
+            params["since"] = since
+        response = await client.get("/api/tasks/changes", params=params)
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    async def test_first_sync_only_returns_a_cursor(self, client: AsyncClient, test_task):
+        data = await self.sync(client)
+        assert data["items"] == [] and data["deleted"] == [] and data["has_more"] is False
+        assert data["next_cursor"]
+
+    async def test_returns_writes_and_deletes_since_cursor(self, client: AsyncClient, test_task, auth_headers):
+        cursor = (await self.sync(client))["next_cursor"]
+        created = (await client.post("/api/tasks", json={"task": "New", "done": False, "due": None}, headers=auth_headers)).json()
+        await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        await client.delete(f"/api/tasks/{created['id']}", headers=auth_headers)
+
+        data = await self.sync(client, cursor)
+        assert [item["id"] for item in data["items"]] == [test_task.id]
+        assert data["items"][0]["done"] is True
+        assert data["deleted"] == [created["id"]]
+        # Nothing new since then
+        again = await self.sync(client, data["next_cursor"])
+        assert again["items"] == [] and again["deleted"] == []
+
+    async def test_pages_with_has_more(self, client: AsyncClient, auth_headers):
+        cursor = (await self.sync(client))["next_cursor"]
+        await client.post("/api/tasks/batch", json={"items": [{"task": f"T{i}", "done": False, "due": None} for i in range(5)]}, headers=auth_headers)
+        seen = []
+        while True:
+            data = await self.sync(client, cursor, limit=2)
+            seen += [item["task"] for item in data["items"]]
+            cursor = data["next_cursor"]
+            if not data["has_more"]:
+                break
+        assert seen == [f"T{i}" for i in range(5)]
+
+    async def test_recent_writes_are_sent_again_within_settle_window(self, client: AsyncClient, auth_headers, monkeypatch):
+        cursor = (await self.sync(client))["next_cursor"]
+        await client.post("/api/tasks", json={"task": "Late commit?", "done": False, "due": None}, headers=auth_headers)
+        monkeypatch.setattr(settings, "sync_settle_seconds", 60)
+        first = await self.sync(client, cursor)
+        second = await self.sync(client, first["next_cursor"])
+        assert [item["task"] for item in first["items"]] == [item["task"] for item in second["items"]] == ["Late commit?"]
+
+    async def test_user_delete_writes_tombstones(self, client: AsyncClient, test_user2, auth_headers2, query_counter):
+        cursor = (await self.sync(client))["next_cursor"]
+        batch = (await client.post("/api/tasks/batch", json={"items": [{"task": "A", "done": False, "due": None}, {"task": "B", "done": True, "due": None}]}, headers=auth_headers2)).json()
+        query_counter.clear()
+        response = await client.delete(f"/api/users/{test_user2.id}", headers=auth_headers2)
+        assert response.status_code == 204
+        # Lock the user, tombstones, tasks, user: independent of how many tasks there were
+        assert len(query_counter) == 4
+
+        data = await self.sync(client, cursor)
+        assert data["items"] == []
+        assert sorted(data["deleted"]) == sorted(result["id"] for result in batch["results"])
+
+    async def test_sparse_fieldsets(self, client: AsyncClient, test_task, auth_headers):
+        cursor = (await self.sync(client))["next_cursor"]
+        await client.patch(f"/api/tasks/{test_task.id}", json={"task": "Sparse"}, headers=auth_headers)
+        data = await self.sync(client, cursor, fields="task")
+        assert data["items"] == [{"id": test_task.id, "task": "Sparse"}]
+
+    async def test_expired_and_invalid_cursors(self, client: AsyncClient):
+        from datetime import UTC, datetime, timedelta
+
+        from pagination import pack_cursor
+        from sync import encode_sync_cursor
+
+        old = (datetime.now(UTC) - timedelta(days=settings.tombstone_retention_days + 1), 0)
+        response = await client.get("/api/tasks/changes", params={"since": encode_sync_cursor(old, old)})
+        assert response.status_code == 410
+        # A listing cursor is not a sync cursor
+        response = await client.get("/api/tasks/changes", params={"since": pack_cursor("created", None, 1)})
+        assert response.status_code == 400
+
+    async def test_compaction_drops_expired_tombstones(self, db_session):
+        from datetime import UTC, datetime, timedelta
+
+        from sqlalchemy import func, select
+
+        from models import TaskTombstone
+        from sync import compact_tombstones
+
+        now = datetime.now(UTC)
+        db_session.add_all([
+            TaskTombstone(task_id=1, user_id=1, deleted_at=now - timedelta(days=settings.tombstone_retention_days + 1)),
+            TaskTombstone(task_id=2, user_id=1, deleted_at=now),
+        ])
+        await db_session.commit()
+        assert await compact_tombstones(db_session) == 1
+        await db_session.commit()
+        assert (await db_session.execute(select(func.count()).select_from(TaskTombstone))).scalar() == 1
+
+    async def test_sync_is_an_index_range_scan(self, db_session):
+        from sqlalchemy import text
+
+        plan = (await db_session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM tasklist WHERE (updated_at, id) > ('2026-01-01', 0) ORDER BY updated_at, id LIMIT 51"
+        ))).all()
+        assert any("ix_tasklist_updated_at_id" in row[-1] for row in plan)
+
+
+class TestIdempotencyKeys:
+    NEW_TASK = {"task": "Pay rent", "done": False, "due": None}
+
+    async def post(self, client: AsyncClient, headers: dict, key: str, body: dict | None = None, path: str = "/api/tasks"):
+        return await client.post(path, json=body or self.NEW_TASK, headers={**headers, "Idempotency-Key": key})
+
+    async def task_count(self, client: AsyncClient, headers: dict) -> int:
+        return len((await client.get("/api/tasks", headers=headers)).json()["items"])
+
+    async def test_retry_replays_first_response(self, client: AsyncClient, test_user, auth_headers):
+        with broker.subscribe(user_topic(test_user.id)) as subscription:
+            first = await self.post(client, auth_headers, "retry-1")
+            retry = await self.post(client, auth_headers, "retry-1")
+            events = read_frames(subscription)
+        assert first.status_code == retry.status_code == 201
+        assert retry.json() == first.json()
+        assert retry.headers["idempotent-replayed"] == "true"
+        assert "idempotent-replayed" not in first.headers
+        assert [event for event, _ in events] == ["task.created"]
+        assert await self.task_count(client, auth_headers) == 1
+        stats = (await client.get(f"/api/users/{test_user.id}/tasks/stats")).json()
+        assert stats["total"] == 1
+
+    async def test_key_reused_for_other_body_is_rejected(self, client: AsyncClient, auth_headers):
+        assert (await self.post(client, auth_headers, "reused")).status_code == 201
+        response = await self.post(client, auth_headers, "reused", {**self.NEW_TASK, "task": "Something else"})
+        assert response.status_code == 422
+        # The same body on another route is a different request too
+        response = await self.post(client, auth_headers, "reused", {"items": [self.NEW_TASK]}, "/api/tasks/batch")
+        assert response.status_code == 422
+        assert await self.task_count(client, auth_headers) == 1
+
+    async def test_batch_retry_replays(self, client: AsyncClient, auth_headers):
+        body = {"items": [self.NEW_TASK, {**self.NEW_TASK, "task": "Buy milk"}]}
+        first = await self.post(client, auth_headers, "batch-1", body, "/api/tasks/batch")
+        retry = await self.post(client, auth_headers, "batch-1", body, "/api/tasks/batch")
+        assert first.status_code == retry.status_code == 201
+        assert retry.json() == first.json()
+        assert await self.task_count(client, auth_headers) == 2
+
+    async def test_concurrent_duplicates_create_one_task(self, client: AsyncClient, auth_headers):
+        responses = await asyncio.gather(*(self.post(client, auth_headers, "burst") for _ in range(5)))
+        assert {response.status_code for response in responses} == {201}
+        assert len({response.json()["id"] for response in responses}) == 1
+        assert await self.task_count(client, auth_headers) == 1
+
+    async def test_keys_are_scoped_per_user(self, client: AsyncClient, auth_headers, auth_headers2):
+        mine = await self.post(client, auth_headers, "shared")
+        theirs = await self.post(client, auth_headers2, "shared")
+        assert mine.status_code == theirs.status_code == 201
+        assert mine.json()["id"] != theirs.json()["id"]
+        assert "idempotent-replayed" not in theirs.headers
+
+    async def test_expired_key_can_be_reused(self, client: AsyncClient, test_user, auth_headers, db_session):
+        from datetime import UTC, datetime, timedelta
+
+        from models import IdempotencyRecord
+
+        db_session.add(IdempotencyRecord(
+            user_id=test_user.id, key="old", fingerprint="stale", status_code=201, response="{}",
+            created_at=datetime.now(UTC) - timedelta(hours=settings.idempotency_key_ttl_hours + 1),
+        ))
+        await db_session.commit()
+        response = await self.post(client, auth_headers, "old")
+        assert response.status_code == 201
+        assert response.json()["task"] == "Pay rent"
+
+    async def test_sweep_drops_expired_keys(self, client: AsyncClient, test_user, auth_headers, db_session):
+        from datetime import UTC, datetime, timedelta
+
+        from sqlalchemy import func, select
+
+        from idempotency import sweep_idempotency_keys
+        from models import IdempotencyRecord
+
+        await self.post(client, auth_headers, "fresh")
+        db_session.add(IdempotencyRecord(
+            user_id=test_user.id, key="old", fingerprint="stale", status_code=201, response="{}",
+            created_at=datetime.now(UTC) - timedelta(hours=settings.idempotency_key_ttl_hours + 1),
+        ))
+        await db_session.commit()
+        assert await sweep_idempotency_keys(db_session) == 1
+        await db_session.commit()
+        assert (await db_session.execute(select(func.count()).select_from(IdempotencyRecord))).scalar() == 1
+
+    async def test_replay_is_one_statement(self, client: AsyncClient, auth_headers, query_counter):
+        await self.post(client, auth_headers, "counted")
+        query_counter.clear()
+        assert (await self.post(client, auth_headers, "counted")).status_code == 201
+        assert len(query_counter) == 1
+
+    async def test_key_length_is_validated(self, client: AsyncClient, auth_headers):
+        response = await self.post(client, auth_headers, "k" * 256)
+        assert response.status_code == 422
+
+
+class TestWriteCoalescing:
+    @pytest.fixture(autouse=True)
+    async def coalescing(self, monkeypatch):
+        from coalesce import coalescer
+
+        monkeypatch.setattr(settings, "write_coalescing", True)
+        monkeypatch.setattr(coalescer, "window", 0.01)
+        yield coalescer
+        await coalescer.drain()
+
+    async def user_counters(self, db_session, user_id: int) -> tuple[int, int]:
+        from sqlalchemy import select
+
+        from models import User
+
+        row = (await db_session.execute(select(User.task_count, User.done_count).where(User.id == user_id))).one()
+        return tuple(row)
+
+    async def test_burst_collapses_to_one_update(self, client: AsyncClient, test_task, test_user, auth_headers, coalescing, db_session):
+        flushes = coalescing.flushes
+        with broker.subscribe(user_topic(test_user.id)) as subscription:
+            responses = await asyncio.gather(*(
+                client.patch(f"/api/tasks/{test_task.id}", json={"done": index % 2 == 0}, headers=auth_headers)
+                for index in range(5)
+            ))
+            events = read_frames(subscription)
+        assert {response.status_code for response in responses} == {200}
+        # Every request sees the row the group commit wrote (whichever request was queued last wins)
+        assert len({response.json()["done"] for response in responses}) == 1
+        assert len({response.headers["etag"] for response in responses}) == 1
+        done = responses[0].json()["done"]
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["done"] is done
+        assert coalescing.flushes == flushes + 1
+        assert [event for event, _ in events] == ["task.updated"]
+        assert await self.user_counters(db_session, test_user.id) == (1, int(done))
+
+    async def test_one_flush_covers_several_owners(self, client: AsyncClient, test_task, test_user, test_user2, auth_headers, auth_headers2, db_session):
+        theirs = (await client.post("/api/tasks", json={"task": "Theirs", "done": True, "due": None}, headers=auth_headers2)).json()
+        responses = await asyncio.gather(
+            client.patch(f"/api/tasks/{test_task.id}", json={"done": True, "task": "Mine, done"}, headers=auth_headers),
+            client.patch(f"/api/tasks/{theirs['id']}", json={"done": False}, headers=auth_headers2),
+        )
+        assert [response.status_code for response in responses] == [200, 200]
+        assert responses[0].json()["task"] == "Mine, done"
+        assert responses[1].json()["task"] == "Theirs"
+        assert await self.user_counters(db_session, test_user.id) == (1, 1)
+        assert await self.user_counters(db_session, test_user2.id) == (1, 0)
+
+    async def test_misses_keep_their_status(self, client: AsyncClient, test_task, auth_headers, auth_headers2):
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers2)
+        assert response.status_code == 403
+        response = await client.patch("/api/tasks/999999", json={"done": True}, headers=auth_headers)
+        assert response.status_code == 404
+        response = await client.get(f"/api/tasks/{test_task.id}")
+        assert response.json()["done"] is False
+
+    async def test_other_owner_is_not_merged(self, client: AsyncClient, test_task, auth_headers, auth_headers2):
+        mine, theirs = await asyncio.gather(
+            client.patch(f"/api/tasks/{test_task.id}", json={"task": "Mine"}, headers=auth_headers),
+            client.patch(f"/api/tasks/{test_task.id}", json={"task": "Not yours"}, headers=auth_headers2),
+        )
+        assert mine.status_code == 200
+        assert theirs.status_code == 403
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["task"] == "Mine"
+
+    async def test_null_for_a_required_field_is_not_queued(self, client: AsyncClient, test_task, auth_headers, coalescing):
+        submitted = coalescing.submitted
+        try:
+            await client.patch(f"/api/tasks/{test_task.id}", json={"done": None}, headers=auth_headers)
+        except IntegrityError:
+            pass
+        assert coalescing.submitted == submitted
+        assert coalescing.stats()["pending"] == 0
+
+    async def test_failed_entry_fails_alone(self, client: AsyncClient, test_task, auth_headers, auth_headers2, coalescing, monkeypatch):
+        import coalesce
+
+        # Let a bad entry into the group commit to check it doesn't take the others down with it
+        monkeypatch.setattr(coalesce, "NOT_NULL_FIELDS", frozenset())
+        theirs = (await client.post("/api/tasks", json={"task": "Theirs", "done": False, "due": None}, headers=auth_headers2)).json()
+        failures = coalescing.failures
+        bad, good = await asyncio.gather(
+            client.patch(f"/api/tasks/{test_task.id}", json={"task": None}, headers=auth_headers),
+            client.patch(f"/api/tasks/{theirs['id']}", json={"done": True}, headers=auth_headers2),
+            return_exceptions=True,
+        )
+        assert isinstance(bad, IntegrityError)
+        assert good.status_code == 200
+        assert good.json()["done"] is True
+        assert coalescing.failures == failures + 1
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["task"] == test_task.task
+
+    async def test_direct_write_lands_after_pending_update(self, client: AsyncClient, test_task, auth_headers, coalescing, monkeypatch):
+        monkeypatch.setattr(settings, "write_coalesce_durable", False)
+        monkeypatch.setattr(coalescing, "window", 60)
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True, "task": "Queued"}, headers=auth_headers)
+        assert response.status_code == 202
+        response = await client.put(f"/api/tasks/{test_task.id}", json={"task": "Put", "done": False, "due": None}, headers=auth_headers)
+        assert response.status_code == 200
+        assert coalescing.stats()["pending"] == 0
+        await coalescing.drain()
+        task = (await client.get(f"/api/tasks/{test_task.id}")).json()
+        assert (task["task"], task["done"]) == ("Put", False)
+
+    async def test_delete_takes_pending_update(self, client: AsyncClient, test_task, test_user, auth_headers, coalescing, monkeypatch, db_session):
+        monkeypatch.setattr(settings, "write_coalesce_durable", False)
+        monkeypatch.setattr(coalescing, "window", 60)
+        await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        response = await client.delete(f"/api/tasks/{test_task.id}", headers=auth_headers)
+        assert response.status_code == 204
+        assert coalescing.stats()["pending"] == 0
+        assert await self.user_counters(db_session, test_user.id) == (0, 0)
+
+    async def test_non_durable_answers_before_the_flush(self, client: AsyncClient, test_task, auth_headers, coalescing, monkeypatch):
+        monkeypatch.setattr(settings, "write_coalesce_durable", False)
+        monkeypatch.setattr(coalescing, "window", 60)
+        # Cache the task first, so the flush has to invalidate it
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["done"] is False
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        assert response.status_code == 202
+        assert response.json() == {"id": test_task.id, "pending": {"done": True}}
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["done"] is False
+        await coalescing.drain()
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["done"] is True
+
+    async def test_full_queue_writes_directly(self, client: AsyncClient, test_task, auth_headers, coalescing, monkeypatch):
+        monkeypatch.setattr(coalescing, "max_pending", 0)
+        overflows = coalescing.overflows
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        assert response.status_code == 200
+        assert response.json()["done"] is True
+        assert coalescing.overflows == overflows + 1
+
+    async def test_if_match_bypasses_coalescing(self, client: AsyncClient, test_task, auth_headers, coalescing):
+        etag = (await client.get(f"/api/tasks/{test_task.id}")).headers["etag"]
+        submitted = coalescing.submitted
+        response = await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers={**auth_headers, "If-Match": etag})
+        assert response.status_code == 200
+        assert coalescing.submitted == submitted
+
+    async def test_shutdown_flushes_pending_writes(self, client: AsyncClient, test_task, auth_headers, coalescing, monkeypatch):
+        from schema import create_schema
+
+        async with engine.begin() as conn:
+            await create_schema(conn)
+        monkeypatch.setattr(settings, "write_coalesce_durable", False)
+        monkeypatch.setattr(coalescing, "window", 60)
+        async with app.router.lifespan_context(app):
+            response = await client.patch(f"/api/tasks/{test_task.id}", json={"task": "Saved on shutdown"}, headers=auth_headers)
+            assert response.status_code == 202
+        assert coalescing.stats()["pending"] == 0
+        assert (await client.get(f"/api/tasks/{test_task.id}")).json()["task"] == "Saved on shutdown"
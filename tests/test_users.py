@@ -1,6 +1,13 @@
+import csv
+import io
+import json
+
 import pytest
 from httpx import AsyncClient
 
+from auth import password_pool
+from config import settings
+
 
 class TestCreateUser:
     async def test_create_user_success(self, client: AsyncClient):
@@ -45,6 +52,57 @@ class TestCreateUser:
         )
         assert response.status_code == 400
 
+    async def test_create_user_duplicate_email_other_case(self, client: AsyncClient, test_user):
+        response = await client.post(
+            "/api/users",
+            json={"username": "otheruser", "email": "Test@Example.com", "password": "password123"},
+        )
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Email already exists"
+
+    async def test_create_user_duplicate_username_other_case(self, client: AsyncClient, test_user):
+        response = await client.post(
+            "/api/users",
+            json={"username": "TestUser", "email": "other@example.com", "password": "password123"},
+        )
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Username already exists"
+
+    async def test_duplicate_is_named_by_constraint_not_by_text(self, client: AsyncClient):
+        # A username that contains "email" must still be reported as a duplicate username
+        payload = {"username": "email_fan", "email": "fan@example.com", "password": "password123"}
+        assert (await client.post("/api/users", json=payload)).status_code == 201
+        response = await client.post("/api/users", json={**payload, "email": "fan2@example.com"})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Username already exists"
+
+    async def test_create_user_is_one_insert(self, client: AsyncClient, query_counter):
+        response = await client.post(
+            "/api/users",
+            json={"username": "newuser", "email": "new@example.com", "password": "password123"},
+        )
+        assert response.status_code == 201
+        assert len(query_counter) == 1
+        assert query_counter[0].startswith("INSERT INTO users")
+
+    async def test_concurrent_signups_create_one_user(self, client: AsyncClient):
+        import asyncio
+
+        responses = await asyncio.gather(*(
+            client.post("/api/users", json={"username": name, "email": f"{index}@example.com", "password": "password123"})
+            for index, name in enumerate(["racer", "RACER", "Racer"])
+        ))
+        assert sorted(response.status_code for response in responses) == [201, 400, 400]
+        assert {response.json().get("detail") for response in responses if response.status_code == 400} == {"Username already exists"}
+
+    async def test_lookups_use_the_unique_indexes(self, db_session):
+        from sqlalchemy import text
+
+        plan = (await db_session.execute(text("EXPLAIN QUERY PLAN SELECT id FROM users WHERE lower(username) = 'testuser'"))).all()
+        assert any("ux_users_username_lower" in row[-1] for row in plan)
+        plan = (await db_session.execute(text("EXPLAIN QUERY PLAN SELECT id FROM users WHERE email = 'test@example.com'"))).all()
+        assert any(row[-1].startswith("SEARCH users USING") for row in plan)
+
     async def test_create_user_short_password(self, client: AsyncClient):
         response = await client.post(
             "/api/users",
@@ -59,6 +117,15 @@ class TestCreateUser:
         )
         assert response.status_code == 422
 
+    async def test_create_user_sheds_load_when_hash_pool_full(self, client: AsyncClient, monkeypatch):
+        monkeypatch.setattr(password_pool, "max_pending", 0)
+        response = await client.post(
+            "/api/users",
+            json={"username": "newuser", "email": "new@example.com", "password": "password123"},
+        )
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+
     async def test_create_user_missing_fields(self, client: AsyncClient):
         response = await client.post("/api/users", json={"username": "newuser"})
         assert response.status_code == 422
@@ -116,6 +183,25 @@ class TestUpdateUser:
         )
         assert response.status_code == 400
 
+    async def test_update_duplicate_username_other_case(self, client: AsyncClient, test_user, test_user2, auth_headers):
+        response = await client.patch(
+            f"/api/users/{test_user.id}",
+            json={"username": "TestUser2"},
+            headers=auth_headers,
+        )
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Username already exists"
+
+    async def test_update_duplicate_email(self, client: AsyncClient, test_user, test_user2, auth_headers):
+        response = await client.patch(
+            f"/api/users/{test_user.id}",
+            json={"email": "TEST2@example.com"},
+            headers=auth_headers,
+        )
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Email already registered"
+        assert (await client.get("/api/users/me", headers=auth_headers)).json()["email"] == "test@example.com"
+
     async def test_update_same_username_allowed(self, client: AsyncClient, test_user, auth_headers):
         response = await client.patch(
             f"/api/users/{test_user.id}",
@@ -140,6 +226,52 @@ class TestUpdateUser:
         assert response.status_code == 401
 
 
+class TestUserResponseCache:
+    async def test_update_invalidates_profile(self, client: AsyncClient, test_user, auth_headers):
+        await client.get(f"/api/users/{test_user.id}")
+        await client.patch(f"/api/users/{test_user.id}", json={"username": "renamed"}, headers=auth_headers)
+        assert (await client.get(f"/api/users/{test_user.id}")).json()["username"] == "renamed"
+
+    async def test_delete_invalidates_profile_and_tasks(self, client: AsyncClient, test_user, test_task, auth_headers):
+        await client.get(f"/api/users/{test_user.id}")
+        await client.get(f"/api/tasks/{test_task.id}")
+        await client.delete(f"/api/users/{test_user.id}", headers=auth_headers)
+        assert (await client.get(f"/api/users/{test_user.id}")).status_code == 404
+        assert (await client.get(f"/api/tasks/{test_task.id}")).status_code == 404
+
+    async def test_delete_invalidates_sparse_task(self, client: AsyncClient, test_user, test_task, auth_headers):
+        # Without the author block nothing else would notice the task is gone
+        await client.get(f"/api/tasks/{test_task.id}", params={"fields": "task"})
+        await client.delete(f"/api/users/{test_user.id}", headers=auth_headers)
+        assert (await client.get(f"/api/tasks/{test_task.id}", params={"fields": "task"})).status_code == 404
+
+
+class TestUserETags:
+    async def test_conditional_get_not_modified(self, client: AsyncClient, test_user):
+        etag = (await client.get(f"/api/users/{test_user.id}")).headers["ETag"]
+        response = await client.get(f"/api/users/{test_user.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+    async def test_update_changes_etag(self, client: AsyncClient, test_user, auth_headers):
+        etag = (await client.get(f"/api/users/{test_user.id}")).headers["ETag"]
+        response = await client.patch(
+            f"/api/users/{test_user.id}", json={"username": "renamed"}, headers={**auth_headers, "If-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert (await client.get(f"/api/users/{test_user.id}", headers={"If-None-Match": etag})).status_code == 200
+
+    async def test_update_with_stale_etag(self, client: AsyncClient, test_user, auth_headers):
+        response = await client.patch(
+            f"/api/users/{test_user.id}", json={"username": "renamed"}, headers={**auth_headers, "If-Match": '"99"'}
+        )
+        assert response.status_code == 412
+
+    async def test_delete_with_stale_etag(self, client: AsyncClient, test_user, auth_headers):
+        response = await client.delete(f"/api/users/{test_user.id}", headers={**auth_headers, "If-Match": '"99"'})
+        assert response.status_code == 412
+
+
 class TestDeleteUser:
     async def test_delete_own_user(self, client: AsyncClient, test_user, auth_headers):
         response = await client.delete(f"/api/users/{test_user.id}", headers=auth_headers)
@@ -165,7 +297,7 @@ class TestGetUserTasks:
     async def test_get_user_tasks(self, client: AsyncClient, test_user, test_task):
         response = await client.get(f"/api/users/{test_user.id}/tasks")
         assert response.status_code == 200
-        data = response.json()
+        data = response.json()["items"]
         assert isinstance(data, list)
         assert len(data) == 1
         assert data[0]["user_id"] == test_user.id
@@ -174,8 +306,132 @@ class TestGetUserTasks:
     async def test_get_user_tasks_empty(self, client: AsyncClient, test_user):
         response = await client.get(f"/api/users/{test_user.id}/tasks")
         assert response.status_code == 200
-        assert response.json() == []
+        assert response.json() == {"items": [], "next_cursor": None}
+
+    async def test_get_user_tasks_paginated(self, client: AsyncClient, test_user, test_user2, auth_headers, auth_headers2):
+        for i in range(3):
+            await client.post("/api/tasks", json={"task": f"Mine {i}", "done": False, "due": None}, headers=auth_headers)
+        await client.post("/api/tasks", json={"task": "Not mine", "done": False, "due": None}, headers=auth_headers2)
+
+        first = (await client.get(f"/api/users/{test_user.id}/tasks", params={"limit": 2})).json()
+        assert [t["task"] for t in first["items"]] == ["Mine 0", "Mine 1"]
+        second = (await client.get(f"/api/users/{test_user.id}/tasks", params={"limit": 2, "after": first["next_cursor"]})).json()
+        assert [t["task"] for t in second["items"]] == ["Mine 2"]
+        assert second["next_cursor"] is None
+
+    async def test_get_user_tasks_filtered(self, client: AsyncClient, test_user, auth_headers):
+        await client.post("/api/tasks", json={"task": "open", "done": False, "due": None}, headers=auth_headers)
+        await client.post("/api/tasks", json={"task": "closed", "done": True, "due": None}, headers=auth_headers)
+        response = await client.get(f"/api/users/{test_user.id}/tasks", params={"done": "true"})
+        assert [t["task"] for t in response.json()["items"]] == ["closed"]
 
     async def test_get_tasks_for_nonexistent_user(self, client: AsyncClient):
         response = await client.get("/api/users/99999/tasks")
         assert response.status_code == 404
+
+
+class TestExportUserTasks:
+    async def _seed(self, client, headers, count):
+        items = [{"task": f"Task {i}", "done": i % 2 == 0, "due": None} for i in range(count)]
+        response = await client.post("/api/tasks/batch", json={"items": items}, headers=headers)
+        assert response.status_code == 201
+
+    async def test_export_ndjson(self, client: AsyncClient, test_user, auth_headers, auth_headers2, monkeypatch):
+        monkeypatch.setattr(settings, "export_chunk_size", 2)
+        await self._seed(client, auth_headers, 5)
+        await self._seed(client, auth_headers2, 1)
+
+        response = await client.get(f"/api/users/{test_user.id}/tasks/export")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["task"] for row in rows] == [f"Task {i}" for i in range(5)]
+        assert all(row["user_id"] == test_user.id for row in rows)
+        assert rows[0]["done"] is True
+
+    async def test_export_csv(self, client: AsyncClient, test_user, auth_headers):
+        await self._seed(client, auth_headers, 3)
+        response = await client.get(f"/api/users/{test_user.id}/tasks/export", params={"format": "csv"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [row["task"] for row in rows] == ["Task 0", "Task 1", "Task 2"]
+        assert set(rows[0]) == {"id", "user_id", "task", "due", "done", "created"}
+
+    async def test_export_empty(self, client: AsyncClient, test_user):
+        response = await client.get(f"/api/users/{test_user.id}/tasks/export")
+        assert response.status_code == 200
+        assert response.text == ""
+
+    async def test_export_nonexistent_user(self, client: AsyncClient):
+        response = await client.get("/api/users/99999/tasks/export")
+        assert response.status_code == 404
+
+    async def test_export_invalid_format(self, client: AsyncClient, test_user):
+        response = await client.get(f"/api/users/{test_user.id}/tasks/export", params={"format": "xml"})
+        assert response.status_code == 422
+
+
+class TestUserTaskStats:
+    async def _stats(self, client, user_id):
+        response = await client.get(f"/api/users/{user_id}/tasks/stats")
+        assert response.status_code == 200
+        return response.json()
+
+    async def test_counters_follow_every_write(self, client: AsyncClient, test_user, test_task, auth_headers):
+        assert await self._stats(client, test_user.id) == {"total": 1, "done": 0, "open": 1, "overdue": 0, "due_this_week": 0}
+
+        await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers=auth_headers)
+        # Setting done to the value it already has changes nothing
+        await client.put(f"/api/tasks/{test_task.id}", json={"task": "Same", "done": True, "due": None}, headers=auth_headers)
+        created = await client.post(
+            "/api/tasks/batch",
+            json={"items": [{"task": f"Batch {i}", "done": i == 0, "due": None} for i in range(3)]},
+            headers=auth_headers,
+        )
+        ids = [item["id"] for item in created.json()["results"]]
+        assert (await self._stats(client, test_user.id))["done"] == 2
+
+        await client.patch("/api/tasks/batch", json={"items": [{"id": ids[0], "done": False}, {"id": ids[1], "done": True}, {"id": ids[2], "task": "x"}]}, headers=auth_headers)
+        assert await self._stats(client, test_user.id) == {"total": 4, "done": 2, "open": 2, "overdue": 0, "due_this_week": 0}
+
+        await client.delete("/api/tasks/batch", params={"ids": [ids[1], ids[2]]}, headers=auth_headers)
+        await client.delete(f"/api/tasks/{test_task.id}", headers=auth_headers)
+        assert await self._stats(client, test_user.id) == {"total": 1, "done": 0, "open": 1, "overdue": 0, "due_this_week": 0}
+
+    async def test_failed_write_leaves_counters(self, client: AsyncClient, test_user, test_task, auth_headers, auth_headers2):
+        await client.patch(f"/api/tasks/{test_task.id}", json={"done": True}, headers={**auth_headers, "If-Match": '"99"'})
+        await client.delete(f"/api/tasks/{test_task.id}", headers=auth_headers2)
+        assert await self._stats(client, test_user.id) == {"total": 1, "done": 0, "open": 1, "overdue": 0, "due_this_week": 0}
+
+    async def test_time_windows(self, client: AsyncClient, test_user, auth_headers):
+        from datetime import UTC, datetime, timedelta
+
+        now = datetime.now(UTC)
+        for due, done in [(now - timedelta(days=1), False), (now - timedelta(days=1), True), (now + timedelta(days=2), False), (now + timedelta(days=30), False)]:
+            await client.post("/api/tasks", json={"task": "t", "done": done, "due": due.isoformat()}, headers=auth_headers)
+        stats = await self._stats(client, test_user.id)
+        assert stats["overdue"] == 1
+        assert stats["due_this_week"] == 1
+        assert stats["total"] == 4
+
+    async def test_constant_query_count(self, client: AsyncClient, test_user, test_task, query_counter):
+        query_counter.clear()
+        await self._stats(client, test_user.id)
+        assert len(query_counter) == 2
+
+    async def test_unknown_user(self, client: AsyncClient):
+        response = await client.get("/api/users/99999/tasks/stats")
+        assert response.status_code == 404
+
+    async def test_rebuild_counters(self, client: AsyncClient, db_session, test_user, test_task):
+        from sqlalchemy import update
+
+        from crud import rebuild_task_counters
+        from models import User
+
+        await db_session.execute(update(User).values(task_count=7, done_count=3))
+        await db_session.commit()
+        assert await rebuild_task_counters(db_session) == 1
+        await db_session.commit()
+        assert await self._stats(client, test_user.id) == {"total": 1, "done": 0, "open": 1, "overdue": 0, "due_this_week": 0}
@@ -0,0 +1,87 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from config import settings
+
+# Per-request timings. The middleware in main.py puts a RequestTimings in the context var; the
+# engine hooks in database.py and the auth dependency add to it. Outside a request (fixtures,
+# scripts, background work) there is nothing in the var and the hooks do nothing
+
+logger = logging.getLogger("taskmanager.timing")
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+@dataclass(slots=True)
+class RequestTimings:
+    method: str
+    path: str
+    start: float = field(default_factory=time.perf_counter)
+    queries: int = 0
+    db_time: float = 0.0
+    # Named spans measured with timed(), e.g. "auth"
+    spans: dict[str, float] = field(default_factory=dict)
+
+    def record_query(self, statement: str) -> None:
+        self.queries += 1
+        if self.queries > settings.query_budget:
+            message = f"{self.method} {self.path} ran {self.queries} statements (budget {settings.query_budget}): {statement[:200]}"
+            if settings.query_budget_strict:
+                raise QueryBudgetExceeded(message)
+            # Only the first statement over budget is logged
+            if self.queries == settings.query_budget + 1:
+                logger.warning(message)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        # Durations in milliseconds; "total" is time until the response started
+        metrics = [f'db;dur={1000 * self.db_time:.1f};desc="{self.queries} queries"']
+        metrics += [f"{name};dur={1000 * duration:.1f}" for name, duration in self.spans.items()]
+        metrics.append(f"total;dur={1000 * self.elapsed():.1f}")
+        return ", ".join(metrics)
+
+    def as_dict(self, status_code: int) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status": status_code,
+            "queries": self.queries,
+            "db_ms": round(1000 * self.db_time, 2),
+            **{f"{name}_ms": round(1000 * duration, 2) for name, duration in self.spans.items()},
+            "total_ms": round(1000 * self.elapsed(), 2),
+        }
+
+
+current_timings: ContextVar[RequestTimings | None] = ContextVar("current_timings", default=None)
+
+
+@contextmanager
+def timed(name: str):
+    # Adds the duration of the block to the current request's span called name
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.spans[name] = timings.spans.get(name, 0.0) + time.perf_counter() - start
+
+
+def process_age() -> float | None:
+    # Seconds since this process started, interpreter and server imports included (Linux only)
+    try:
+        with open("/proc/self/stat") as stat:
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None